@@ -16,28 +16,45 @@
 from contextlib import contextmanager, nested
 import datetime
 import fcntl
+import inspect
 import logging
 import os
 import signal
+import threading
 import time
 
-from kazoo.client import KazooClient
+from kazoo.client import KazooState
+from kazoo.exceptions import BadVersionError
+from kazoo.exceptions import KazooException
 from kazoo.exceptions import LockTimeout
+from kazoo.exceptions import NodeExistsError
+from kazoo.exceptions import NoNodeError
+from marathon import MarathonError
 from marathon.models import MarathonApp
 
 import marathon_tools
 import mesos_tools
 from paasta_tools.smartstack_tools import DEFAULT_SYNAPSE_PORT
+from paasta_tools.smartstack_tools import query_locations
 from paasta_tools.monitoring.replication_utils import \
     get_registered_marathon_tasks
+from paasta_tools.zookeeper_tools import get_lost_zookeeper_sessions
+from paasta_tools.zookeeper_tools import get_zookeeper_client
 from utils import compose_job_id
 from utils import load_system_paasta_config
 
 log = logging.getLogger('__main__')
 logging.getLogger("requests").setLevel(logging.WARNING)
+# The scripts turn '__main__' down to WARNING unless they are verbose, but the
+# timings of create_app_lock are needed from every run to tune its leases.
+lease_timing_log = logging.getLogger('paasta_tools.bounce_lib.create_app_lock')
+lease_timing_log.setLevel(logging.INFO)
 
 ZK_LOCK_CONNECT_TIMEOUT_S = 10.0  # seconds to wait to connect to zookeeper
 ZK_LOCK_PATH = '/bounce'
+CREATE_APP_LOCK_PATH = '%s/create_marathon_app_lock' % ZK_LOCK_PATH
+CREATE_APP_SEMAPHORE_PATH = '%s/create_marathon_app_semaphore' % ZK_LOCK_PATH
+CREATE_APP_LOCK_TIMEOUT_S = 30
 WAIT_CREATE_S = 3
 WAIT_DELETE_S = 5
 
@@ -68,10 +85,30 @@ def list_bounce_methods():
     return _bounce_method_funcs.keys()
 
 
+def get_bounce_method_params(bounce_func, bounce_method_params):
+    """Split a service's bounce_method_params into the ones bounce_func takes, and the ones it doesn't.
+    Only the keyword arguments a bounce method gives a default for can be set this way.
+
+    :param bounce_func: A bounce function, as returned by get_bounce_method_func
+    :param bounce_method_params: The bounce_method_params dictionary from the service's config
+    :returns: A tuple of (dictionary of the params bounce_func takes, sorted list of the names of the others)"""
+    argspec = inspect.getargspec(bounce_func)
+    optional_args = argspec.args[len(argspec.args) - len(argspec.defaults or ()):]
+    accepted = dict((k, v) for k, v in bounce_method_params.items() if k in optional_args)
+    ignored = sorted(k for k in bounce_method_params if k not in accepted)
+    return accepted, ignored
+
+
 class LockHeldException(Exception):
     pass
 
 
+class LockLostException(Exception):
+
+    """Raised by check_zookeeper_locks once a held zookeeper lock is gone."""
+    pass
+
+
 @contextmanager
 def bounce_lock(name):
     """Acquire a bounce lockfile for the name given. The name should generally
@@ -95,47 +132,204 @@ def bounce_lock(name):
             os.remove(lockfile)
 
 
+def release_zookeeper_lock(lock, zk, lost_sessions, description):
+    """Release a lock taken with zk, warning if zk lost its session, and with it the
+    lock, since lost_sessions was read from get_lost_zookeeper_sessions.
+
+    :param lock: The acquired kazoo Lock
+    :param zk: The KazooClient the lock was taken with
+    :param lost_sessions: The number of sessions zk had lost when the lock was acquired
+    :param description: What the lock is for, for the log"""
+    if get_lost_zookeeper_sessions(zk) != lost_sessions:
+        log.error("Lost the zookeeper session while holding the lock for %s; "
+                  "someone else may have held it at the same time" % description)
+    try:
+        lock.release()
+    except KazooException as e:
+        # Once the session is gone, so is the lock's ephemeral node
+        log.warning("Failed to release the lock for %s: %s" % (description, e))
+
+
+# The (description, lost Event) of each zookeeper lock this thread holds, innermost last
+_held_zookeeper_locks = threading.local()
+
+
 @contextmanager
-def bounce_lock_zookeeper(name):
+def watch_zookeeper_lock(zk, lost_sessions, description):
+    """A contextmanager for the code holding a lock taken with zk. As soon as zk loses its
+    session, and with it the lock's ephemeral node, the lock is flagged as lost, and
+    check_zookeeper_locks raises a LockLostException in this thread from then on.
+
+    :param zk: The KazooClient the lock was taken with
+    :param lost_sessions: The number of sessions zk had lost when the lock was acquired
+    :param description: What the lock is for, for the exception"""
+    lost = threading.Event()
+
+    def listener(state):
+        # Kazoo calls listeners from its connection thread, so this must not block
+        if state == KazooState.LOST:
+            lost.set()
+    zk.add_listener(listener)
+    # The session may have been lost before the listener was added
+    if get_lost_zookeeper_sessions(zk) != lost_sessions:
+        lost.set()
+    held = getattr(_held_zookeeper_locks, 'value', [])
+    _held_zookeeper_locks.value = held + [(description, lost)]
+    try:
+        yield
+    finally:
+        _held_zookeeper_locks.value = held
+        zk.remove_listener(listener)
+
+
+def check_zookeeper_locks():
+    """Raise a LockLostException if the zookeeper session of a lock held by an enclosing
+    bounce_lock_zookeeper or create_app_lock in this thread was lost. Code holding such a
+    lock should call this before every change it makes, since someone else may hold the
+    lock once it is lost."""
+    for description, lost in getattr(_held_zookeeper_locks, 'value', []):
+        if lost.is_set():
+            raise LockLostException("Lost the zookeeper session, and with it the lock for %s" % description)
+
+
+@contextmanager
+def bounce_lock_zookeeper(name, zk=None):
     """Acquire a bounce lock in zookeeper for the name given. The name should
     generally be the service namespace being bounced.
 
     This is a contextmanager. Please use it via 'with bounce_lock(name):'.
 
-    :param name: The lock name to acquire"""
-    zk = KazooClient(hosts=load_system_paasta_config().get_zk_hosts(), timeout=ZK_LOCK_CONNECT_TIMEOUT_S)
-    zk.start()
+    :param name: The lock name to acquire
+    :param zk: An already started KazooClient to take the lock with. If not given,
+               the process's shared client from get_zookeeper_client is used."""
+    if zk is None:
+        zk = get_zookeeper_client(timeout=ZK_LOCK_CONNECT_TIMEOUT_S)
+    lost_sessions = get_lost_zookeeper_sessions(zk)
     lock = zk.Lock('%s/%s' % (ZK_LOCK_PATH, name))
     acquired = False
     try:
         lock.acquire(timeout=1)  # timeout=0 throws some other strange exception
         acquired = True
-        yield
+        with watch_zookeeper_lock(zk, lost_sessions, name):
+            yield
     except LockTimeout:
         raise LockHeldException("Service %s is already being bounced!" % name)
     finally:
         if acquired:
-            lock.release()
-        zk.stop()
+            release_zookeeper_lock(lock, zk, lost_sessions, name)
+
+
+def log_app_creation_lease_timing(event, seconds, leases):
+    """Log how long we waited for, or held, a lease of create_app_lock, in a
+    format that log-based metrics can pick up to tune the number of leases."""
+    lease_timing_log.info("create_app_lock %s_s=%.3f leases=%d" % (event, seconds, leases))
+
+
+def is_app_creation_lock_held(zk):
+    """Returns whether anyone holds create_app_lock, as a lock or a lease of the semaphore."""
+    for path in (CREATE_APP_LOCK_PATH, CREATE_APP_SEMAPHORE_PATH):
+        try:
+            if zk.get_children(path):
+                return True
+        except NoNodeError:
+            pass
+    return False
+
+
+def get_app_creation_leases(zk, configured_leases):
+    """Returns how many leases create_app_lock has across the cluster.
+
+    Every host must agree on it, so it is kept in one place, the data of the
+    CREATE_APP_SEMAPHORE_PATH node, where kazoo's Semaphore also checks it against
+    every acquirer. There is one lease while that node doesn't exist.
+
+    When this host is configured with a different count, the node is rewritten
+    with it, but only while nobody holds the lock, so that everyone holding it
+    agrees on the count. Until then, the stored count is used.
+
+    :param zk: A started KazooClient
+    :param configured_leases: The marathon_app_creation_leases of this host's config
+    :returns: The number of leases"""
+    try:
+        data, stat = zk.get(CREATE_APP_SEMAPHORE_PATH)
+    except NoNodeError:
+        data, stat = '1', None
+    try:
+        leases = int(data)
+    except (ValueError, TypeError):
+        log.warning("%s holds no number of leases" % CREATE_APP_SEMAPHORE_PATH)
+        leases = configured_leases
+    if leases == configured_leases:
+        return leases
+    if is_app_creation_lock_held(zk):
+        log.warning("Using the %d app creation leases stored in %s instead of the %d configured on this host "
+                    "until nobody holds them" % (leases, CREATE_APP_SEMAPHORE_PATH, configured_leases))
+        return leases
+    try:
+        if stat is None:
+            zk.create(CREATE_APP_SEMAPHORE_PATH, str(configured_leases), makepath=True)
+        else:
+            zk.set(CREATE_APP_SEMAPHORE_PATH, str(configured_leases), version=stat.version)
+    except (NodeExistsError, BadVersionError):
+        # Another host changed it at the same time, so let the next lock look again
+        return leases
+    log.info("Changed the app creation leases stored in %s from %d to %d" %
+             (CREATE_APP_SEMAPHORE_PATH, leases, configured_leases))
+    return configured_leases
 
 
 @contextmanager
-def create_app_lock():
-    """Acquire a lock in zookeeper for creating a marathon app. This is
-    due to marathon's extreme lack of resilience with creating multiple
-    apps at once, so we use this to not do that and only deploy
-    one app at a time."""
-    zk = KazooClient(hosts=load_system_paasta_config().get_zk_hosts(), timeout=ZK_LOCK_CONNECT_TIMEOUT_S)
-    zk.start()
-    lock = zk.Lock('%s/%s' % (ZK_LOCK_PATH, 'create_marathon_app_lock'))
+def create_app_lock(zk=None, leases=None):
+    """Acquire a lock in zookeeper for creating or deleting a marathon app.
+    This is due to marathon's extreme lack of resilience with creating
+    multiple apps at once, so we use this to only deploy a few apps at a
+    time across the whole cluster.
+
+    With one lease, this is a plain lock on CREATE_APP_LOCK_PATH, the same one
+    older versions of paasta take. With more, it is a lease of a semaphore on
+    CREATE_APP_SEMAPHORE_PATH, which older versions know nothing about, so only
+    raise marathon_app_creation_leases once every host runs this version.
+
+    :param zk: An already started KazooClient to take the lock with. If not given,
+               the process's shared client from get_zookeeper_client is used,
+               which is also the one bounce locks are taken with by default.
+    :param leases: How many apps may be created at the same time, which becomes the
+                   count for the whole cluster once nobody holds the lock (see
+                   get_app_creation_leases). If not given, the
+                   marathon_app_creation_leases of the system paasta config is used."""
+    if leases is None:
+        leases = load_system_paasta_config().get_marathon_app_creation_leases()
+    if zk is None:
+        zk = get_zookeeper_client(timeout=ZK_LOCK_CONNECT_TIMEOUT_S)
+    lost_sessions = get_lost_zookeeper_sessions(zk)
+    leases = get_app_creation_leases(zk, leases)
+    if leases == 1:
+        lock = zk.Lock(CREATE_APP_LOCK_PATH)
+    else:
+        lock = zk.Semaphore(CREATE_APP_SEMAPHORE_PATH, max_leases=leases)
+    acquired = False
+    wait_start = time.time()
     try:
-        lock.acquire(timeout=30)  # timeout=0 throws some other strange exception
-        yield
+        try:
+            lock.acquire(timeout=CREATE_APP_LOCK_TIMEOUT_S)
+        except ValueError as e:
+            # kazoo's check of max_leases, if the count was changed since we read it
+            raise LockHeldException("Failed to acquire lock for creating marathon app: %s" % e)
+        acquired = True
+        hold_start = time.time()
+        log_app_creation_lease_timing('wait', hold_start - wait_start, leases)
+        with watch_zookeeper_lock(zk, lost_sessions, 'creating marathon apps'):
+            yield
     except LockTimeout:
+        log_app_creation_lease_timing('wait_timeout', time.time() - wait_start, leases)
         raise LockHeldException("Failed to acquire lock for creating marathon app!")
     finally:
-        lock.release()
-        zk.stop()
+        if acquired:
+            log_app_creation_lease_timing('hold', time.time() - hold_start, leases)
+            release_zookeeper_lock(lock, zk, lost_sessions, 'creating marathon apps')
+
+
+_time_limit_deadline = threading.local()
 
 
 @contextmanager
@@ -143,7 +337,19 @@ def time_limit(minutes):
     """A contextmanager to raise a TimeoutException whenever a specified
     number of minutes has passed.
 
+    Signals can only be handled in the main thread, so in any other thread
+    this only sets a deadline, and the code inside has to call
+    check_time_limit() to find out whether it has passed.
+
     :param minutes: The number of minutes until an exception is raised"""
+    if threading.current_thread().name != 'MainThread':
+        _time_limit_deadline.value = time.time() + minutes * 60
+        try:
+            yield
+        finally:
+            _time_limit_deadline.value = None
+        return
+
     def signal_handler(signum, frame):
         raise TimeoutException("Time limit expired")
     signal.signal(signal.SIGALRM, signal_handler)
@@ -154,15 +360,31 @@ def time_limit(minutes):
         signal.alarm(0)
 
 
-def wait_for_create(app_id, client):
-    """Wait for the specified app_id to be listed in marathon.
-    Waits WAIT_CREATE_S seconds between calls to list_apps.
+def check_time_limit():
+    """Raise a TimeoutException if the deadline set by an enclosing time_limit
+    in this (non-main) thread has passed."""
+    deadline = getattr(_time_limit_deadline, 'value', None)
+    if deadline is not None and time.time() > deadline:
+        raise TimeoutException("Time limit expired")
+
+
+def wait_for_create(app_id, client, events=None):
+    """Wait for the specified app_id to be known to marathon.
+    Checks on just that app with GET /v2/apps/<app_id> whenever the event
+    stream mentions it, or every WAIT_CREATE_S seconds otherwise.
 
     :param app_id: The app_id to ensure creation for
-    :param client: A MarathonClient object"""
-    while marathon_tools.is_app_id_running(app_id, client) is False:
+    :param client: A MarathonClient object
+    :param events: A MarathonEventStream opened before the app was created,
+                   or None to only check every WAIT_CREATE_S seconds"""
+    while marathon_tools.is_app_id_present(app_id, client) is False:
+        check_time_limit()
+        check_zookeeper_locks()
         log.info("Waiting for %s to be created in marathon..", app_id)
-        time.sleep(WAIT_CREATE_S)
+        if events is None:
+            time.sleep(WAIT_CREATE_S)
+        else:
+            events.wait_for_app_event(app_id, WAIT_CREATE_S)
 
 
 def create_marathon_app(app_id, config, client):
@@ -171,20 +393,29 @@ def create_marathon_app(app_id, config, client):
 
     :param config: The marathon configuration to be deployed
     :param client: A MarathonClient object"""
-    with nested(create_app_lock(), time_limit(1)):
+    with nested(create_app_lock(), time_limit(1), marathon_tools.MarathonEventStream(client)) as (_, _, events):
+        check_zookeeper_locks()
         client.create_app(app_id, MarathonApp(**config))
-        wait_for_create(app_id, client)
+        wait_for_create(app_id, client, events)
 
 
-def wait_for_delete(app_id, client):
-    """Wait for the specified app_id to not be listed in marathon
-    anymore. Waits WAIT_DELETE_S seconds inbetween checks.
+def wait_for_delete(app_id, client, events=None):
+    """Wait for the specified app_id to not be known to marathon
+    anymore. Checks on just that app with GET /v2/apps/<app_id> whenever
+    the event stream mentions it, or every WAIT_DELETE_S seconds otherwise.
 
     :param app_id: The app_id to check for deletion
-    :param client: A MarathonClient object"""
-    while marathon_tools.is_app_id_running(app_id, client) is True:
+    :param client: A MarathonClient object
+    :param events: A MarathonEventStream opened before the app was deleted,
+                   or None to only check every WAIT_DELETE_S seconds"""
+    while marathon_tools.is_app_id_present(app_id, client) is True:
+        check_time_limit()
+        check_zookeeper_locks()
         log.info("Waiting for %s to be deleted from marathon...", app_id)
-        time.sleep(WAIT_DELETE_S)
+        if events is None:
+            time.sleep(WAIT_DELETE_S)
+        else:
+            events.wait_for_app_event(app_id, WAIT_DELETE_S)
 
 
 def delete_marathon_app(app_id, client):
@@ -193,13 +424,15 @@ def delete_marathon_app(app_id, client):
 
     :param app_id: The marathon app id to be deleted
     :param client: A MarathonClient object"""
-    with nested(create_app_lock(), time_limit(1)):
+    with nested(create_app_lock(), time_limit(1), marathon_tools.MarathonEventStream(client)) as (_, _, events):
+        check_zookeeper_locks()
         # Scale app to 0 first to work around
         # https://github.com/mesosphere/marathon/issues/725
         client.scale_app(app_id, instances=0, force=True)
         time.sleep(1)
+        check_zookeeper_locks()
         client.delete_app(app_id, force=True)
-        wait_for_delete(app_id, client)
+        wait_for_delete(app_id, client, events)
 
 
 def kill_old_ids(old_ids, client):
@@ -210,6 +443,7 @@ def kill_old_ids(old_ids, client):
     :param old_ids: A list of old job/app ids to kill
     :param client: A marathon.MarathonClient object"""
     for app in old_ids:
+        check_zookeeper_locks()
         try:
             log.info("Killing %s", app)
             delete_marathon_app(app, client)
@@ -217,6 +451,33 @@ def kill_old_ids(old_ids, client):
             continue
 
 
+def kill_tasks(tasks, client):
+    """Kill tasks and scale their apps down to match, with one bulk request to
+    marathon. If marathon rejects the bulk request, every task is killed on its
+    own instead, so that one bad task can't keep the others alive and so that
+    every task that couldn't be killed is known.
+
+    :param tasks: A collection of MarathonTask objects to kill
+    :param client: A MarathonClient object
+    :returns: A dict of the tasks that couldn't be killed to the MarathonError
+              marathon gave for each of them"""
+    tasks = list(tasks)
+    if not tasks:
+        return {}
+    try:
+        marathon_tools.kill_given_tasks(client, [task.id for task in tasks], scale=True)
+        return {}
+    except MarathonError as e:
+        log.warning("Failed to kill %d tasks at once, killing them one at a time: %s", len(tasks), e)
+    failures = {}
+    for task in tasks:
+        try:
+            client.kill_task(task.app_id, task.id, scale=True)
+        except MarathonError as e:
+            failures[task] = e
+    return failures
+
+
 def get_happy_tasks(app, service, nerve_ns, min_task_uptime=None, check_haproxy=False):
     """Given a MarathonApp object, return the subset of tasks which are considered healthy.
     With the default options, this returns tasks where at least one of the defined Marathon healthchecks passes.
@@ -241,14 +502,17 @@ def get_happy_tasks(app, service, nerve_ns, min_task_uptime=None, check_haproxy=
         discover_location_type = service_namespace_config.get_discover()
         unique_values = mesos_tools.get_mesos_slaves_grouped_by_attribute(discover_location_type)
 
-        for value, hosts in unique_values.iteritems():
-            synapse_host = hosts[0]
-            tasks_in_smartstack.extend(get_registered_marathon_tasks(
+        registered_tasks_by_location = query_locations(
+            unique_values,
+            lambda synapse_host: get_registered_marathon_tasks(
                 synapse_host,
                 DEFAULT_SYNAPSE_PORT,
                 service_namespace,
                 tasks,
-            ))
+            ),
+        )
+        for value in unique_values:
+            tasks_in_smartstack.extend(registered_tasks_by_location[value])
         tasks = tasks_in_smartstack
 
     for task in tasks:
@@ -276,6 +540,7 @@ def brutal_bounce(
     new_app_running,
     happy_new_tasks,
     old_app_live_tasks,
+    old_app_draining_tasks,
 ):
     """Pays no regard to safety. Starts the new app if necessary, and kills any
     old ones. Mostly meant as an example of the simplest working bounce method,
@@ -286,6 +551,8 @@ def brutal_bounce(
     :param happy_new_tasks: Set of MarathonTasks belonging to the new application that are considered healthy and up.
     :param old_app_live_tasks: Dictionary of app_id -> set(Tasks) belonging to apps for old apps for this service. Tasks
                                that are being drained are not included in this dictionary.
+    :param old_app_draining_tasks: Dictionary of app_id -> set(Tasks) belonging to old apps for this service which are
+                                   being drained but have not been killed yet.
     :return: A dictionary representing the desired bounce actions and containing the following keys:
               - create_app: True if we should start the new Marathon app, False otherwise.
               - tasks_to_drain: a set of task objects which should be drained and killed. May be empty.
@@ -303,6 +570,7 @@ def upthendown_bounce(
     new_app_running,
     happy_new_tasks,
     old_app_live_tasks,
+    old_app_draining_tasks,
 ):
     """Starts a new app if necessary; only kills old apps once all the requested tasks for the new version are running.
 
@@ -327,6 +595,7 @@ def crossover_bounce(
     new_app_running,
     happy_new_tasks,
     old_app_live_tasks,
+    old_app_draining_tasks,
 ):
     """Starts a new app if necessary; slowly kills old apps as instances of the new app become happy.
 
@@ -353,12 +622,73 @@ def crossover_bounce(
         }
 
 
+def get_bounce_margin(value, instances, round_up):
+    """Turn a max_surge or max_unavailable value into a number of tasks.
+
+    :param value: Either an absolute number of tasks, or a percentage of instances like '25%'
+    :param instances: The number of instances the new app should end up with
+    :param round_up: Whether a percentage which is not a whole number of tasks should be rounded up or down
+    :returns: A number of tasks, no greater than instances"""
+    if isinstance(value, basestring) and value.endswith('%'):
+        tasks, remainder = divmod(int(value[:-1]) * instances, 100)
+        if round_up and remainder:
+            tasks += 1
+    else:
+        tasks = int(value)
+    return min(max(tasks, 0), instances)
+
+
+@register_bounce_method('rolling')
+def rolling_bounce(
+    new_config,
+    new_app_running,
+    happy_new_tasks,
+    old_app_live_tasks,
+    old_app_draining_tasks,
+    max_surge='25%',
+    max_unavailable=0,
+):
+    """Replaces old tasks with new ones in waves. The new app is kept small enough that there are never more than
+    instances + max_surge live tasks, and old tasks are only drained while at least instances - max_unavailable
+    tasks stay up. Raising either parameter makes bounces faster, at the cost of spare capacity or availability.
+
+    Both parameters may be a number of tasks or a percentage of instances. A percentage max_surge is rounded up, a
+    percentage max_unavailable is rounded down, and max_surge is at least 1 if max_unavailable is 0 so the bounce can
+    always make progress.
+
+    See the docstring for brutal_bounce() for the other parameters. In addition to the usual keys, the returned
+    dictionary contains new_app_instances: the number of instances the new app should be scaled to.
+    """
+    instances = new_config['instances']
+    surge = get_bounce_margin(max_surge, instances, round_up=True)
+    unavailable = get_bounce_margin(max_unavailable, instances, round_up=False)
+    if surge == 0 and unavailable == 0:
+        surge = 1
+
+    old_tasks = []
+    for app, tasks in sorted(old_app_live_tasks.items()):
+        old_tasks.extend(sorted(tasks, key=lambda task: task.id))
+    draining_count = sum(len(tasks) for tasks in old_app_draining_tasks.values())
+
+    # Old tasks are only counted as gone once they have been killed, so the new app can only grow into the room
+    # left by tasks which were drained and killed on a previous run.
+    new_app_instances = max(min(instances, instances + surge - len(old_tasks) - draining_count), 0)
+    needed_count = max(instances - unavailable - len(happy_new_tasks), 0)
+
+    return {
+        "create_app": not new_app_running,
+        "tasks_to_drain": set(old_tasks[needed_count:]),
+        "new_app_instances": new_app_instances,
+    }
+
+
 @register_bounce_method('downthenup')
 def downthenup_bounce(
     new_config,
     new_app_running,
     happy_new_tasks,
     old_app_live_tasks,
+    old_app_draining_tasks,
 ):
     """Stops any old apps and waits for them to die before starting a new one.
 
@@ -377,6 +707,7 @@ def down_bounce(
     new_app_running,
     happy_new_tasks,
     old_app_live_tasks,
+    old_app_draining_tasks,
 ):
     """
     Stops old apps, doesn't start any new apps.
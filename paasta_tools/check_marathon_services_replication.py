@@ -108,6 +108,7 @@ def check_smartstack_replication_for_instance(
     soa_dir,
     crit_threshold,
     expected_count,
+    replication_checker=None,
 ):
     """Check a set of namespaces to see if their number of available backends is too low,
     emitting events to Sensu based on the fraction available and the thresholds given.
@@ -117,6 +118,7 @@ def check_smartstack_replication_for_instance(
     :param cluster: name of the cluster
     :param soa_dir: The SOA configuration directory to read from
     :param crit_threshold: The fraction of instances that need to be up to avoid a CRITICAL event
+    :param replication_checker: An optional SmartstackReplicationChecker to share across instances
     """
     namespace = marathon_tools.read_namespace_for_service_instance(service, instance, soa_dir=soa_dir)
     if namespace != instance:
@@ -128,7 +130,8 @@ def check_smartstack_replication_for_instance(
     monitoring_blacklist = job_config.get_monitoring_blacklist()
     log.info('Checking instance %s in smartstack', full_name)
     smartstack_replication_info = load_smartstack_info_for_service(
-        service=service, namespace=namespace, soa_dir=soa_dir, blacklist=monitoring_blacklist)
+        service=service, namespace=namespace, soa_dir=soa_dir, blacklist=monitoring_blacklist,
+        replication_checker=replication_checker)
     log.debug('Got smartstack replication info for %s: %s' % (full_name, smartstack_replication_info))
 
     if len(smartstack_replication_info) == 0:
@@ -162,9 +165,15 @@ def check_smartstack_replication_for_instance(
     send_event(service=service, namespace=instance, cluster=cluster, soa_dir=soa_dir, status=status, output=output)
 
 
-def get_healthy_marathon_instances_for_short_app_id(client, app_id):
-    tasks = client.list_tasks()
-    tasks_for_app = [task for task in tasks if task.app_id.startswith('/%s' % app_id)]
+def get_healthy_marathon_instances_for_short_app_id(client, app_id, task_index=None):
+    """Count the healthy tasks of the apps whose id starts with app_id.
+
+    :param task_index: An optional marathon_tools.MarathonTaskIndex of every task in the cluster.
+                       If None, the tasks are listed from the client.
+    """
+    if task_index is None:
+        task_index = marathon_tools.MarathonTaskIndex(client.list_tasks())
+    tasks_for_app = task_index.get_tasks_with_app_id_prefix('/%s' % app_id)
 
     one_minute_ago = datetime.now() - timedelta(minutes=1)
 
@@ -177,10 +186,10 @@ def get_healthy_marathon_instances_for_short_app_id(client, app_id):
 
 
 def check_healthy_marathon_tasks_for_service_instance(client, service, instance, cluster,
-                                                      soa_dir, crit_threshold, expected_count):
+                                                      soa_dir, crit_threshold, expected_count, task_index=None):
     app_id = format_job_id(service, instance)
     log.info("Checking %s in marathon as it is not in smartstack" % app_id)
-    num_healthy_tasks = get_healthy_marathon_instances_for_short_app_id(client, app_id)
+    num_healthy_tasks = get_healthy_marathon_instances_for_short_app_id(client, app_id, task_index=task_index)
     send_event_if_under_replication(
         service=service,
         instance=instance,
@@ -220,7 +229,8 @@ def send_event_if_under_replication(
         output=output)
 
 
-def check_service_replication(client, service, instance, cluster, crit_threshold, soa_dir):
+def check_service_replication(client, service, instance, cluster, crit_threshold, soa_dir, expected_counts=None,
+                              replication_checker=None, task_index=None):
     """Checks a service's replication levels based on how the service's replication
     should be monitored. (smartstack or mesos)
 
@@ -229,13 +239,25 @@ def check_service_replication(client, service, instance, cluster, crit_threshold
     :param cluster: name of the cluster
     :param crit_threshold: an int from 0-100 representing the percentage threshold for triggering an alert
     :param soa_dir: The SOA configuration directory to read from
+    :param expected_counts: A dictionary of {(service, namespace): expected instance count} from
+                            marathon_tools.get_expected_instance_counts_by_namespace. If None, the
+                            expected count for this instance is looked up on its own.
+    :param replication_checker: An optional SmartstackReplicationChecker to share across instances
+    :param task_index: An optional marathon_tools.MarathonTaskIndex of every task in the cluster
     """
     job_id = compose_job_id(service, instance)
-    try:
-        expected_count = marathon_tools.get_expected_instance_count_for_namespace(service, instance, soa_dir=soa_dir)
-    except NoDeploymentsAvailable:
+    if expected_counts is None:
+        try:
+            expected_count = marathon_tools.get_expected_instance_count_for_namespace(
+                service, instance, soa_dir=soa_dir)
+        except NoDeploymentsAvailable:
+            log.info('deployments.json missing for %s. Skipping replication monitoring.' % job_id)
+            return
+    elif (service, instance) not in expected_counts:
         log.info('deployments.json missing for %s. Skipping replication monitoring.' % job_id)
         return
+    else:
+        expected_count = expected_counts[(service, instance)]
     if expected_count is None:
         return
     log.info("Expecting %d total tasks for %s" % (expected_count, job_id))
@@ -247,7 +269,8 @@ def check_service_replication(client, service, instance, cluster, crit_threshold
             cluster=cluster,
             soa_dir=soa_dir,
             crit_threshold=crit_threshold,
-            expected_count=expected_count)
+            expected_count=expected_count,
+            replication_checker=replication_checker)
     else:
         check_healthy_marathon_tasks_for_service_instance(
             client=client,
@@ -257,15 +280,18 @@ def check_service_replication(client, service, instance, cluster, crit_threshold
             soa_dir=soa_dir,
             crit_threshold=crit_threshold,
             expected_count=expected_count,
+            task_index=task_index,
         )
 
 
-def load_smartstack_info_for_service(service, namespace, soa_dir, blacklist):
+def load_smartstack_info_for_service(service, namespace, soa_dir, blacklist, replication_checker=None):
     """Retrives number of available backends for given services
 
     :param service_instances: A list of tuples of (service, instance)
     :param namespaces: list of Smartstack namespaces
     :param blacklist: A list of blacklisted location tuples in the form (location, value)
+    :param replication_checker: An optional SmartstackReplicationChecker to query instead of
+                                asking mesos and synapse directly
     :returns: a dictionary of the form
 
     ::
@@ -283,6 +309,12 @@ def load_smartstack_info_for_service(service, namespace, soa_dir, blacklist):
     service_namespace_config = marathon_tools.load_service_namespace_config(service, namespace,
                                                                             soa_dir=soa_dir)
     discover_location_type = service_namespace_config.get_discover()
+    if replication_checker is not None:
+        return replication_checker.get_replication_for_attribute(
+            attribute=discover_location_type,
+            service=service,
+            namespace=namespace,
+            blacklist=blacklist)
     return get_smartstack_replication_for_attribute(
         attribute=discover_location_type,
         service=service,
@@ -301,21 +333,77 @@ def get_smartstack_replication_for_attribute(attribute, service, namespace, blac
     :returns: a dictionary of the form {'<unique_attribute_value>': <smartstack replication hash>}
               (the dictionary will contain keys for unique all attribute values)
     """
-    replication_info = {}
     unique_values = mesos_tools.get_mesos_slaves_grouped_by_attribute(attribute=attribute, blacklist=blacklist)
     full_name = compose_job_id(service, namespace)
 
-    for value, hosts in unique_values.iteritems():
-        # arbitrarily choose the first host with a given attribute to query for replication stats
-        synapse_host = hosts[0]
-        repl_info = replication_utils.get_replication_for_services(
+    return smartstack_tools.query_locations(
+        unique_values,
+        lambda synapse_host: replication_utils.get_replication_for_services(
             synapse_host=synapse_host,
             synapse_port=smartstack_tools.DEFAULT_SYNAPSE_PORT,
             services=[full_name],
-        )
-        replication_info[value] = repl_info
+        ),
+    )
+
 
-    return replication_info
+class SmartstackReplicationChecker(object):
+    """Answers the same questions as get_smartstack_replication_for_attribute for many
+    service namespaces in one run, but only groups the mesos slaves once per
+    (attribute, blacklist) and only downloads the haproxy CSV of each synapse host once.
+    Most namespaces share a blacklist, so a run downloads one CSV per location rather
+    than one per service per location.
+    """
+
+    def __init__(self, mesos_slaves, synapse_port=smartstack_tools.DEFAULT_SYNAPSE_PORT):
+        """:param mesos_slaves: The 'slaves' list of the mesos state"""
+        self.mesos_slaves = mesos_slaves
+        self.synapse_port = synapse_port
+        self._grouped_slaves = {}
+        self._replication_by_host = {}
+
+    def get_grouped_slaves(self, attribute, blacklist):
+        key = (attribute, tuple(tuple(entry) for entry in blacklist or []))
+        if key not in self._grouped_slaves:
+            self._grouped_slaves[key] = mesos_tools.get_mesos_slaves_grouped_by_attribute(
+                attribute=attribute,
+                blacklist=blacklist,
+                slaves=self.mesos_slaves,
+            )
+        return self._grouped_slaves[key]
+
+    def get_replication_for_host(self, synapse_host):
+        if synapse_host not in self._replication_by_host:
+            self._replication_by_host[synapse_host] = replication_utils.get_replication_for_all_services(
+                synapse_host=synapse_host,
+                synapse_port=self.synapse_port,
+            )
+        return self._replication_by_host[synapse_host]
+
+    def get_replication_for_attribute(self, attribute, service, namespace, blacklist):
+        """Like get_smartstack_replication_for_attribute, see its docstring for the parameters
+        and the returned dictionary. The synapse hosts that haven't been asked yet are all
+        asked at the same time."""
+        full_name = compose_job_id(service, namespace)
+        grouped_slaves = self.get_grouped_slaves(attribute, blacklist)
+        unqueried_locations = dict(
+            (value, hosts) for value, hosts in grouped_slaves.iteritems()
+            if hosts[0] not in self._replication_by_host
+        )
+        for value, replication in smartstack_tools.query_locations(
+            unqueried_locations,
+            lambda synapse_host: replication_utils.get_replication_for_all_services(
+                synapse_host=synapse_host,
+                synapse_port=self.synapse_port,
+            ),
+        ).iteritems():
+            # Remembered under the first host of the location, whichever of its hosts answered
+            self._replication_by_host[unqueried_locations[value][0]] = replication
+
+        replication_info = {}
+        for value, hosts in grouped_slaves.iteritems():
+            # arbitrarily choose the first host with a given attribute to query for replication stats
+            replication_info[value] = {full_name: self.get_replication_for_host(hosts[0])[full_name]}
+        return replication_info
 
 
 def main():
@@ -333,6 +421,10 @@ def main():
 
     config = marathon_tools.load_marathon_config()
     client = marathon_tools.get_marathon_client(config.get_url(), config.get_username(), config.get_password())
+    expected_counts = marathon_tools.get_expected_instance_counts_by_namespace(
+        service_instances, cluster=cluster, soa_dir=soa_dir)
+    replication_checker = SmartstackReplicationChecker(mesos_tools.get_mesos_state_cache()['state']['slaves'])
+    task_index = marathon_tools.MarathonTaskIndex(client.list_tasks())
     for service, instance in service_instances:
         check_service_replication(
             client=client,
@@ -341,6 +433,9 @@ def main():
             cluster=cluster,
             crit_threshold=crit_threshold,
             soa_dir=soa_dir,
+            expected_counts=expected_counts,
+            replication_checker=replication_checker,
+            task_index=task_index,
         )
 
 
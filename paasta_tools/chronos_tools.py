@@ -41,6 +41,7 @@ from paasta_tools.utils import load_deployments_json
 from paasta_tools.utils import load_system_paasta_config
 from paasta_tools.utils import PaastaColors
 from paasta_tools.utils import PATH_TO_SYSTEM_PAASTA_CONFIG_DIR
+from paasta_tools.utils import read_extra_service_information
 from paasta_tools.utils import timeout
 
 
@@ -143,7 +144,7 @@ def read_chronos_jobs_for_service(service, cluster, soa_dir=DEFAULT_SOA_DIR):
     chronos_conf_file = 'chronos-%s' % cluster
     log.info("Reading Chronos configuration file: %s/%s/chronos-%s.yaml" % (soa_dir, service, cluster))
 
-    return service_configuration_lib.read_extra_service_information(
+    return read_extra_service_information(
         service,
         chronos_conf_file,
         soa_dir=soa_dir
@@ -13,11 +13,19 @@
 # limitations under the License.
 
 import re
-import requests
+import threading
 import time
 
+from concurrent.futures import ThreadPoolExecutor
+import requests
+
+# How many hacheck requests a HacheckDrainMethod makes at the same time by default
+DEFAULT_HACHECK_JOBS = 16
 
 _drain_methods = {}
+_hacheck_session = None
+_hacheck_session_pool_maxsize = 0
+_hacheck_session_lock = threading.Lock()
 
 
 def register_drain_method(name):
@@ -37,6 +45,22 @@ def list_drain_methods():
     return sorted(_drain_methods.keys())
 
 
+def get_hacheck_session(jobs=DEFAULT_HACHECK_JOBS):
+    """Returns the requests.Session shared by every hacheck request this process makes,
+    so that requests to the same hacheck reuse its connections.
+
+    :param jobs: How many concurrent requests to one host the caller makes. The session
+                 is replaced by one with bigger connection pools if its are smaller."""
+    global _hacheck_session, _hacheck_session_pool_maxsize
+    with _hacheck_session_lock:
+        if _hacheck_session is None or _hacheck_session_pool_maxsize < jobs:
+            session = requests.Session()
+            session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=jobs))
+            _hacheck_session = session
+            _hacheck_session_pool_maxsize = jobs
+        return _hacheck_session
+
+
 class DrainMethod(object):
     """A drain method is a way of stopping new traffic to tasks without killing them. For example, you might take a task
     out of a load balancer by causing its healthchecks to fail.
@@ -48,6 +72,10 @@ class DrainMethod(object):
                           process, because a bounce may take multiple runs of setup_marathon_job to complete.
      - is_safe_to_kill(task): Return True if this task is safe to kill, False otherwise.
 
+    The batch variants drain_many, stop_draining_many, is_draining_many and is_safe_to_kill_many
+    call the methods above once per task. Drain methods that make a remote call per task should
+    override them to make those calls concurrently.
+
     When implementing a drain method, be sure to decorate with @register_drain_method(name).
     """
 
@@ -72,6 +100,24 @@ class DrainMethod(object):
         """Return True if a task is drained and ready to be killed, or False if we should wait."""
         raise NotImplementedError()
 
+    def drain_many(self, tasks):
+        """Make several tasks stop receiving new traffic."""
+        for task in tasks:
+            self.drain(task)
+
+    def stop_draining_many(self, tasks):
+        """Make several previously downed tasks start receiving traffic again."""
+        for task in tasks:
+            self.stop_draining(task)
+
+    def is_draining_many(self, tasks):
+        """Return a dict of each task to whether it is being drained."""
+        return dict((task, self.is_draining(task)) for task in tasks)
+
+    def is_safe_to_kill_many(self, tasks):
+        """Return a dict of each task to whether it is drained and ready to be killed."""
+        return dict((task, self.is_safe_to_kill(task)) for task in tasks)
+
 
 @register_drain_method('noop')
 class NoopDrainMethod(DrainMethod):
@@ -118,12 +164,22 @@ class TestDrainMethod(DrainMethod):
 @register_drain_method('hacheck')
 class HacheckDrainMethod(DrainMethod):
     """This drain policy issues a POST to hacheck's /spool/{service}/{port}/status endpoint to cause healthchecks to
-    fail. It considers tasks safe to kill if they've been down in hacheck for more than a specified delay."""
-    def __init__(self, service, instance, nerve_ns, delay=120, hacheck_port=6666, expiration=0, **kwargs):
+    fail. It considers tasks safe to kill if they've been down in hacheck for more than a specified delay.
+
+    The batch methods make up to `jobs` hacheck requests at the same time.
+
+    Spools are cached for the lifetime of the drain method, which is one run of setup_marathon_job for one
+    service instance, so that a task's spool is fetched once per bounce rather than once per question asked
+    about it. A task's cached spool is dropped when we post a different status for it."""
+    def __init__(self, service, instance, nerve_ns, delay=120, hacheck_port=6666, expiration=0,
+                 jobs=DEFAULT_HACHECK_JOBS, **kwargs):
         super(HacheckDrainMethod, self).__init__(service, instance, nerve_ns)
         self.delay = float(delay)
         self.hacheck_port = hacheck_port
         self.expiration = float(expiration) or float(delay) * 10
+        self.jobs = int(jobs)
+        self._spool_cache = {}
+        self._spool_cache_lock = threading.Lock()
 
     def spool_url(self, task):
         return 'http://%(task_host)s:%(hacheck_port)d/spool/%(service)s.%(nerve_ns)s/%(task_port)d/status' % {
@@ -135,7 +191,7 @@ class HacheckDrainMethod(DrainMethod):
         }
 
     def post_spool(self, task, status):
-        resp = requests.post(
+        resp = get_hacheck_session(self.jobs).post(
             self.spool_url(task),
             data={
                 'status': status,
@@ -144,10 +200,32 @@ class HacheckDrainMethod(DrainMethod):
             },
         )
         resp.raise_for_status()
+        with self._spool_cache_lock:
+            # Bounces re-drain draining tasks every run and rely on that leaving their 'since' alone,
+            # so only a different status makes the cached spool wrong
+            cached_spool = self._spool_cache.get(self.spool_url(task))
+            if cached_spool is not None and cached_spool['state'] != status:
+                del self._spool_cache[self.spool_url(task)]
+
+    def clear_spool_cache(self):
+        with self._spool_cache_lock:
+            self._spool_cache.clear()
 
     def get_spool(self, task):
-        """Query hacheck for the state of a task, and parse the result into a dictionary."""
-        response = requests.get(self.spool_url(task))
+        """Query hacheck for the state of a task, and parse the result into a dictionary.
+        The answer is cached, see the class docstring."""
+        url = self.spool_url(task)
+        with self._spool_cache_lock:
+            if url in self._spool_cache:
+                return self._spool_cache[url]
+        info = self.fetch_spool(url)
+        with self._spool_cache_lock:
+            self._spool_cache[url] = info
+        return info
+
+    def fetch_spool(self, url):
+        """Query hacheck for a spool, bypassing the cache."""
+        response = get_hacheck_session(self.jobs).get(url)
         if response.status_code == 200:
             return {
                 'state': 'up',
@@ -175,6 +253,36 @@ class HacheckDrainMethod(DrainMethod):
             info['reason'] = groupdict['reason']
         return info
 
+    def map_tasks(self, func, tasks):
+        """Call func on every task, up to self.jobs at the same time.
+
+        :returns: A dict of each task to what func returned for it. If func raised
+                  for any task, the first such exception is raised instead."""
+        tasks = list(tasks)
+        if not tasks:
+            return {}
+        executor = ThreadPoolExecutor(max_workers=min(self.jobs, len(tasks)))
+        try:
+            futures = [(task, executor.submit(func, task)) for task in tasks]
+            return dict((task, future.result()) for task, future in futures)
+        finally:
+            executor.shutdown(wait=True)
+
+    def get_spool_many(self, tasks):
+        """Query hacheck for the state of several tasks at the same time.
+
+        :returns: A dict of each task to its parsed spool, as returned by get_spool"""
+        return self.map_tasks(self.get_spool, tasks)
+
+    def spool_is_draining(self, info):
+        return info["state"] != "up"
+
+    def spool_is_safe_to_kill(self, info):
+        if info["state"] == "up":
+            return False
+        else:
+            return info.get("since", 0) < (time.time() - self.delay)
+
     def drain(self, task):
         self.post_spool(task, 'down')
 
@@ -182,15 +290,19 @@ class HacheckDrainMethod(DrainMethod):
         self.post_spool(task, 'up')
 
     def is_draining(self, task):
-        info = self.get_spool(task)
-        if info["state"] == "up":
-            return False
-        else:
-            return True
+        return self.spool_is_draining(self.get_spool(task))
 
     def is_safe_to_kill(self, task):
-        info = self.get_spool(task)
-        if info["state"] == "up":
-            return False
-        else:
-            return info.get("since", 0) < (time.time() - self.delay)
+        return self.spool_is_safe_to_kill(self.get_spool(task))
+
+    def drain_many(self, tasks):
+        self.map_tasks(self.drain, tasks)
+
+    def stop_draining_many(self, tasks):
+        self.map_tasks(self.stop_draining, tasks)
+
+    def is_draining_many(self, tasks):
+        return dict((task, self.spool_is_draining(info)) for task, info in self.get_spool_many(tasks).items())
+
+    def is_safe_to_kill_many(self, tasks):
+        return dict((task, self.spool_is_safe_to_kill(info)) for task, info in self.get_spool_many(tasks).items())
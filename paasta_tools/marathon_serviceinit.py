@@ -21,15 +21,17 @@ import isodate
 import requests_cache
 
 from paasta_tools import marathon_tools
-from paasta_tools.mesos_tools import get_running_tasks_from_active_frameworks
 from paasta_tools.mesos_tools import get_mesos_slaves_grouped_by_attribute
+from paasta_tools.mesos_tools import MesosTaskQuery
 from paasta_tools.mesos_tools import status_mesos_tasks_verbose
 from paasta_tools.monitoring.replication_utils import match_backends_and_tasks, backend_is_up
 from paasta_tools.smartstack_tools import DEFAULT_SYNAPSE_PORT
 from paasta_tools.smartstack_tools import get_backends
+from paasta_tools.smartstack_tools import query_locations
 from paasta_tools.utils import compose_job_id
 from paasta_tools.utils import datetime_from_utc_to_local
 from paasta_tools.utils import format_table
+from paasta_tools.utils import get_service_instance_list
 from paasta_tools.utils import is_under_replicated
 from paasta_tools.utils import _log
 from paasta_tools.utils import NoDockerImageError
@@ -272,16 +274,16 @@ def pretty_print_smartstack_backends_for_locations(service_instance, tasks, loca
     """
     rows = [("      Name", "LastCheck", "LastChange", "Status")]
     expected_count_per_location = int(expected_count / len(locations))
+    backends_by_location = query_locations(
+        locations,
+        lambda synapse_host: get_backends(service_instance, synapse_host=synapse_host,
+                                          synapse_port=DEFAULT_SYNAPSE_PORT),
+    )
     for location in sorted(locations):
-        hosts = locations[location]
-        # arbitrarily choose the first host with a given attribute to query for replication stats
-        synapse_host = hosts[0]
-        sorted_backends = sorted(get_backends(service_instance,
-                                              synapse_host=synapse_host,
-                                              synapse_port=DEFAULT_SYNAPSE_PORT),
+        sorted_backends = sorted(backends_by_location[location],
                                  key=lambda backend: backend['status'],
                                  reverse=True)  # Specify reverse so that backends in 'UP' are placed above 'MAINT'
-        matched_tasks = match_backends_and_tasks(sorted_backends, tasks)
+        matched_tasks = match_backends_and_tasks(sorted_backends, tasks, pre_resolve=True)
         running_count = sum(1 for backend, task in matched_tasks if backend and backend_is_up(backend))
         rows.append("    %s - %s" % (location, haproxy_backend_report(expected_count_per_location, running_count)))
 
@@ -298,9 +300,11 @@ def get_short_task_id(task_id):
     return task_id.split(marathon_tools.MESOS_TASK_SPACER)[-1]
 
 
-def status_mesos_tasks(service, instance, normal_instance_count):
+def status_mesos_tasks(service, instance, normal_instance_count, task_query=None):
+    if task_query is None:
+        task_query = MesosTaskQuery()
     job_id = marathon_tools.format_job_id(service, instance)
-    running_and_active_tasks = get_running_tasks_from_active_frameworks(job_id)
+    running_and_active_tasks = task_query.get_running_tasks(job_id)
     count = len(running_and_active_tasks)
     if count >= normal_instance_count:
         status = PaastaColors.green("Healthy")
@@ -335,7 +339,12 @@ def perform_command(command, service, instance, cluster, verbose, soa_dir, app_i
             return 1
 
     normal_instance_count = job_config.get_instances()
-    normal_smartstack_count = marathon_tools.get_expected_instance_count_for_namespace(service, instance)
+    expected_counts = marathon_tools.get_expected_instance_counts_by_namespace(
+        get_service_instance_list(service, cluster=cluster, instance_type='marathon', soa_dir=soa_dir),
+        cluster=cluster,
+        soa_dir=soa_dir,
+    )
+    normal_smartstack_count = expected_counts.get((service, instance), 0)
     proxy_port = marathon_tools.get_proxy_port_for_instance(service, instance, soa_dir=soa_dir)
 
     client = marathon_tools.get_marathon_client(marathon_config.get_url(), marathon_config.get_username(),
@@ -355,9 +364,11 @@ def perform_command(command, service, instance, cluster, verbose, soa_dir, app_i
         tasks, out = status_marathon_job_verbose(service, instance, client)
         if verbose:
             print out
-        print status_mesos_tasks(service, instance, normal_instance_count)
+        # Both views of the mesos tasks are answered from a single fetch
+        task_query = MesosTaskQuery()
+        print status_mesos_tasks(service, instance, normal_instance_count, task_query=task_query)
         if verbose:
-            print status_mesos_tasks_verbose(app_id, get_short_task_id)
+            print status_mesos_tasks_verbose(app_id, get_short_task_id, task_query=task_query)
         if proxy_port is not None:
             print status_smartstack_backends(
                 service=service,
@@ -18,20 +18,30 @@ that interact with marathon. There's config parsers, url composers,
 and a number of other things used by other components in order to
 make the PaaSTA stack work.
 """
+import bisect
+import datetime
 import logging
 import os
 import pipes
 import re
 import socket
+import threading
+import time
 from time import sleep
 
 from marathon import MarathonClient
 from marathon import NotFoundError
+from marathon.models import MarathonApp
+from marathon.models.task import MarathonTask
+from marathon.util import MarathonJsonEncoder
 import json
+import Queue
+import requests
 import service_configuration_lib
 
 from paasta_tools.mesos_tools import get_local_slave_state
 from paasta_tools.mesos_tools import get_mesos_slaves_grouped_by_attribute
+from paasta_tools.utils import atomic_file_write
 from paasta_tools.utils import deploy_blacklist_to_constraints
 from paasta_tools.utils import compose_job_id
 from paasta_tools.utils import decompose_job_id
@@ -45,9 +55,12 @@ from paasta_tools.utils import InvalidInstanceConfig
 from paasta_tools.utils import load_deployments_json
 from paasta_tools.utils import load_system_paasta_config
 from paasta_tools.utils import NoConfigurationForServiceError
+from paasta_tools.utils import NoDeploymentsAvailable
 from paasta_tools.utils import PaastaColors
 from paasta_tools.utils import PaastaNotConfiguredError
 from paasta_tools.utils import PATH_TO_SYSTEM_PAASTA_CONFIG_DIR
+from paasta_tools.utils import read_extra_service_information
+from paasta_tools.utils import read_service_configuration
 from paasta_tools.utils import timeout
 
 CONTAINER_PORT = 8888
@@ -59,6 +72,14 @@ DEFAULT_SOA_DIR = service_configuration_lib.DEFAULT_SOA_DIR
 MESOS_TASK_SPACER = '.'
 PATH_TO_MARATHON_CONFIG = os.path.join(PATH_TO_SYSTEM_PAASTA_CONFIG_DIR, 'marathon.json')
 PUPPET_SERVICE_DIR = '/etc/nerve/puppet_services.d'
+# A marathon snapshot older than this is not trusted by setup_marathon_job,
+# which falls back to asking Marathon directly.
+MARATHON_SNAPSHOT_MAX_AGE_S = 300
+MARATHON_EVENT_STREAM_CONNECT_TIMEOUT_S = 5
+# A quiet event stream is given up on, and reopened later, after this long.
+# Waiting for an event doesn't depend on it, so it can be longer than any wait.
+MARATHON_EVENT_STREAM_READ_TIMEOUT_S = 60
+MARATHON_EVENT_STREAM_CHUNK_SIZE = 64 * 1024
 
 log = logging.getLogger('__main__')
 logging.getLogger('marathon').setLevel(logging.WARNING)
@@ -125,13 +146,13 @@ def load_marathon_service_config(service, instance, cluster, load_deployments=Tr
     :returns: A dictionary of whatever was in the config for the service instance"""
     log.info("Reading service configuration files from dir %s/ in %s" % (service, soa_dir))
     log.info("Reading general configuration file: service.yaml")
-    general_config = service_configuration_lib.read_service_configuration(
+    general_config = read_service_configuration(
         service,
         soa_dir=soa_dir
     )
     marathon_conf_file = "marathon-%s" % cluster
     log.info("Reading marathon configuration file: %s.yaml", marathon_conf_file)
-    instance_configs = service_configuration_lib.read_extra_service_information(
+    instance_configs = read_extra_service_information(
         service,
         marathon_conf_file,
         soa_dir=soa_dir
@@ -220,6 +241,13 @@ class MarathonServiceConfig(InstanceConfig):
         :returns: The bounce method specified in the config, or 'crossover' if not specified"""
         return self.config_dict.get('bounce_method', 'crossover')
 
+    def get_bounce_method_params(self):
+        """Get the bounce method parameters specified in the service's marathon configuration,
+        such as max_surge and max_unavailable for the rolling bounce method.
+
+        :returns: The bounce_method_params dictionary specified in the config, or {} if not specified"""
+        return self.config_dict.get('bounce_method_params', {})
+
     def get_drain_method(self, service_namespace_config):
         """Get the drain method specified in the service's marathon configuration.
 
@@ -484,7 +512,7 @@ def load_service_namespace_config(service, namespace, soa_dir=DEFAULT_SOA_DIR):
     :returns: A dict of the above keys, if they were defined
     """
 
-    service_config = service_configuration_lib.read_service_configuration(service, soa_dir)
+    service_config = read_service_configuration(service, soa_dir)
     smartstack_config = service_config.get('smartstack', {})
     namespace_config_from_file = smartstack_config.get(namespace, {})
 
@@ -619,7 +647,7 @@ def read_namespace_for_service_instance(name, instance, cluster=None, soa_dir=DE
     If one is not defined in the config file, returns instance instead."""
     if not cluster:
         cluster = load_system_paasta_config().get_cluster()
-    srv_info = service_configuration_lib.read_extra_service_information(
+    srv_info = read_extra_service_information(
         name,
         "marathon-%s" % cluster,
         soa_dir
@@ -656,7 +684,7 @@ def get_all_namespaces_for_service(service, soa_dir=DEFAULT_SOA_DIR, full_name=T
     :returns: A list of tuples of the form (service<SPACER>namespace, namespace_config) if full_name is true,
               otherwise of the form (namespace, namespace_config)
     """
-    service_config = service_configuration_lib.read_service_configuration(service, soa_dir)
+    service_config = read_service_configuration(service, soa_dir)
     smartstack = service_config.get('smartstack', {})
     namespace_list = []
     for namespace in smartstack:
@@ -814,6 +842,202 @@ def is_app_id_running(app_id, client):
     return app_id in all_app_ids
 
 
+def is_app_id_present(app_id, client):
+    """Returns a boolean indicating if marathon knows about the app.
+    Unlike is_app_id_running this only asks about the one app, with
+    GET /v2/apps/<app_id>, instead of listing every app in marathon.
+
+    :param app_id: The app_id to look for
+    :param client: A MarathonClient object"""
+    try:
+        client.get_app(app_id)
+    except NotFoundError:
+        return False
+    return True
+
+
+class MarathonEventStream(object):
+    """A subscription to the server sent events marathon publishes on /v2/events.
+
+    It is only used to find out sooner that something happened to an app, so
+    it never raises: if the stream can't be opened or breaks, waiting for an
+    event falls back to sleeping for the whole wait, and callers are expected to
+    check the app's actual state after every wait. Open the stream before
+    making the change you want to wait for, so its events can't be missed.
+
+    A thread reads the stream while it is open, so one connection serves every
+    wait, and events that arrive between waits are kept for the next one."""
+
+    def __init__(self, client, connect_timeout_s=MARATHON_EVENT_STREAM_CONNECT_TIMEOUT_S,
+                 read_timeout_s=MARATHON_EVENT_STREAM_READ_TIMEOUT_S):
+        self.client = client
+        self.connect_timeout_s = connect_timeout_s
+        self.read_timeout_s = read_timeout_s
+        self._response = None
+        self._lines = None
+        self._unavailable = False
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def open(self):
+        """Opens the stream on the first marathon server that accepts it.
+
+        :returns: Whether the stream is open"""
+        if self._lines is not None:
+            return True
+        if self._unavailable:
+            return False
+        for server in self.client.servers:
+            try:
+                response = requests.get(
+                    '%s/v2/events' % server.rstrip('/'),
+                    headers={'Accept': 'text/event-stream'},
+                    auth=self.client.auth,
+                    stream=True,
+                    timeout=(self.connect_timeout_s, self.read_timeout_s),
+                )
+            except requests.exceptions.RequestException as e:
+                log.debug("Could not open the marathon event stream on %s: %s" % (server, e))
+                continue
+            if response.status_code != 200:
+                # Nothing will change that by retrying, e.g. the event stream is disabled
+                log.debug("Marathon %s has no event stream: HTTP %d" % (server, response.status_code))
+                response.close()
+                self._unavailable = True
+                return False
+            self._response = response
+            self._lines = Queue.Queue()
+            reader = threading.Thread(target=self._read_lines, args=(response, self._lines))
+            reader.daemon = True
+            reader.start()
+            return True
+        return False
+
+    def is_available(self):
+        """Returns False once marathon has said it has no event stream."""
+        return not self._unavailable
+
+    def close(self):
+        if self._response is not None:
+            self._response.close()
+        self._response = None
+        self._lines = None
+
+    @classmethod
+    def _read_lines(cls, response, lines):
+        """Put each line of a response on a queue, then None once it ends or breaks."""
+        try:
+            for line in cls._iter_lines(response):
+                lines.put(line)
+        except Exception as e:
+            # Usually a read timeout because marathon was quiet, or the stream being closed
+            log.debug("Marathon event stream stopped: %s" % e)
+        lines.put(None)
+
+    @staticmethod
+    def _iter_lines(response):
+        # Events must be seen as soon as they arrive. For a chunked response, which
+        # marathon's event stream is, iter_content returns each chunk as it arrives,
+        # whatever chunk_size is; otherwise it waits for chunk_size bytes.
+        # Marathon ends lines with \r\n, which Response.iter_lines can split in two.
+        chunk_size = MARATHON_EVENT_STREAM_CHUNK_SIZE if response.raw.chunked else 1
+        pending = ''
+        for chunk in response.iter_content(chunk_size=chunk_size):
+            lines = (pending + chunk).split('\n')
+            pending = lines.pop()
+            for line in lines:
+                yield line.rstrip('\r')
+
+    def iter_events(self):
+        """Yield each event marathon sends as a tuple of (event type, data), where data
+        is the event's json as a string. Stops when the stream can't be opened, breaks,
+        or has been quiet for read_timeout_s, after which it can be iterated again."""
+        if not self.open():
+            return
+        lines = self._lines
+        event_type, data = None, []
+        while True:
+            line = lines.get()
+            if line is None:
+                break
+            if line.startswith('event:'):
+                event_type = line[len('event:'):].strip()
+            elif line.startswith('data:'):
+                data.append(line[len('data:'):].strip())
+            elif not line:
+                if data:
+                    yield event_type, '\n'.join(data)
+                event_type, data = None, []
+        self.close()
+
+    def wait_for_app_event(self, app_id, timeout_s):
+        """Wait up to timeout_s seconds for an event that mentions an app.
+
+        :param app_id: The app_id, without a leading '/'
+        :param timeout_s: How many seconds to wait at most
+        :returns: True if such an event arrived, False if it didn't in time
+                  or if the event stream isn't available"""
+        deadline = time.time() + timeout_s
+        if not self.open():
+            sleep(max(0, deadline - time.time()))
+            return False
+        # Every event carries app ids in their '/'-prefixed form, in a json string
+        needle = '"/%s"' % app_id.lstrip('/')
+        while True:
+            try:
+                line = self._lines.get(timeout=max(0, deadline - time.time()))
+            except Queue.Empty:
+                return False
+            if line is None:
+                # The stream broke, so open a new one next time
+                self.close()
+                sleep(max(0, deadline - time.time()))
+                return False
+            if line.startswith('data:') and needle in line:
+                return True
+
+
+def marathon_request(client, method, path, params=None, data=None):
+    """Make a request to marathon that MarathonClient has no method for, with the
+    client's _do_request, so it still fails over between servers and raises
+    MarathonError like the client's own methods do.
+
+    _do_request is private to the client, so this relies on the marathon==0.7.5
+    pinned in requirements.txt. test_marathon_request_matches_client fails if its
+    signature changes.
+
+    :param client: A MarathonClient object
+    :param method: The HTTP method
+    :param path: The path of the endpoint, like '/v2/tasks/delete'
+    :param params: A dict of query parameters
+    :param data: The body of the request
+    :returns: What _do_request returns, the requests.Response"""
+    return client._do_request(method, path, params=params, data=data)
+
+
+def kill_given_tasks(client, task_ids, scale):
+    """Kill tasks, of any number of apps, with a single request to marathon's
+    POST /v2/tasks/delete endpoint. With scale, marathon scales all their apps
+    down in one deployment, instead of starting a deployment per killed task.
+
+    :param client: A MarathonClient object
+    :param task_ids: The ids of the tasks to kill
+    :param scale: Whether to scale the tasks' apps down by the number of tasks killed
+    :raises marathon.MarathonError: if marathon didn't accept the request"""
+    marathon_request(
+        client,
+        'POST',
+        '/v2/tasks/delete',
+        params={'scale': scale},
+        data=json.dumps({'ids': list(task_ids)}),
+    )
+
+
 def app_has_tasks(client, app_id, expected_tasks, exact_matches_only=False):
     """ A predicate function indicating whether an app has launched *at least* expected_tasks
     tasks.
@@ -864,14 +1088,17 @@ def wait_for_app_to_launch_tasks(client, app_id, expected_tasks, exact_matches_o
             sleep(0.5)
 
 
-def create_complete_config(service, instance, marathon_config, soa_dir=DEFAULT_SOA_DIR):
-    """Generates a complete dictionary to be POST'ed to create an app on Marathon"""
-    system_paasta_config = load_system_paasta_config()
+def create_complete_config(service, instance, marathon_config, soa_dir=DEFAULT_SOA_DIR, system_paasta_config=None):
+    """Generates a complete dictionary to be POST'ed to create an app on Marathon
+
+    :param system_paasta_config: An already loaded SystemPaastaConfig. If not given, it is loaded from disk."""
+    if system_paasta_config is None:
+        system_paasta_config = load_system_paasta_config()
     partial_id = format_job_id(service=service, instance=instance)
     instance_config = load_marathon_service_config(
         service=service,
         instance=instance,
-        cluster=load_system_paasta_config().get_cluster(),
+        cluster=system_paasta_config.get_cluster(),
         soa_dir=soa_dir,
     )
     docker_url = get_docker_url(system_paasta_config.get_docker_registry(), instance_config.get_docker_image())
@@ -920,6 +1147,33 @@ def get_expected_instance_count_for_namespace(service, namespace, cluster=None,
     return total_expected
 
 
+def get_expected_instance_counts_by_namespace(service_instances, cluster=None, soa_dir=DEFAULT_SOA_DIR):
+    """Get the number of expected instances for every namespace of the given service
+    instances in one pass, loading each instance's config only once.
+
+    Each (service, instance) is in the result, with 0 if no instance is announced
+    under a namespace of that name, just like get_expected_instance_count_for_namespace.
+    Instances of services without a deployments.json are left out.
+
+    :param service_instances: A list of tuples of (service, instance), like the ones
+                              returned by get_services_for_cluster
+    :param cluster: The cluster to read the configuration for
+    :param soa_dir: The SOA configuration directory to read from
+    :returns: A dictionary of {(service, namespace): expected instance count}"""
+    if not cluster:
+        cluster = load_system_paasta_config().get_cluster()
+    expected_counts = {}
+    for service, instance in service_instances:
+        try:
+            srv_config = load_marathon_service_config(service, instance, cluster, soa_dir=soa_dir)
+        except NoDeploymentsAvailable:
+            continue
+        expected_counts.setdefault((service, instance), 0)
+        key = (service, srv_config.get_nerve_namespace())
+        expected_counts[key] = expected_counts.get(key, 0) + srv_config.get_instances()
+    return expected_counts
+
+
 def get_matching_appids(servicename, instance, client):
     """Returns a list of appids given a service and instance.
     Useful for fuzzy matching if you think there are marathon
@@ -930,12 +1184,134 @@ def get_matching_appids(servicename, instance, client):
 def get_matching_apps(servicename, instance, client, embed_failures=False):
     """Returns a list of appids given a service and instance.
     Useful for fuzzy matching if you think there are marathon
-    apps running but you don't know the full instance id"""
+    apps running but you don't know the full instance id
+
+    :param client: A MarathonClient object, or a MarathonSnapshot to read the apps from"""
     jobid = format_job_id(servicename, instance)
     expected_prefix = "/%s%s" % (jobid, MESOS_TASK_SPACER)
     return [app for app in client.list_apps(embed_failures=embed_failures) if app.id.startswith(expected_prefix)]
 
 
+class MarathonSnapshotNotAvailable(Exception):
+    pass
+
+
+class MarathonSnapshotJsonEncoder(MarathonJsonEncoder):
+    """Like MarathonJsonEncoder, but writes datetimes in the same format Marathon
+    uses, so MarathonApp.from_json can parse them back."""
+
+    def default(self, obj):
+        if isinstance(obj, datetime.datetime):
+            return obj.strftime(MarathonTask.DATETIME_FORMAT)
+        return super(MarathonSnapshotJsonEncoder, self).default(obj)
+
+
+class MarathonSnapshot(object):
+    """A point-in-time copy of every app in Marathon, with tasks and last task
+    failures embedded, as returned by ``list_apps(embed_failures=True)``.
+
+    Fetching every app is expensive on a large cluster, so deploy_marathon_services
+    fetches one snapshot per cycle and every setup_marathon_job reads from it.
+    It has the same ``list_apps`` signature as a MarathonClient, so read-only code
+    like get_matching_apps can be handed either one. Anything that mutates Marathon
+    must still go through a real client."""
+
+    def __init__(self, apps, timestamp):
+        self.apps = apps
+        self.timestamp = timestamp
+
+    def list_apps(self, embed_tasks=False, embed_failures=False):
+        return list(self.apps)
+
+    def get_age(self):
+        return time.time() - self.timestamp
+
+    def is_stale(self, max_age_s=MARATHON_SNAPSHOT_MAX_AGE_S):
+        return self.get_age() > max_age_s
+
+
+def fetch_marathon_snapshot(client):
+    """Take a snapshot of all the apps (and their tasks) currently in Marathon.
+
+    :param client: A MarathonClient object
+    :returns: A MarathonSnapshot"""
+    timestamp = time.time()
+    apps = client.list_apps(embed_failures=True)
+    return MarathonSnapshot(apps=apps, timestamp=timestamp)
+
+
+class SharedMarathonSnapshot(object):
+    """Hands out one MarathonSnapshot to every thread of a long run, fetching a new one
+    from the client as soon as it is stale, so no thread reads apps older than max_age_s."""
+
+    def __init__(self, client, snapshot=None, max_age_s=MARATHON_SNAPSHOT_MAX_AGE_S):
+        self.client = client
+        self.snapshot = snapshot
+        self.max_age_s = max_age_s
+        self._lock = threading.Lock()
+
+    def get(self):
+        """Returns a MarathonSnapshot which is no older than max_age_s"""
+        with self._lock:
+            if self.snapshot is None or self.snapshot.is_stale(self.max_age_s):
+                self.snapshot = fetch_marathon_snapshot(self.client)
+            return self.snapshot
+
+
+def write_marathon_snapshot(snapshot, path):
+    """Atomically persist a MarathonSnapshot to path, so that other processes
+    can read it with load_marathon_snapshot."""
+    with atomic_file_write(path) as f:
+        json.dump(
+            {
+                'timestamp': snapshot.timestamp,
+                'apps': [app.json_repr() for app in snapshot.apps],
+            },
+            f,
+            cls=MarathonSnapshotJsonEncoder,
+        )
+
+
+def load_marathon_snapshot(path):
+    """Read a MarathonSnapshot previously written by write_marathon_snapshot.
+
+    :param path: The file the snapshot was written to
+    :returns: A MarathonSnapshot
+    :raises MarathonSnapshotNotAvailable: if the snapshot can't be read or parsed"""
+    try:
+        with open(path) as f:
+            raw_snapshot = json.load(f)
+        return MarathonSnapshot(
+            apps=[MarathonApp.from_json(app) for app in raw_snapshot['apps']],
+            timestamp=raw_snapshot['timestamp'],
+        )
+    except IOError as e:
+        raise MarathonSnapshotNotAvailable("Could not read marathon snapshot %s: %s" % (e.filename, e.strerror))
+    except (ValueError, KeyError, TypeError) as e:
+        raise MarathonSnapshotNotAvailable("Could not parse marathon snapshot %s: %s" % (path, e))
+
+
+class MarathonTaskIndex(object):
+    """Marathon tasks sorted by app id, so that the tasks whose app id starts
+    with a prefix can be found without scanning every task in the cluster."""
+
+    def __init__(self, tasks):
+        """:param tasks: A list of MarathonTask objects, like the ones returned by client.list_tasks()"""
+        self.tasks = sorted(tasks, key=lambda task: task.app_id)
+        self.app_ids = [task.app_id for task in self.tasks]
+
+    def get_tasks_with_app_id_prefix(self, prefix):
+        """Get the tasks whose app id starts with prefix, in O(log(tasks) + matching tasks).
+
+        :param prefix: The app id prefix, like '/example_service.main'
+        :returns: A list of MarathonTask objects"""
+        start = bisect.bisect_left(self.app_ids, prefix)
+        end = start
+        while end < len(self.app_ids) and self.app_ids[end].startswith(prefix):
+            end += 1
+        return self.tasks[start:end]
+
+
 def get_healthcheck_for_instance(service, instance, service_manifest, random_port, soa_dir=DEFAULT_SOA_DIR):
     """
     Returns healthcheck for a given service instance in the form of a tuple (mode, healthcheck_command)
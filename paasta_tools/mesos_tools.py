@@ -12,21 +12,37 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from collections import deque
+from collections import namedtuple
 import datetime
+import decimal
 import json
+import logging
 import os
 import re
 import requests
 import socket
+import threading
+import time
 
+import concurrent.futures
+from concurrent.futures import ThreadPoolExecutor
 import humanize
-from kazoo.client import KazooClient
+try:
+    # The C backend is an order of magnitude faster than the pure python default
+    import ijson.backends.yajl2_c as ijson
+except ImportError:
+    import ijson
 from mesos.cli.exceptions import SlaveDoesNotExist
 
+from paasta_tools.utils import atomic_file_write
+from paasta_tools.utils import DEFAULT_MESOS_STATE_CACHE_TTL_S
 from paasta_tools.utils import format_table
+from paasta_tools.utils import load_system_paasta_config
 from paasta_tools.utils import PaastaColors
-from paasta_tools.utils import timeout
+from paasta_tools.utils import PaastaNotConfiguredError
 from paasta_tools.utils import TimeoutError
+from paasta_tools.zookeeper_tools import get_zookeeper_client
 
 
 # mesos.cli.master reads its config file at *import* time, so we must have
@@ -58,8 +74,62 @@ mesos.cli.log.fatal = lambda msg, code = 1: raise_cli_exception(msg)
 MY_HOSTNAME = socket.getfqdn()
 MESOS_MASTER_PORT = 5050
 MESOS_SLAVE_PORT = '5051'
+MESOS_STATE_CACHE_PATH = '/var/cache/paasta/mesos_state.json'
+TASK_STATS_TIMEOUT_S = 10
+DEFAULT_MAX_NON_RUNNING_TASKS = 10
 from mesos.cli import master
 
+log = logging.getLogger('__main__')
+
+# The parts of a mesos master's state.json that paasta reads, for parse_json_fields.
+MESOS_MASTER_STATE_FIELDS = {
+    'elected_time': True,
+    'flags': True,
+    'slaves': [{
+        'id': True,
+        'hostname': True,
+        'attributes': True,
+        'resources': True,
+    }],
+    'frameworks': [{
+        'id': True,
+        'name': True,
+        'active': True,
+        'tasks': [{
+            'id': True,
+            'name': True,
+            'framework_id': True,
+            'slave_id': True,
+            'state': True,
+            'resources': True,
+        }],
+    }],
+}
+# The parts of a mesos slave's state.json that paasta reads, for parse_json_fields.
+MESOS_SLAVE_STATE_FIELDS = {
+    'frameworks': [{
+        'name': True,
+        'executors': [{
+            'id': True,
+            'resources': True,
+            'tasks': [{
+                'state': True,
+            }],
+        }],
+    }],
+}
+# The parts of a mesos slave's state.json needed to find the executor of each of its running tasks.
+MESOS_SLAVE_EXECUTOR_FIELDS = {
+    'frameworks': [{
+        'executors': [{
+            'id': True,
+            'tasks': [{
+                'id': True,
+            }],
+        }],
+    }],
+}
+
 
 class MesosMasterConnectionError(Exception):
     pass
@@ -131,6 +201,67 @@ def get_non_running_tasks_from_active_frameworks(job_id):
     return not_running_tasks
 
 
+# The tasks of a job, split by state. non_running only holds the most recent
+# non-running tasks, newest first.
+MesosTasks = namedtuple('MesosTasks', ['running', 'non_running'])
+
+
+def split_tasks_by_state(tasks, max_non_running_tasks=DEFAULT_MAX_NON_RUNNING_TASKS):
+    """Splits tasks into running and non-running ones in a single pass, only ever
+    holding on to the last max_non_running_tasks of the non-running ones.
+
+    :param tasks: An iterable of mesos.cli.Task, oldest first
+    :param max_non_running_tasks: How many non-running tasks to keep, or None to keep them all
+    :returns: A MesosTasks"""
+    running = []
+    non_running = deque(maxlen=max_non_running_tasks)
+    for task in tasks:
+        if task['state'] == 'TASK_RUNNING':
+            running.append(task)
+        else:
+            non_running.append(task)
+    return MesosTasks(running=running, non_running=list(reversed(non_running)))
+
+
+class MesosTaskQuery(object):
+    """Fetches the tasks of each job id from the mesos master at most once.
+
+    Tasks are matched on their ids containing the job id, so the tasks of a more
+    specific job id (like a marathon app id) are picked out of an earlier fetch of
+    a less specific one (like its service.instance) rather than fetched again.
+    Every non-running task of a fetch is kept for this, and max_non_running_tasks
+    is applied to each job id's tasks as they are returned."""
+
+    def __init__(self, max_non_running_tasks=DEFAULT_MAX_NON_RUNNING_TASKS):
+        self.max_non_running_tasks = max_non_running_tasks
+        self._tasks_by_job_id = {}
+
+    def _get_all_tasks(self, job_id):
+        if job_id not in self._tasks_by_job_id:
+            for fetched_job_id, fetched_tasks in self._tasks_by_job_id.items():
+                if fetched_job_id in job_id:
+                    tasks = MesosTasks(
+                        running=[task for task in fetched_tasks.running if job_id in task['id']],
+                        non_running=[task for task in fetched_tasks.non_running if job_id in task['id']],
+                    )
+                    break
+            else:
+                tasks = split_tasks_by_state(get_current_tasks(job_id), max_non_running_tasks=None)
+            self._tasks_by_job_id[job_id] = tasks
+        return self._tasks_by_job_id[job_id]
+
+    def get_tasks(self, job_id):
+        """Returns the MesosTasks of job_id"""
+        tasks = self._get_all_tasks(job_id)
+        return MesosTasks(running=tasks.running, non_running=tasks.non_running[:self.max_non_running_tasks])
+
+    def get_running_tasks(self, job_id):
+        return self.get_tasks(job_id).running
+
+    def get_non_running_tasks(self, job_id):
+        return self.get_tasks(job_id).non_running
+
+
 def get_short_hostname_from_task(task):
     try:
         slave_hostname = task.slave['hostname']
@@ -152,27 +283,110 @@ def get_first_status_timestamp(task):
         return "Unknown"
 
 
-@timeout()
-def get_mem_usage(task):
+def _get_executor_ids_by_task_id(slave, timeout_s):
+    """Maps the id of each task on a slave to the id of the executor running it."""
+    response = slave.fetch('/slave(1)/state.json', timeout=timeout_s, stream=True)
+    response.raise_for_status()
+    response.raw.decode_content = True
+    state = parse_json_fields(response.raw, MESOS_SLAVE_EXECUTOR_FIELDS)
+    executor_ids_by_task_id = {}
+    for framework in state.get('frameworks', []):
+        for executor in framework.get('executors', []):
+            for task in executor.get('tasks', []):
+                executor_ids_by_task_id[task['id']] = executor['id']
+    return executor_ids_by_task_id
+
+
+def get_task_stats_from_slave(slave, task_ids, deadline):
+    """Gets the statistics of some tasks running on one slave, using a single
+    request to its monitor/statistics endpoint.
+
+    :param slave: The mesos.cli.slave.MesosSlave the tasks are running on
+    :param task_ids: The ids of the tasks to get statistics for
+    :param deadline: The time.time() by which the slave must have answered
+    :returns: A dictionary of task id to the statistics of its executor, which is
+              empty for tasks that have no statistics (yet)"""
     try:
-        task_mem_limit = task.mem_limit
-        task_rss = task.rss
-        if task_mem_limit == 0:
-            return "Undef"
-        mem_percent = task_rss / task_mem_limit * 100
-        mem_string = "%d/%dMB" % ((task_rss / 1024 / 1024), (task_mem_limit / 1024 / 1024))
-        if mem_percent > 90:
-            return PaastaColors.red(mem_string)
-        else:
-            return mem_string
-    except (AttributeError, SlaveDoesNotExist):
-        return "None"
-    except TimeoutError:
+        executor_ids_by_task_id = _get_executor_ids_by_task_id(slave, max(0, deadline - time.time()))
+        response = slave.fetch('/monitor/statistics.json', timeout=max(0, deadline - time.time()))
+        response.raise_for_status()
+    except requests.exceptions.Timeout:
+        raise TimeoutError("%s did not answer in time" % slave['hostname'])
+    stats_by_executor_id = dict((stats['executor_id'], stats['statistics']) for stats in response.json())
+    return dict(
+        (task_id, stats_by_executor_id.get(executor_ids_by_task_id.get(task_id), {}))
+        for task_id in task_ids
+    )
+
+
+def get_running_task_stats(tasks, timeout_s=TASK_STATS_TIMEOUT_S):
+    """Gets the statistics of running tasks, querying each slave they run on
+    once and all of the slaves at the same time.
+
+    Everything must be done within timeout_s; a slave that hasn't answered by
+    then is left running in the background and its tasks are reported as timed out.
+
+    :param tasks: A list of mesos.cli.Task
+    :param timeout_s: How long to wait for all of the slaves to answer
+    :returns: A dictionary of task id to either the statistics of the task, or
+              the TimeoutError or SlaveDoesNotExist that prevented us from getting them"""
+    deadline = time.time() + timeout_s
+    task_stats = {}
+    task_ids_by_slave_id = {}
+    slaves_by_id = {}
+    for task in tasks:
+        # Look the slaves up here rather than in the workers, as mesos.cli
+        # caches the master state without any locking.
+        try:
+            slaves_by_id[task['slave_id']] = task.slave
+        except SlaveDoesNotExist as e:
+            task_stats[task['id']] = e
+            continue
+        task_ids_by_slave_id.setdefault(task['slave_id'], []).append(task['id'])
+    if not task_ids_by_slave_id:
+        return task_stats
+
+    executor = ThreadPoolExecutor(max_workers=len(task_ids_by_slave_id))
+    futures = dict(
+        (executor.submit(get_task_stats_from_slave, slaves_by_id[slave_id], task_ids, deadline), task_ids)
+        for slave_id, task_ids in task_ids_by_slave_id.items()
+    )
+    done, not_done = concurrent.futures.wait(futures, timeout=max(0, deadline - time.time()))
+    executor.shutdown(wait=False)
+
+    for future in done:
+        try:
+            task_stats.update(future.result())
+        except (TimeoutError, SlaveDoesNotExist) as e:
+            task_stats.update((task_id, e) for task_id in futures[future])
+        except requests.exceptions.RequestException as e:
+            task_stats.update((task_id, SlaveDoesNotExist(str(e))) for task_id in futures[future])
+    for future in not_done:
+        task_stats.update((task_id, TimeoutError()) for task_id in futures[future])
+    return task_stats
+
+
+def get_mem_usage(task_stats):
+    """Formats the memory a task is using out of the memory it was allocated.
+
+    :param task_stats: The task's entry in the result of get_running_task_stats"""
+    if isinstance(task_stats, TimeoutError):
         return "Timed Out"
+    if task_stats is None or isinstance(task_stats, SlaveDoesNotExist):
+        return "None"
+    task_mem_limit = task_stats.get('mem_limit_bytes', 0)
+    task_rss = task_stats.get('mem_rss_bytes', 0)
+    if task_mem_limit == 0:
+        return "Undef"
+    mem_percent = task_rss / task_mem_limit * 100
+    mem_string = "%d/%dMB" % ((task_rss / 1024 / 1024), (task_mem_limit / 1024 / 1024))
+    if mem_percent > 90:
+        return PaastaColors.red(mem_string)
+    else:
+        return mem_string
 
 
-@timeout()
-def get_cpu_usage(task):
+def get_cpu_usage(task, task_stats):
     """Calculates a metric of used_cpu/allocated_cpu
     To do this, we take the total number of cpu-seconds the task has consumed,
     (the sum of system and user time), OVER the total cpu time the task
@@ -181,38 +395,42 @@ def get_cpu_usage(task):
     The total time a task has been allocated is the total time the task has
     been running (https://github.com/mesosphere/mesos/blob/0b092b1b0/src/webui/master/static/js/controllers.js#L140)
     multiplied by the "shares" a task has.
+
+    :param task: A mesos.cli.Task
+    :param task_stats: The task's entry in the result of get_running_task_stats
     """
-    try:
-        start_time = round(task['statuses'][0]['timestamp'])
-        current_time = int(datetime.datetime.now().strftime('%s'))
-        duration_seconds = current_time - start_time
-        # The CPU shares has an additional .1 allocated to it for executor overhead.
-        # We subtract this to the true number
-        # (https://github.com/apache/mesos/blob/dc7c4b6d0bcf778cc0cad57bb108564be734143a/src/slave/constants.hpp#L100)
-        cpu_shares = task.cpu_limit - .1
-        allocated_seconds = duration_seconds * cpu_shares
-        used_seconds = task.stats.get('cpus_system_time_secs', 0.0) + task.stats.get('cpus_user_time_secs', 0.0)
-        if allocated_seconds == 0:
-            return "Undef"
-        percent = round(100 * (used_seconds / allocated_seconds), 1)
-        percent_string = "%s%%" % percent
-        if percent > 90:
-            return PaastaColors.red(percent_string)
-        else:
-            return percent_string
-    except (AttributeError, SlaveDoesNotExist):
-        return "None"
-    except TimeoutError:
+    if isinstance(task_stats, TimeoutError):
         return "Timed Out"
+    if task_stats is None or isinstance(task_stats, SlaveDoesNotExist):
+        return "None"
+    start_time = round(task['statuses'][0]['timestamp'])
+    current_time = int(datetime.datetime.now().strftime('%s'))
+    duration_seconds = current_time - start_time
+    # The CPU shares has an additional .1 allocated to it for executor overhead.
+    # We subtract this to the true number
+    # (https://github.com/apache/mesos/blob/dc7c4b6d0bcf778cc0cad57bb108564be734143a/src/slave/constants.hpp#L100)
+    cpu_shares = task_stats.get('cpus_limit', 0) - .1
+    allocated_seconds = duration_seconds * cpu_shares
+    used_seconds = task_stats.get('cpus_system_time_secs', 0.0) + task_stats.get('cpus_user_time_secs', 0.0)
+    if allocated_seconds == 0:
+        return "Undef"
+    percent = round(100 * (used_seconds / allocated_seconds), 1)
+    percent_string = "%s%%" % percent
+    if percent > 90:
+        return PaastaColors.red(percent_string)
+    else:
+        return percent_string
 
 
-def format_running_mesos_task_row(task, get_short_task_id):
-    """Returns a pretty formatted string of a running mesos task attributes"""
+def format_running_mesos_task_row(task, get_short_task_id, task_stats=None):
+    """Returns a pretty formatted string of a running mesos task attributes
+
+    :param task_stats: The task's entry in the result of get_running_task_stats"""
     return (
         get_short_task_id(task['id']),
         get_short_hostname_from_task(task),
-        get_mem_usage(task),
-        get_cpu_usage(task),
+        get_mem_usage(task_stats),
+        get_cpu_usage(task, task_stats),
         get_first_status_timestamp(task),
     )
 
@@ -227,16 +445,19 @@ def format_non_running_mesos_task_row(task, get_short_task_id):
     )
 
 
-def status_mesos_tasks_verbose(job_id, get_short_task_id):
+def status_mesos_tasks_verbose(job_id, get_short_task_id, task_query=None):
     """Returns detailed information about the mesos tasks for a service.
 
     :param job_id: An id used for looking up Mesos tasks
     :param get_short_task_id: A function which given a
                               task_id returns a short task_id suitable for
                               printing.
+    :param task_query: A MesosTaskQuery shared with the rest of the command, if any
     """
+    if task_query is None:
+        task_query = MesosTaskQuery()
     output = []
-    running_and_active_tasks = get_running_tasks_from_active_frameworks(job_id)
+    running_and_active_tasks = task_query.get_running_tasks(job_id)
     output.append("  Running Tasks:")
     rows_running = [[
         "Mesos Task ID",
@@ -245,11 +466,12 @@ def status_mesos_tasks_verbose(job_id, get_short_task_id):
         "CPU",
         "Deployed at what localtime"
     ]]
+    task_stats = get_running_task_stats(running_and_active_tasks)
     for task in running_and_active_tasks:
-        rows_running.append(format_running_mesos_task_row(task, get_short_task_id))
+        rows_running.append(format_running_mesos_task_row(task, get_short_task_id, task_stats.get(task['id'])))
     output.extend(["    %s" % row for row in format_table(rows_running)])
 
-    non_running_tasks = reversed(get_non_running_tasks_from_active_frameworks(job_id)[-10:])
+    non_running_tasks = task_query.get_non_running_tasks(job_id)
     output.append(PaastaColors.grey("  Non-Running Tasks"))
     rows_non_running = [[
         PaastaColors.grey("Mesos Task ID"),
@@ -271,12 +493,66 @@ def get_mesos_stats():
     return response.json()
 
 
+def _skip_json_value(events, event):
+    """Consume the events of a value that parse_json_fields doesn't keep."""
+    if event not in ('start_map', 'start_array'):
+        return
+    depth = 1
+    for _, event, _ in events:
+        if event in ('start_map', 'start_array'):
+            depth += 1
+        elif event in ('end_map', 'end_array'):
+            depth -= 1
+            if depth == 0:
+                return
+
+
+def _build_json_value(events, event, value, fields):
+    if event == 'start_map':
+        result = {}
+        for _, event, key in events:
+            if event == 'end_map':
+                return result
+            _, event, value = next(events)
+            key_fields = True if fields is True else fields.get(key) if isinstance(fields, dict) else None
+            if key_fields is None:
+                _skip_json_value(events, event)
+            else:
+                result[key] = _build_json_value(events, event, value, key_fields)
+    elif event == 'start_array':
+        result = []
+        item_fields = fields[0] if isinstance(fields, list) else True
+        for _, event, value in events:
+            if event == 'end_array':
+                return result
+            result.append(_build_json_value(events, event, value, item_fields))
+    elif isinstance(value, decimal.Decimal):
+        return float(value)
+    else:
+        return value
+
+
+def parse_json_fields(fileobj, fields):
+    """Incrementally parse a JSON document, only materializing the parts of it selected by fields,
+    so that the whole document is never in memory at once.
+
+    :param fileobj: A file-like object to read the document from
+    :param fields: True to keep a whole value. For an object, a dictionary of the keys to keep,
+                   each mapped to the fields to keep of its value. For an array, a list of a
+                   single element: the fields to keep of each of its items.
+    :returns: The selected parts of the document, as json.load would have returned them
+    """
+    events = iter(ijson.parse(fileobj))
+    _, event, value = next(events)
+    return _build_json_value(events, event, value, fields)
+
+
 def get_local_slave_state():
-    """Fetches mesos slave state.json and returns it as a dict."""
+    """Fetches mesos slave state.json and returns the parts of it in MESOS_SLAVE_STATE_FIELDS as a dict."""
     hostname = socket.getfqdn()
     stats_uri = 'http://%s:%s/state.json' % (hostname, MESOS_SLAVE_PORT)
     try:
-        response = requests.get(stats_uri, timeout=10)
+        response = requests.get(stats_uri, timeout=10, stream=True)
     except requests.ConnectionError as e:
         raise MesosSlaveConnectionError(
             'Could not connect to the mesos slave to see which services are running\n'
@@ -284,20 +560,107 @@ def get_local_slave_state():
             'Error was: %s\n' % (e.request.url, e.message)
         )
     response.raise_for_status()
-    return json.loads(response.text)
+    response.raw.decode_content = True
+    return parse_json_fields(response.raw, MESOS_SLAVE_STATE_FIELDS)
 
 
 def get_mesos_state_from_leader():
-    """Fetches mesos state from the leader.
+    """Fetches mesos state from the leader, keeping only the parts of it in MESOS_MASTER_STATE_FIELDS.
     Raises an exception if the state doesn't look like it came from an
     elected leader, as we never want non-leader state data."""
-    state = master.CURRENT.state
+    response = master.CURRENT.fetch('/master/state.json', stream=True)
+    response.raise_for_status()
+    response.raw.decode_content = True
+    state = parse_json_fields(response.raw, MESOS_MASTER_STATE_FIELDS)
     if 'elected_time' not in state:
         raise MasterNotAvailableException("We asked for the current leader state, "
                                           "but it wasn't the elected leader. Please try again.")
     return state
 
 
+def get_mesos_state_cache_ttl():
+    """Returns the mesos_state_cache_ttl_s from the system paasta config, or the default
+    if this host has no paasta config."""
+    try:
+        return load_system_paasta_config().get_mesos_state_cache_ttl()
+    except PaastaNotConfiguredError:
+        return DEFAULT_MESOS_STATE_CACHE_TTL_S
+
+
+def get_slaves_by_attribute(slaves):
+    """Index mesos slaves by every one of their attributes.
+
+    :param slaves: The 'slaves' list of a mesos state
+    :returns: a dictionary of the form {'<attribute>': {'<attribute_value>': [<list of hosts>]}}
+    """
+    slaves_by_attribute = {}
+    for slave in slaves:
+        for attribute, value in slave['attributes'].iteritems():
+            slaves_by_attribute.setdefault(attribute, {}).setdefault(value, []).append(slave['hostname'])
+    return slaves_by_attribute
+
+
+def read_mesos_state_cache(path=MESOS_STATE_CACHE_PATH):
+    """Returns the cache written by write_mesos_state_cache, or None if it can't be read."""
+    try:
+        with open(path) as f:
+            cache = json.load(f)
+        # json turns every key into a string, and an attribute can be a number,
+        # so the index of the slaves' attributes is built again from the slaves.
+        cache['slaves_by_attribute'] = get_slaves_by_attribute(cache['state']['slaves'])
+        return cache
+    except (IOError, ValueError, KeyError, TypeError):
+        return None
+
+
+def write_mesos_state_cache(cache, path=MESOS_STATE_CACHE_PATH):
+    """Write the cache so that other processes can use it. Failing to write it is not fatal.
+    Its slaves_by_attribute is left out, as read_mesos_state_cache builds it again."""
+    try:
+        with atomic_file_write(path) as f:
+            json.dump({'timestamp': cache['timestamp'], 'state': cache['state']}, f)
+    except (IOError, OSError) as e:
+        log.warning("Could not write the mesos state cache to %s: %s" % (path, e))
+
+
+# The last cache read or written by this process, so it isn't re-read for every call
+_mesos_state_cache = None
+_mesos_state_cache_lock = threading.Lock()
+
+
+def get_mesos_state_cache(ttl=None, path=MESOS_STATE_CACHE_PATH):
+    """Get the mesos state from the leader, or a copy of it fetched less than ttl seconds ago by
+    this or any other process on this host.
+
+    :param ttl: How old, in seconds, the cached state may be. Defaults to get_mesos_state_cache_ttl()
+    :param path: The file to share the cache through
+    :returns: A dictionary of the form {'timestamp': <time the state was fetched>, 'state': <mesos state>,
+              'slaves_by_attribute': <the state's slaves, indexed by get_slaves_by_attribute>}
+    """
+    global _mesos_state_cache
+    if ttl is None:
+        ttl = get_mesos_state_cache_ttl()
+
+    def is_fresh(cache):
+        return cache is not None and 0 <= time.time() - cache['timestamp'] < ttl
+
+    with _mesos_state_cache_lock:
+        if is_fresh(_mesos_state_cache):
+            return _mesos_state_cache
+        cache = read_mesos_state_cache(path)
+        if not is_fresh(cache):
+            timestamp = time.time()
+            state = get_mesos_state_from_leader()
+            cache = {
+                'timestamp': timestamp,
+                'state': state,
+                'slaves_by_attribute': get_slaves_by_attribute(state['slaves']),
+            }
+            write_mesos_state_cache(cache, path)
+        _mesos_state_cache = cache
+        return cache
+
+
 def get_mesos_quorum(state):
     """Returns the configured quorum size.
     :param state: mesos state dictionary"""
@@ -317,27 +680,32 @@ def get_number_of_mesos_masters(zk_config):
     Masters register themselves in zookeeper by creating ``info_`` entries.
     We count these entries to get the number of masters.
     """
-    zk = KazooClient(hosts=zk_config['hosts'], read_only=True)
-    zk.start()
+    zk = get_zookeeper_client(zk_config['hosts'], read_only=True)
     root_entries = zk.get_children(zk_config['path'])
     result = [info for info in root_entries if info.startswith('info_')]
-    zk.stop()
     return len(result)
 
 
-def get_mesos_slaves_grouped_by_attribute(attribute, blacklist=None):
+def get_mesos_slaves_grouped_by_attribute(attribute, blacklist=None, slaves=None):
     """Returns a dictionary of unique values and the corresponding hosts for a given Mesos attribute
 
     :param attribute: an attribute to filter
     :param blacklist: a list of [attribute, value] lists to exclude from the output list
+    :param slaves: the 'slaves' list of a mesos state to group. If None, the state comes from
+                   get_mesos_state_cache.
     :returns: a dictionary of the form {'<attribute_value>': [<list of hosts with attribute=attribute_value>]}
               (response can contain multiple 'attribute_value)
     """
     if blacklist is None:
         blacklist = []
     attr_map = {}
-    mesos_state = get_mesos_state_from_leader()
-    slaves = mesos_state['slaves']
+    if slaves is None:
+        cache = get_mesos_state_cache()
+        slaves = cache['state']['slaves']
+        if not blacklist and slaves != []:
+            return dict(
+                (attr_val, list(hosts)) for attr_val, hosts in cache['slaves_by_attribute'].get(attribute, {}).items()
+            )
     filtered_slaves = filter_mesos_slaves_by_blacklist(slaves=slaves, blacklist=blacklist)
     if filtered_slaves == []:
         raise NoSlavesAvailable("No mesos slaves were available to query. Try again later")
@@ -14,8 +14,21 @@
 
 import collections
 import socket
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
 from paasta_tools.smartstack_tools import get_multiple_backends
 
+# How long a resolved hostname is remembered for
+DNS_CACHE_TTL_S = 300
+# How many hostnames resolve_hostnames looks up at the same time
+DEFAULT_RESOLVE_JOBS = 16
+
+_dns_cache = {}
+_dns_cache_lock = threading.Lock()
+
 
 def get_replication_for_services(synapse_host, synapse_port, services):
     """Returns the replication level for the provided services
@@ -43,6 +56,24 @@ def get_replication_for_services(synapse_host, synapse_port, services):
     return dict((sn, counter[sn]) for sn in services)
 
 
+def get_replication_for_all_services(synapse_host, synapse_port):
+    """Returns the replication level of every service in the haproxy of one synapse host,
+    downloading its haproxy CSV only once.
+
+    :param synapse_host: The host that this check should contact for replication information.
+    :param synapse_port: The port number that this check should contact for replication information.
+
+    :returns available_instance_counts: A collections.Counter mapping every service name
+                                        to an integer number of available replicas
+    """
+    backends = get_multiple_backends(
+        services=None,
+        synapse_host=synapse_host,
+        synapse_port=synapse_port,
+    )
+    return collections.Counter([b['pxname'] for b in backends if backend_is_up(b)])
+
+
 def backend_is_up(backend):
     """Returns whether a server is receiving traffic in HAProxy.
 
@@ -79,13 +110,59 @@ def get_registered_marathon_tasks(
     """
     backends = get_multiple_backends([service], synapse_host=synapse_host, synapse_port=synapse_port)
     healthy_tasks = []
-    for backend, task in match_backends_and_tasks(backends, marathon_tasks):
+    for backend, task in match_backends_and_tasks(backends, marathon_tasks, pre_resolve=True):
         if backend is not None and task is not None and backend['status'].startswith('UP'):
             healthy_tasks.append(task)
     return healthy_tasks
 
 
-def match_backends_and_tasks(backends, tasks):
+def gethostbyname(hostname, ttl=DNS_CACHE_TTL_S):
+    """Like socket.gethostbyname, but remembers each answer for ttl seconds,
+    across every caller in this process.
+
+    :param hostname: The hostname to resolve
+    :param ttl: How many seconds an earlier answer may be reused for
+    :returns ip: The IPv4 address of hostname, as a string
+    """
+    with _dns_cache_lock:
+        cached = _dns_cache.get(hostname)
+    if cached is not None and time.time() - cached[0] < ttl:
+        return cached[1]
+    timestamp = time.time()
+    ip = socket.gethostbyname(hostname)
+    with _dns_cache_lock:
+        _dns_cache[hostname] = (timestamp, ip)
+    return ip
+
+
+def resolve_hostnames(hostnames, jobs=DEFAULT_RESOLVE_JOBS):
+    """Resolves the unique hostnames that aren't in the cache yet, jobs at a time,
+    so that the gethostbyname calls that follow are answered from the cache.
+    Hostnames that fail to resolve are left out, to fail when they are next looked up.
+
+    :param hostnames: An iterable of hostnames
+    :param jobs: How many hostnames to resolve at the same time
+    """
+    now = time.time()
+    with _dns_cache_lock:
+        unresolved = set(
+            hostname for hostname in hostnames
+            if hostname not in _dns_cache or now - _dns_cache[hostname][0] >= DNS_CACHE_TTL_S
+        )
+    if not unresolved:
+        return
+    executor = ThreadPoolExecutor(max_workers=min(jobs, len(unresolved)))
+    try:
+        for future in [executor.submit(gethostbyname, hostname) for hostname in unresolved]:
+            try:
+                future.result()
+            except socket.error:
+                pass
+    finally:
+        executor.shutdown(wait=True)
+
+
+def match_backends_and_tasks(backends, tasks, pre_resolve=False):
     """Returns tuples of matching (backend, task) pairs, as matched by IP and port. Each backend will be listed exactly
     once, and each task will be listed once per port. If a backend does not match with a task, (backend, None) will
     be included. If a task's port does not match with any backends, (None, task) will be included.
@@ -93,7 +170,13 @@ def match_backends_and_tasks(backends, tasks):
     :param backends: An iterable of haproxy backend dictionaries, e.g. the list returned by
                      smartstack_tools.get_multiple_backends.
     :param tasks: An iterable of MarathonTask objects.
+    :param pre_resolve: Whether to resolve all of the tasks' hosts concurrently before matching,
+                        rather than one by one.
     """
+    if pre_resolve:
+        tasks = list(tasks)
+        resolve_hostnames(task.host for task in tasks)
+
     backends_by_ip_port = collections.defaultdict(list)  # { (ip, port) : [backend1, backend2], ... }
     backend_task_pairs = []
 
@@ -102,7 +185,7 @@ def match_backends_and_tasks(backends, tasks):
         backends_by_ip_port[ip, port].append(backend)
 
     for task in tasks:
-        ip = socket.gethostbyname(task.host)
+        ip = gethostbyname(task.host)
         for port in task.ports:
             for backend in backends_by_ip_port.pop((ip, port), [None]):
                 backend_task_pairs.append((backend, task))
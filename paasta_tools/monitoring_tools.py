@@ -23,12 +23,13 @@ Everything in here is private, and you shouldn't worry about it.
 """
 import json
 import logging
-import os
 
 import service_configuration_lib
 import pysensu_yelp
 
 from utils import load_system_paasta_config
+from utils import read_extra_service_information
+from utils import read_service_configuration
 
 
 log = logging.getLogger('__main__')
@@ -83,7 +84,7 @@ def get_project(overrides, service, soa_dir=service_configuration_lib.DEFAULT_SO
 
 
 def __get_monitoring_config_value(key, overrides, service, soa_dir=service_configuration_lib.DEFAULT_SOA_DIR):
-    general_config = service_configuration_lib.read_service_configuration(service, soa_dir=soa_dir)
+    general_config = read_service_configuration(service, soa_dir=soa_dir)
     monitor_config = read_monitoring_config(service, soa_dir=soa_dir)
     service_default = general_config.get(key, monitoring_defaults(key))
     service_default = general_config.get('monitoring', {key: service_default}).get(key, service_default)
@@ -185,7 +186,4 @@ def read_monitoring_config(service, soa_dir=service_configuration_lib.DEFAULT_SO
     :param service: The service name
     :param soa_dir: THe SOA configuration directory to read from
     :returns: A dictionary of whatever was in soa_dir/name/monitoring.yaml"""
-    rootdir = os.path.abspath(soa_dir)
-    monitoring_file = os.path.join(rootdir, service, "monitoring.yaml")
-    monitor_conf = service_configuration_lib.read_monitoring(monitoring_file)
-    return monitor_conf
+    return read_extra_service_information(service, 'monitoring', soa_dir=soa_dir)
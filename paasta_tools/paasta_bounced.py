@@ -0,0 +1,451 @@
+#!/usr/bin/env python
+# Copyright 2015 Yelp Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Usage: ./paasta_bounced.py [options]
+
+A daemon which keeps every marathon service instance in this cluster deployed,
+as deploy_marathon_services does from cron, but which only sets up the instances
+whose inputs changed, seconds after they changed.
+
+It keeps its marathon client, zookeeper session, parsed configuration and the
+caches of bounce_lib, drain_lib and mesos_tools in memory between cycles. The
+system paasta and marathon configuration are reloaded when their files change,
+and every file of the SOA config dir is read through paasta_tools.utils, which
+re-parses it when it changes. It finds out what changed from:
+
+- Marathon's event stream: an event about one of an instance's apps (a task
+  changing state or health, an app being created or removed) marks it dirty
+- The SOA config dir, which is scanned every --soa-scan-interval seconds:
+  a change to any yaml file or deployments.json of a service marks all of its
+  marathon instances dirty
+
+Every cycle takes one snapshot of the apps in Marathon, and sets up each dirty
+instance with setup_marathon_job's setup_service_instance. An instance that is
+in the middle of a bounce (it has more or less than one app) is set up again
+every --bounce-interval seconds until it finishes, since waiting for old tasks
+to drain produces no events. Every instance is set up every --full-sync-interval
+seconds regardless, in case an event was missed.
+
+Instances are only set up while this host is the mesos leader.
+
+Command line options:
+
+- -d <SOA_DIR>, --soa-dir <SOA_DIR>: Specify a SOA config dir to read from
+- -j <JOBS>, --jobs <JOBS>: How many instances to set up at the same time
+- --soa-scan-interval <SECONDS>: How often to look for changes in the SOA config dir
+- --bounce-interval <SECONDS>: How often to set up instances which are being bounced
+- --full-sync-interval <SECONDS>: How often to set up every instance
+- -v, --verbose: Verbose output
+"""
+import argparse
+import json
+import logging
+import os
+import signal
+import threading
+import time
+
+import service_configuration_lib
+
+from paasta_tools import bounce_lib
+from paasta_tools import marathon_tools
+from paasta_tools.mesos_tools import is_mesos_leader
+from paasta_tools.setup_marathon_job import get_main_marathon_config
+from paasta_tools.setup_marathon_jobs import DEFAULT_JOBS
+from paasta_tools.setup_marathon_jobs import setup_service_instances
+from paasta_tools.utils import compose_job_id
+from paasta_tools.utils import configure_log
+from paasta_tools.utils import get_service_instance_list
+from paasta_tools.utils import get_soa_service_signature
+from paasta_tools.utils import get_system_paasta_config_signature
+from paasta_tools.utils import InvalidJobNameError
+from paasta_tools.utils import load_system_paasta_config
+from paasta_tools.zookeeper_tools import get_zookeeper_client
+
+DEFAULT_SOA_SCAN_INTERVAL_S = 5
+DEFAULT_BOUNCE_INTERVAL_S = 10
+DEFAULT_FULL_SYNC_INTERVAL_S = 600
+# Wait this long after waking up, so that a burst of events is handled by one cycle
+MIN_CYCLE_INTERVAL_S = 2
+# Marathon sends nothing on a quiet event stream, so this is how often it is reopened
+EVENT_STREAM_READ_TIMEOUT_S = 60
+EVENT_STREAM_RECONNECT_DELAY_S = 1
+# The marathon events about a single app which can change what setting up its instance does
+APP_EVENT_TYPES = set([
+    'status_update_event',
+    'health_status_changed_event',
+    'failed_health_check_event',
+    'app_terminated_event',
+    'api_post_event',
+])
+
+log = logging.getLogger('__main__')
+logging.basicConfig()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Keeps every marathon instance in the cluster deployed.')
+    parser.add_argument('-d', '--soa-dir', dest="soa_dir", metavar="SOA_DIR",
+                        default=service_configuration_lib.DEFAULT_SOA_DIR,
+                        help="define a different soa config directory")
+    parser.add_argument('-j', '--jobs', dest="jobs", metavar="JOBS", type=int,
+                        default=DEFAULT_JOBS,
+                        help="how many instances to set up at the same time (default %(default)s)")
+    parser.add_argument('--soa-scan-interval', dest="soa_scan_interval", metavar="SECONDS", type=float,
+                        default=DEFAULT_SOA_SCAN_INTERVAL_S,
+                        help="how often to look for changes in the soa config dir (default %(default)s)")
+    parser.add_argument('--bounce-interval', dest="bounce_interval", metavar="SECONDS", type=float,
+                        default=DEFAULT_BOUNCE_INTERVAL_S,
+                        help="how often to set up instances which are being bounced (default %(default)s)")
+    parser.add_argument('--full-sync-interval', dest="full_sync_interval", metavar="SECONDS", type=float,
+                        default=DEFAULT_FULL_SYNC_INTERVAL_S,
+                        help="how often to set up every instance (default %(default)s)")
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        dest="verbose", default=False)
+    args = parser.parse_args()
+    return args
+
+
+def get_app_id_from_event(event_type, data):
+    """Returns the id of the app a marathon event is about, or None if it isn't
+    one of APP_EVENT_TYPES.
+
+    :param event_type: The type of the event
+    :param data: The event's json, as a string"""
+    if event_type not in APP_EVENT_TYPES:
+        return None
+    try:
+        event = json.loads(data)
+    except ValueError:
+        return None
+    if event_type == 'api_post_event':
+        return event.get('appDefinition', {}).get('id')
+    return event.get('appId')
+
+
+def get_service_instance_for_app_id(app_id):
+    """Returns the (service, instance) a marathon app id belongs to, or None
+    if it isn't the id of an app paasta set up."""
+    try:
+        service, instance, _, __ = marathon_tools.deformat_job_id(app_id.lstrip('/'))
+    except InvalidJobNameError:
+        return None
+    return (service, instance)
+
+
+def count_apps_by_service_instance(marathon_snapshot):
+    """Returns a dict of (service, instance) to how many apps it has in a MarathonSnapshot."""
+    counts = {}
+    for app in marathon_snapshot.list_apps():
+        service_instance = get_service_instance_for_app_id(app.id)
+        if service_instance is not None:
+            counts[service_instance] = counts.get(service_instance, 0) + 1
+    return counts
+
+
+class BounceDaemon(object):
+    """What paasta_bounced keeps in memory between cycles: the marathon instances of
+    each service and the signature of the files they were read from, the instances
+    marked dirty since the last cycle, and the instances which are being bounced."""
+
+    def __init__(self, cluster, soa_dir, client, marathon_config, system_paasta_config, zk, jobs,
+                 bounce_interval_s=DEFAULT_BOUNCE_INTERVAL_S, full_sync_interval_s=DEFAULT_FULL_SYNC_INTERVAL_S,
+                 config_signature=None):
+        self.config_signature = config_signature
+        self.cluster = cluster
+        self.soa_dir = soa_dir
+        self.client = client
+        self.marathon_config = marathon_config
+        self.system_paasta_config = system_paasta_config
+        self.zk = zk
+        self.jobs = jobs
+        self.bounce_interval_s = bounce_interval_s
+        self.full_sync_interval_s = full_sync_interval_s
+        self.service_signatures = {}
+        self.instances_by_service = {}
+        self.unsettled = set()
+        self.last_bounce = 0
+        self.last_full_sync = 0
+        self.needs_full_sync = False
+        self.wakeup = threading.Event()
+        self._dirty = set()
+        self._lock = threading.Lock()
+
+    def get_service_instances(self):
+        with self._lock:
+            return set(
+                service_instance
+                for service_instances in self.instances_by_service.values()
+                for service_instance in service_instances
+            )
+
+    def mark_dirty(self, service_instances):
+        """Have the next cycle set up the given (service, instance) tuples."""
+        service_instances = set(service_instances)
+        if not service_instances:
+            return
+        with self._lock:
+            self._dirty.update(service_instances)
+        self.wakeup.set()
+
+    def take_dirty(self):
+        """Returns the instances marked dirty since the last call, and forgets them."""
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+        return dirty
+
+    def mark_app_dirty(self, app_id):
+        """Mark the instance a marathon app belongs to dirty, if it is one of ours."""
+        service_instance = get_service_instance_for_app_id(app_id)
+        if service_instance is None:
+            return
+        with self._lock:
+            known = service_instance in self.instances_by_service.get(service_instance[0], [])
+        if known:
+            self.mark_dirty([service_instance])
+
+    def reload_config(self):
+        """Reload the system paasta and marathon configuration if their files changed since
+        they were loaded, reconnecting to marathon or zookeeper if they moved. The next cycle
+        is a full sync, since the change may affect any instance.
+
+        :returns: Whether the configuration was reloaded"""
+        signature = get_system_paasta_config_signature()
+        if signature == self.config_signature:
+            return False
+        system_paasta_config = load_system_paasta_config()
+        marathon_config = get_main_marathon_config()
+        if (marathon_config.get_url(), marathon_config.get_username(), marathon_config.get_password()) != \
+                (self.marathon_config.get_url(), self.marathon_config.get_username(),
+                 self.marathon_config.get_password()):
+            log.info("Marathon config changed, reconnecting to marathon")
+            self.client = marathon_tools.get_marathon_client(marathon_config.get_url(),
+                                                             marathon_config.get_username(),
+                                                             marathon_config.get_password())
+        if system_paasta_config.get_zk_hosts() != self.system_paasta_config.get_zk_hosts():
+            log.info("Zookeeper hosts changed, reconnecting to zookeeper")
+            self.zk = get_zookeeper_client(system_paasta_config.get_zk_hosts(),
+                                           timeout=bounce_lib.ZK_LOCK_CONNECT_TIMEOUT_S)
+        cluster = system_paasta_config.get_cluster()
+        with self._lock:
+            if cluster != self.cluster:
+                # The marathon instances of every service are read for the cluster, so read them all again
+                self.service_signatures = {}
+            self.cluster = cluster
+            self.system_paasta_config = system_paasta_config
+            self.marathon_config = marathon_config
+            self.config_signature = signature
+        self.needs_full_sync = True
+        return True
+
+    def scan_soa_dir(self):
+        """Re-read the marathon instances of every service whose files changed since the
+        last scan, and mark them dirty. Services which are gone are forgotten.
+
+        :returns: The set of (service, instance) tuples which were marked dirty"""
+        changed = set()
+        services = set(os.listdir(self.soa_dir))
+        for service in services:
+            signature = get_soa_service_signature(service, self.soa_dir)
+            if signature == self.service_signatures.get(service):
+                continue
+            try:
+                service_instances = get_service_instance_list(
+                    service,
+                    cluster=self.cluster,
+                    instance_type='marathon',
+                    soa_dir=self.soa_dir,
+                )
+            except Exception as e:
+                # Its signature isn't recorded, so it is read again on the next scan
+                log.error("Failed to read the marathon instances of %s: %s" % (service, e))
+                continue
+            with self._lock:
+                self.service_signatures[service] = signature
+                self.instances_by_service[service] = service_instances
+            changed.update(service_instances)
+        with self._lock:
+            for service in set(self.service_signatures) - services:
+                del self.service_signatures[service]
+                self.instances_by_service.pop(service, None)
+        self.mark_dirty(changed)
+        return changed
+
+    def watch_marathon_events(self, stop):
+        """Mark the instance of every app marathon sends an event about dirty, until stop
+        is set or marathon turns out not to have an event stream. Meant to run in its own thread."""
+        events = marathon_tools.MarathonEventStream(self.client, read_timeout_s=EVENT_STREAM_READ_TIMEOUT_S)
+        while not stop.is_set():
+            if events.client is not self.client:
+                # reload_config reconnected to marathon
+                events.close()
+                events = marathon_tools.MarathonEventStream(self.client, read_timeout_s=EVENT_STREAM_READ_TIMEOUT_S)
+            for event_type, data in events.iter_events():
+                if stop.is_set():
+                    break
+                app_id = get_app_id_from_event(event_type, data)
+                if app_id is not None:
+                    self.mark_app_dirty(app_id)
+            if not events.is_available():
+                log.warning("Marathon has no event stream, so changes to apps are only noticed every %d seconds" %
+                            self.full_sync_interval_s)
+                break
+            stop.wait(EVENT_STREAM_RECONNECT_DELAY_S)
+        events.close()
+
+    def run_cycle(self, service_instances, fresh):
+        """Set up the given instances, from one snapshot of the apps in Marathon.
+
+        An instance stays unsettled, to be set up again after bounce_interval_s, if it failed
+        or if it didn't have exactly one app before being set up. Instances in fresh were
+        marked dirty because their config or their apps changed, so they are set up once more
+        anyway, to find out whether the change started a bounce.
+
+        :param service_instances: The (service, instance) tuples to set up
+        :param fresh: The ones among them which were marked dirty since the last cycle, which
+                      doesn't include those only set up by a full sync
+        :returns: A list of (service, instance, exit_code) tuples"""
+        marathon_snapshot = marathon_tools.fetch_marathon_snapshot(self.client)
+        app_counts = count_apps_by_service_instance(marathon_snapshot)
+        results = setup_service_instances(
+            service_instances=sorted(service_instances),
+            client=self.client,
+            marathon_config=self.marathon_config,
+            soa_dir=self.soa_dir,
+            jobs=self.jobs,
+            marathon_snapshot=marathon_snapshot,
+            system_paasta_config=self.system_paasta_config,
+            zk=self.zk,
+        )
+        unsettled = set(
+            (service, instance) for service, instance, exit_code in results
+            if exit_code != 0 or (service, instance) in fresh or app_counts.get((service, instance), 0) != 1
+        )
+        self.unsettled = (self.unsettled - set(service_instances)) | unsettled
+        failed = [compose_job_id(service, instance) for service, instance, exit_code in results if exit_code != 0]
+        if failed:
+            log.error("Failed to set up: %s" % ', '.join(failed))
+        return results
+
+    def run_once(self, now=None):
+        """Work out which instances need to be set up, and set them up if this host is
+        the mesos leader. A full sync sets up every instance, every full_sync_interval_s
+        or when needs_full_sync is set.
+
+        :returns: The set of (service, instance) tuples which were set up"""
+        if now is None:
+            now = time.time()
+        full_sync = self.needs_full_sync or now - self.last_full_sync >= self.full_sync_interval_s
+        bounce = bool(self.unsettled) and now - self.last_bounce >= self.bounce_interval_s
+        with self._lock:
+            dirty = bool(self._dirty)
+        if not (full_sync or bounce or dirty):
+            return set()
+        if not is_mesos_leader():
+            log.debug("Not the mesos leader, not setting up any instances")
+            # Whoever is the leader sets them up. If we become the leader, start with a full sync.
+            self.take_dirty()
+            self.needs_full_sync = True
+            return set()
+        fresh = self.take_dirty()
+        service_instances = set(fresh)
+        if full_sync:
+            service_instances |= self.get_service_instances()
+            self.last_full_sync = now
+            self.needs_full_sync = False
+        if bounce:
+            service_instances |= self.unsettled
+            self.last_bounce = now
+        if not service_instances:
+            return set()
+        log.info("Setting up %d instances" % len(service_instances))
+        self.run_cycle(service_instances, fresh)
+        return service_instances
+
+    def run(self, stop, soa_scan_interval_s=DEFAULT_SOA_SCAN_INTERVAL_S):
+        """Run cycles until stop is set."""
+        event_watcher = threading.Thread(target=self.watch_marathon_events, args=(stop,), name='marathon-events')
+        event_watcher.daemon = True
+        event_watcher.start()
+        last_scan = 0
+        while not stop.is_set():
+            now = time.time()
+            if now - last_scan >= soa_scan_interval_s:
+                try:
+                    self.reload_config()
+                    self.scan_soa_dir()
+                    last_scan = now
+                except Exception:
+                    log.exception("Failed to look for changes, retrying in %d seconds" % soa_scan_interval_s)
+            try:
+                self.run_once(now)
+            except Exception:
+                log.exception("Cycle failed, retrying in %d seconds" % soa_scan_interval_s)
+            self.wakeup.wait(soa_scan_interval_s)
+            self.wakeup.clear()
+            stop.wait(MIN_CYCLE_INTERVAL_S)
+
+
+def main():
+    """Keep every marathon service instance in the cluster deployed until SIGTERM or SIGINT.
+
+    - Load the system paasta and marathon configuration, and reload them when they change
+    - Connect to marathon and zookeeper once, unless the configuration moves them
+    - Follow marathon's event stream and the soa config dir, and set up the instances they change"""
+    configure_log()
+    args = parse_args()
+    if args.verbose:
+        log.setLevel(logging.DEBUG)
+    else:
+        log.setLevel(logging.INFO)
+
+    # service_configuration_lib caches every yaml file it reads for the life of the process
+    service_configuration_lib.disable_yaml_cache()
+
+    # Taken before loading, so a change made while loading is picked up by the first reload_config
+    config_signature = get_system_paasta_config_signature()
+    system_paasta_config = load_system_paasta_config()
+    marathon_config = get_main_marathon_config()
+    client = marathon_tools.get_marathon_client(marathon_config.get_url(), marathon_config.get_username(),
+                                                marathon_config.get_password())
+    zk = get_zookeeper_client(system_paasta_config.get_zk_hosts(), timeout=bounce_lib.ZK_LOCK_CONNECT_TIMEOUT_S)
+    daemon = BounceDaemon(
+        cluster=system_paasta_config.get_cluster(),
+        soa_dir=args.soa_dir,
+        client=client,
+        marathon_config=marathon_config,
+        system_paasta_config=system_paasta_config,
+        zk=zk,
+        jobs=args.jobs,
+        bounce_interval_s=args.bounce_interval,
+        full_sync_interval_s=args.full_sync_interval,
+        config_signature=config_signature,
+    )
+
+    stop = threading.Event()
+
+    def handle_signal(signum, frame):
+        log.info("Got signal %d, stopping after the current cycle" % signum)
+        stop.set()
+        daemon.wakeup.set()
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
+
+    daemon.run(stop, soa_scan_interval_s=args.soa_scan_interval)
+
+
+if __name__ == "__main__":
+    main()
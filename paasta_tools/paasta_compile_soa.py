@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# Copyright 2015 Yelp Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Usage: ./paasta_compile_soa.py [options]
+
+Parses every yaml file and deployments.json in the SOA config dir once and
+writes the result to a single snapshot file. Scripts reading the SOA configs
+through paasta_tools.utils use the snapshot for any file which hasn't changed
+since it was compiled, instead of parsing the file again.
+
+Run it whenever the SOA config dir is updated.
+
+Command line options:
+
+- -d <SOA_DIR>, --soa-dir <SOA_DIR>: Specify a SOA config dir to read from
+- -o <PATH>, --output <PATH>: Where to write the snapshot
+- -v, --verbose: Verbose output
+"""
+import argparse
+import logging
+import sys
+
+import service_configuration_lib
+
+from paasta_tools.utils import compile_soa_snapshot
+from paasta_tools.utils import DEFAULT_SOA_SNAPSHOT_PATH
+from paasta_tools.utils import write_soa_snapshot
+
+log = logging.getLogger('__main__')
+logging.basicConfig()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Compiles the SOA config dir into a snapshot file.')
+    parser.add_argument('-d', '--soa-dir', dest="soa_dir", metavar="SOA_DIR",
+                        default=service_configuration_lib.DEFAULT_SOA_DIR,
+                        help="define a different soa config directory")
+    parser.add_argument('-o', '--output', dest="output", metavar="PATH",
+                        default=DEFAULT_SOA_SNAPSHOT_PATH,
+                        help="where to write the snapshot (default %(default)s)")
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        dest="verbose", default=False)
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = parse_args()
+    if args.verbose:
+        log.setLevel(logging.DEBUG)
+    else:
+        log.setLevel(logging.WARNING)
+
+    snapshot = compile_soa_snapshot(args.soa_dir)
+    write_soa_snapshot(snapshot, args.output)
+    log.info("Wrote a snapshot of %d files in %s to %s", len(snapshot['files']), args.soa_dir, args.output)
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
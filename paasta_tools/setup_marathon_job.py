@@ -40,8 +40,11 @@ Command line options:
 
 - -d <SOA_DIR>, --soa-dir <SOA_DIR>: Specify a SOA config dir to read from
 - -v, --verbose: Verbose output
+- --marathon-snapshot <PATH>: Read the existing marathon apps from a snapshot
+  written by write_marathon_snapshot instead of listing them from marathon
 """
 import argparse
+import functools
 import logging
 import pysensu_yelp
 import service_configuration_lib
@@ -70,6 +73,9 @@ from paasta_tools.utils import SPACER
 log = logging.getLogger('__main__')
 logging.basicConfig()
 
+# Older docs put these bounce_health_params under bounce_method_params, where they never had any effect
+LEGACY_BOUNCE_METHOD_PARAMS = ('check_haproxy', 'min_task_uptime')
+
 
 def parse_args():
     parser = argparse.ArgumentParser(description='Creates marathon jobs.')
@@ -81,11 +87,14 @@ def parse_args():
                         help="define a different soa config directory")
     parser.add_argument('-v', '--verbose', action='store_true',
                         dest="verbose", default=False)
+    parser.add_argument('--marathon-snapshot', dest="marathon_snapshot", metavar="PATH",
+                        default=None,
+                        help="read existing marathon apps from a snapshot file instead of from marathon")
     args = parser.parse_args()
     return args
 
 
-def send_event(name, instance, soa_dir, status, output):
+def send_event(name, instance, soa_dir, status, output, cluster=None):
     """Send an event to sensu via pysensu_yelp with the given information.
 
     :param name: The service name the event is about
@@ -93,8 +102,10 @@ def send_event(name, instance, soa_dir, status, output):
     :param soa_dir: The service directory to read monitoring information from
     :param status: The status to emit for this event
     :param output: The output to emit for this event
+    :param cluster: The cluster the instance runs in. Defaults to the local cluster.
     """
-    cluster = load_system_paasta_config().get_cluster()
+    if cluster is None:
+        cluster = load_system_paasta_config().get_cluster()
     monitoring_overrides = marathon_tools.load_marathon_service_config(
         name,
         instance,
@@ -156,6 +167,21 @@ def get_main_marathon_config():
     return marathon_config
 
 
+def get_marathon_snapshot(path):
+    """Load the marathon snapshot at path, or return None if it is unusable,
+    in which case the caller should ask marathon directly."""
+    try:
+        snapshot = marathon_tools.load_marathon_snapshot(path)
+    except marathon_tools.MarathonSnapshotNotAvailable as e:
+        log.warning("%s. Falling back to listing apps from marathon.", e)
+        return None
+    if snapshot.is_stale():
+        log.warning("Marathon snapshot %s is %d seconds old. Falling back to listing apps from marathon.",
+                    path, snapshot.get_age())
+        return None
+    return snapshot
+
+
 def do_bounce(
     bounce_func,
     drain_method,
@@ -172,6 +198,7 @@ def do_bounce(
     marathon_jobid,
     client,
     soa_dir,
+    new_app_instances=None,
 ):
     def log_bounce_action(line, level='debug'):
         return _log(
@@ -214,13 +241,17 @@ def do_bounce(
         new_app_running=new_app_running,
         happy_new_tasks=happy_new_tasks,
         old_app_live_tasks=old_app_live_tasks,
+        old_app_draining_tasks=old_app_draining_tasks,
     )
 
     if actions['create_app'] and not new_app_running:
         log_bounce_action(
             line='%s bounce creating new app with app_id %s' % (bounce_method, marathon_jobid),
         )
-        bounce_lib.create_marathon_app(marathon_jobid, config, client)
+        create_config = config
+        if actions.get('new_app_instances') is not None:
+            create_config = dict(config, instances=actions['new_app_instances'])
+        bounce_lib.create_marathon_app(marathon_jobid, create_config, client)
     if len(actions['tasks_to_drain']) > 0:
         tasks_to_drain_by_app_id = {}
         for task in actions['tasks_to_drain']:
@@ -230,20 +261,27 @@ def do_bounce(
                 line='%s bounce draining %d old tasks with app_id %s' %
                 (bounce_method, len(tasks), app_id),
             )
-        for task in actions['tasks_to_drain']:
-            all_draining_tasks.add(task)
-            drain_method.drain(task)
+        all_draining_tasks.update(actions['tasks_to_drain'])
+        bounce_lib.check_zookeeper_locks()
+        drain_method.drain_many(actions['tasks_to_drain'])
     for app, tasks in old_app_draining_tasks.items():
         for task in tasks:
             all_draining_tasks.add(task)
 
-    killed_tasks = set()
-
-    for task in all_draining_tasks:
-        if drain_method.is_safe_to_kill(task):
-            killed_tasks.add(task)
+    tasks_to_kill = set()
+    for task, is_safe_to_kill in drain_method.is_safe_to_kill_many(all_draining_tasks).items():
+        if is_safe_to_kill:
+            tasks_to_kill.add(task)
             log_bounce_action(line='%s bounce killing drained task %s' % (bounce_method, task.id))
-            client.kill_task(task.app_id, task.id, scale=True)
+
+    bounce_lib.check_zookeeper_locks()
+    failed_kills = bounce_lib.kill_tasks(tasks_to_kill, client)
+    for task, error in failed_kills.items():
+        log_bounce_action(
+            line='%s bounce failed to kill drained task %s: %s' % (bounce_method, task.id, error),
+            level='event',
+        )
+    killed_tasks = tasks_to_kill - set(failed_kills)
 
     apps_to_kill = []
     for app in old_app_live_tasks.keys():
@@ -253,6 +291,24 @@ def do_bounce(
         if 0 == len((live_tasks | draining_tasks) - killed_tasks):
             apps_to_kill.append(app)
 
+    # A bounce method may have created the new app with fewer instances than configured, so scale it up as the
+    # bounce goes on. Only do so while there are old apps, so that a scale down of the new app after the bounce is
+    # not undone. Bounce methods which don't size the new app expect it to be full size, as does the end of a bounce.
+    # This happens before the old apps are killed: if it fails, an old app is left for the next run to try again,
+    # while a new app left undersized with no old apps would stay that way.
+    if new_app_running and new_app_instances is not None and old_app_live_tasks:
+        if actions.get('new_app_instances') is None or set(apps_to_kill) == set(old_app_live_tasks.keys()):
+            target_instances = config['instances']
+        else:
+            target_instances = actions['new_app_instances']
+        if target_instances > new_app_instances:
+            log_bounce_action(
+                line='%s bounce scaling new app %s from %d to %d instances' %
+                (bounce_method, marathon_jobid, new_app_instances, target_instances),
+            )
+            bounce_lib.check_zookeeper_locks()
+            client.scale_app(marathon_jobid, instances=target_instances, force=True)
+
     if apps_to_kill:
         log_bounce_action(
             line='%s bounce removing old unused apps with app_ids: %s' %
@@ -284,13 +340,14 @@ def get_old_live_draining_tasks(other_apps, drain_method):
     old_app_live_tasks = {}
     old_app_draining_tasks = {}
 
+    is_draining = drain_method.is_draining_many([task for app in other_apps for task in app.tasks])
     for app in other_apps:
         tasks_by_state = {
             'live': set(),
             'draining': set(),
         }
         for task in app.tasks:
-            state = 'draining' if drain_method.is_draining(task) else 'live'
+            state = 'draining' if is_draining[task] else 'live'
             tasks_by_state[state].add(task)
 
         old_app_live_tasks[app.id] = tasks_by_state['live']
@@ -311,6 +368,10 @@ def deploy_service(
     nerve_ns,
     bounce_health_params,
     soa_dir,
+    marathon_snapshot=None,
+    system_paasta_config=None,
+    zk=None,
+    bounce_method_params=None,
 ):
     """Deploy the service to marathon, either directly or via a bounce if needed.
     Called by setup_service when it's time to actually deploy.
@@ -324,6 +385,11 @@ def deploy_service(
     :param drain_method_name: The name of the traffic draining method to use.
     :param nerve_ns: The nerve namespace to look in.
     :param bounce_health_params: A dictionary of options for bounce_lib.get_happy_tasks.
+    :param marathon_snapshot: An optional MarathonSnapshot to read the existing apps from. Changes to marathon
+                              are always made through client.
+    :param system_paasta_config: An already loaded SystemPaastaConfig. If not given, it is loaded from disk.
+    :param zk: An already started KazooClient to take the bounce lock with. If not given, the shared one is used.
+    :param bounce_method_params: A dictionary of extra keyword arguments for the bounce method.
     :returns: A tuple of (status, output) to be used with send_sensu_event"""
 
     def log_deploy_error(errormsg, level='event'):
@@ -338,8 +404,15 @@ def deploy_service(
 
     short_id = marathon_tools.format_job_id(service, instance)
 
-    cluster = load_system_paasta_config().get_cluster()
-    existing_apps = marathon_tools.get_matching_apps(service, instance, client, embed_failures=True)
+    if system_paasta_config is None:
+        system_paasta_config = load_system_paasta_config()
+    cluster = system_paasta_config.get_cluster()
+    existing_apps = marathon_tools.get_matching_apps(
+        service,
+        instance,
+        marathon_snapshot if marathon_snapshot is not None else client,
+        embed_failures=True,
+    )
     new_app_list = [a for a in existing_apps if a.id == '/%s' % config['id']]
     other_apps = [a for a in existing_apps if a.id != '/%s' % config['id']]
     serviceinstance = "%s.%s" % (service, instance)
@@ -349,9 +422,11 @@ def deploy_service(
         if len(new_app_list) != 1:
             raise ValueError("Only expected one app per ID; found %d" % len(new_app_list))
         new_app_running = True
+        new_app_instances = new_app.instances
         happy_new_tasks = bounce_lib.get_happy_tasks(new_app, service, nerve_ns, **bounce_health_params)
     else:
         new_app_running = False
+        new_app_instances = None
         happy_new_tasks = []
 
     try:
@@ -371,15 +446,12 @@ def deploy_service(
     old_app_live_tasks, old_app_draining_tasks = get_old_live_draining_tasks(other_apps, drain_method)
 
     # Re-drain any already draining tasks on old apps
-    for tasks in old_app_draining_tasks.values():
-        for task in tasks:
-            drain_method.drain(task)
+    drain_method.drain_many(set.union(set(), *old_app_draining_tasks.values()))
 
     # If any tasks on the new app happen to be draining (e.g. someone reverts to an older version with
     # `paasta mark-for-deployment`), then we should undrain them.
     if new_app_running:
-        for task in new_app.tasks:
-            drain_method.stop_draining(task)
+        drain_method.stop_draining_many(new_app.tasks)
 
     # log all uncaught exceptions and raise them again
     try:
@@ -390,9 +462,22 @@ def deploy_service(
                 (bounce_method, ', '.join(bounce_lib.list_bounce_methods()))
             log_deploy_error(errormsg)
             return (1, errormsg)
+        bounce_method_params, ignored_params = bounce_lib.get_bounce_method_params(
+            bounce_func,
+            bounce_method_params or {},
+        )
+        if ignored_params:
+            errormsg = 'WARNING: ignoring bounce_method_params the %s bounce method does not take: %s.' % \
+                (bounce_method, ', '.join(ignored_params))
+            legacy_params = [param for param in ignored_params if param in LEGACY_BOUNCE_METHOD_PARAMS]
+            if legacy_params:
+                errormsg += ' %s should be set in bounce_health_params instead.' % ', '.join(legacy_params)
+            log_deploy_error(errormsg)
+        if bounce_method_params:
+            bounce_func = functools.partial(bounce_func, **bounce_method_params)
 
         try:
-            with bounce_lib.bounce_lock_zookeeper(short_id):
+            with bounce_lib.bounce_lock_zookeeper(short_id, zk=zk):
                 do_bounce(
                     bounce_func=bounce_func,
                     drain_method=drain_method,
@@ -409,11 +494,16 @@ def deploy_service(
                     marathon_jobid=marathon_jobid,
                     client=client,
                     soa_dir=soa_dir,
+                    new_app_instances=new_app_instances,
                 )
 
         except bounce_lib.LockHeldException:
             log.error("Instance %s already being bounced. Exiting", short_id)
             return (1, "Instance %s is already being bounced." % short_id)
+        except bounce_lib.LockLostException as e:
+            errormsg = 'ERROR: stopped bouncing %s: %s. The next run will carry on.' % (short_id, e)
+            log_deploy_error(errormsg)
+            return (1, errormsg)
     except Exception:
         loglines = ['Exception raised during deploy of service %s:' % service]
         loglines.extend(traceback.format_exc().rstrip().split("\n"))
@@ -425,7 +515,8 @@ def deploy_service(
 
 
 def setup_service(service, instance, client, marathon_config,
-                  service_marathon_config, soa_dir):
+                  service_marathon_config, soa_dir, marathon_snapshot=None,
+                  system_paasta_config=None, zk=None):
     """Setup the service instance given and attempt to deploy it, if possible.
     Doesn't do anything if the service is already in Marathon and hasn't changed.
     If it's not, attempt to find old instances of the service and bounce them.
@@ -435,11 +526,19 @@ def setup_service(service, instance, client, marathon_config,
     :param client: A MarathonClient object
     :param marathon_config: The marathon configuration dict
     :param service_marathon_config: The service instance's configuration dict
+    :param marathon_snapshot: An optional MarathonSnapshot to read the existing apps from
+    :param system_paasta_config: An already loaded SystemPaastaConfig. If not given, it is loaded from disk.
+    :param zk: An already started KazooClient to take the bounce lock with. If not given, the shared one is used.
     :returns: A tuple of (status, output) to be used with send_sensu_event"""
 
     log.info("Setting up instance %s for service %s", instance, service)
     try:
-        complete_config = marathon_tools.create_complete_config(service, instance, marathon_config)
+        complete_config = marathon_tools.create_complete_config(
+            service,
+            instance,
+            marathon_config,
+            system_paasta_config=system_paasta_config,
+        )
     except NoDockerImageError:
         error_msg = (
             "Docker image for {0}.{1} not in deployments.json. Exiting. Has Jenkins deployed it?\n"
@@ -466,9 +565,68 @@ def setup_service(service, instance, client, marathon_config,
         nerve_ns=service_marathon_config.get_nerve_namespace(),
         bounce_health_params=service_marathon_config.get_bounce_health_params(service_namespace_config),
         soa_dir=soa_dir,
+        marathon_snapshot=marathon_snapshot,
+        system_paasta_config=system_paasta_config,
+        zk=zk,
+        bounce_method_params=service_marathon_config.get_bounce_method_params(),
     )
 
 
+def setup_service_instance(service, instance, client, marathon_config, soa_dir,
+                           marathon_snapshot=None, system_paasta_config=None, zk=None):
+    """Load a service instance's configuration, deploy it with setup_service and
+    emit an event about the deployment to sensu.
+
+    :param service: The service name to setup
+    :param instance: The instance of the service to setup
+    :param client: A MarathonClient object
+    :param marathon_config: The marathon configuration dict
+    :param soa_dir: The SOA configuration directory to read from
+    :param marathon_snapshot: An optional MarathonSnapshot to read the existing apps from
+    :param system_paasta_config: An already loaded SystemPaastaConfig. If not given, it is loaded from disk.
+    :param zk: An already started KazooClient to take the bounce lock with. If not given, the shared one is used.
+    :returns: The exit code setup_marathon_job should exit with for this instance"""
+    if system_paasta_config is None:
+        system_paasta_config = load_system_paasta_config()
+    cluster = system_paasta_config.get_cluster()
+    service_instance = compose_job_id(service, instance)
+
+    try:
+        service_instance_config = marathon_tools.load_marathon_service_config(
+            service,
+            instance,
+            cluster,
+            soa_dir=soa_dir,
+        )
+    except NoDeploymentsAvailable:
+        error_msg = "No deployments found for %s in cluster %s" % (service_instance, cluster)
+        log.error(error_msg)
+        send_event(service, instance, soa_dir, pysensu_yelp.Status.CRITICAL, error_msg, cluster=cluster)
+        # return 0 because the event was sent to the right team and this is not an issue with Paasta itself
+        return 0
+    except NoConfigurationForServiceError:
+        error_msg = "Could not read marathon configuration file for %s in cluster %s" % \
+                    (service_instance, cluster)
+        log.error(error_msg)
+        send_event(service, instance, soa_dir, pysensu_yelp.Status.CRITICAL, error_msg, cluster=cluster)
+        return 1
+
+    try:
+        status, output = setup_service(service, instance, client, marathon_config,
+                                       service_instance_config, soa_dir, marathon_snapshot,
+                                       system_paasta_config=system_paasta_config, zk=zk)
+        sensu_status = pysensu_yelp.Status.CRITICAL if status else pysensu_yelp.Status.OK
+        send_event(service, instance, soa_dir, sensu_status, output, cluster=cluster)
+        # We return 0 because the deploy finished ok and the event was sent to the right team.
+        return 0
+    except (KeyError, TypeError, AttributeError, InvalidInstanceConfig):
+        error_str = traceback.format_exc()
+        log.error(error_str)
+        send_event(service, instance, soa_dir, pysensu_yelp.Status.CRITICAL, error_str, cluster=cluster)
+        # We return 0 because the deploy finished ok and the event was sent to the right team.
+        return 0
+
+
 def main():
     """Attempt to set up the marathon service instance given.
     Exits 1 if the deployment failed.
@@ -496,42 +654,11 @@ def main():
     marathon_config = get_main_marathon_config()
     client = marathon_tools.get_marathon_client(marathon_config.get_url(), marathon_config.get_username(),
                                                 marathon_config.get_password())
+    marathon_snapshot = None
+    if args.marathon_snapshot:
+        marathon_snapshot = get_marathon_snapshot(args.marathon_snapshot)
 
-    try:
-        service_instance_config = marathon_tools.load_marathon_service_config(
-            service,
-            instance,
-            load_system_paasta_config().get_cluster(),
-            soa_dir=soa_dir,
-        )
-    except NoDeploymentsAvailable:
-        error_msg = "No deployments found for %s in cluster %s" % (args.service_instance,
-                                                                   load_system_paasta_config().get_cluster())
-        log.error(error_msg)
-        send_event(service, instance, soa_dir, pysensu_yelp.Status.CRITICAL, error_msg)
-        # exit 0 because the event was sent to the right team and this is not an issue with Paasta itself
-        sys.exit(0)
-    except NoConfigurationForServiceError:
-        error_msg = "Could not read marathon configuration file for %s in cluster %s" % \
-                    (args.service_instance, load_system_paasta_config().get_cluster())
-        log.error(error_msg)
-        send_event(service, instance, soa_dir, pysensu_yelp.Status.CRITICAL, error_msg)
-        sys.exit(1)
-
-    try:
-        status, output = setup_service(service, instance, client, marathon_config,
-                                       service_instance_config, soa_dir)
-        sensu_status = pysensu_yelp.Status.CRITICAL if status else pysensu_yelp.Status.OK
-        send_event(service, instance, soa_dir, sensu_status, output)
-        # We exit 0 because the script finished ok and the event was sent to the right team.
-        sys.exit(0)
-    except (KeyError, TypeError, AttributeError, InvalidInstanceConfig):
-        import traceback
-        error_str = traceback.format_exc()
-        log.error(error_str)
-        send_event(service, instance, soa_dir, pysensu_yelp.Status.CRITICAL, error_str)
-        # We exit 0 because the script finished ok and the event was sent to the right team.
-        sys.exit(0)
+    sys.exit(setup_service_instance(service, instance, client, marathon_config, soa_dir, marathon_snapshot))
 
 
 if __name__ == "__main__":
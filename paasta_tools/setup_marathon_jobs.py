@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# Copyright 2015 Yelp Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Usage: ./setup_marathon_jobs.py [options]
+
+Deploy every marathon service instance in this cluster from a single process.
+
+This does the same thing as running setup_marathon_job once for each instance
+listed by list_marathon_service_instances, but all of the instances share one
+MarathonClient, one zookeeper session for their bounce locks, one parsed
+system paasta config and one snapshot of the apps in Marathon, which is
+fetched again whenever it gets stale. The instances are deployed concurrently
+on a bounded pool of threads.
+
+Command line options:
+
+- -d <SOA_DIR>, --soa-dir <SOA_DIR>: Specify a SOA config dir to read from
+- -j <JOBS>, --jobs <JOBS>: How many instances to set up at the same time
+- -v, --verbose: Verbose output
+"""
+import argparse
+import logging
+import random
+import sys
+import traceback
+
+from concurrent.futures import ThreadPoolExecutor
+import service_configuration_lib
+
+from paasta_tools import bounce_lib
+from paasta_tools import marathon_tools
+from paasta_tools.setup_marathon_job import get_main_marathon_config
+from paasta_tools.setup_marathon_job import setup_service_instance
+from paasta_tools.utils import compose_job_id
+from paasta_tools.utils import configure_log
+from paasta_tools.utils import get_services_for_cluster
+from paasta_tools.utils import load_system_paasta_config
+from paasta_tools.zookeeper_tools import get_zookeeper_client
+
+DEFAULT_JOBS = 5
+
+log = logging.getLogger('__main__')
+logging.basicConfig()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Creates marathon jobs for every instance in the cluster.')
+    parser.add_argument('-d', '--soa-dir', dest="soa_dir", metavar="SOA_DIR",
+                        default=service_configuration_lib.DEFAULT_SOA_DIR,
+                        help="define a different soa config directory")
+    parser.add_argument('-j', '--jobs', dest="jobs", metavar="JOBS", type=int,
+                        default=DEFAULT_JOBS,
+                        help="how many instances to set up at the same time (default %(default)s)")
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        dest="verbose", default=False)
+    args = parser.parse_args()
+    return args
+
+
+def setup_service_instance_logging_exceptions(service, instance, shared_marathon_snapshot=None, **kwargs):
+    """Run setup_service_instance, turning any exception into a failed exit code
+    so that one broken instance doesn't stop the others from being set up.
+
+    :param shared_marathon_snapshot: An optional SharedMarathonSnapshot to read a fresh enough
+                                     MarathonSnapshot from right before the instance is set up"""
+    try:
+        if shared_marathon_snapshot is not None:
+            kwargs['marathon_snapshot'] = shared_marathon_snapshot.get()
+        return setup_service_instance(service, instance, **kwargs)
+    except Exception:
+        log.error("Exception raised while setting up %s:\n%s" %
+                  (compose_job_id(service, instance), traceback.format_exc()))
+        return 1
+
+
+def setup_service_instances(service_instances, client, marathon_config, soa_dir, jobs,
+                            marathon_snapshot=None, system_paasta_config=None, zk=None):
+    """Set up each of the given service instances on a pool of jobs threads.
+
+    :param service_instances: A list of tuples of (service, instance)
+    :param jobs: The maximum number of instances to set up at the same time
+    :param marathon_snapshot: An optional MarathonSnapshot to read the existing apps from. Once it is
+                              stale, a new one is fetched for the instances that haven't started yet.
+    :returns: A list of (service, instance, exit_code) tuples, in the same order as service_instances"""
+    shared_marathon_snapshot = None
+    if marathon_snapshot is not None:
+        shared_marathon_snapshot = marathon_tools.SharedMarathonSnapshot(client, marathon_snapshot)
+    executor = ThreadPoolExecutor(max_workers=jobs)
+    try:
+        futures = [
+            executor.submit(
+                setup_service_instance_logging_exceptions,
+                service,
+                instance,
+                client=client,
+                marathon_config=marathon_config,
+                soa_dir=soa_dir,
+                shared_marathon_snapshot=shared_marathon_snapshot,
+                system_paasta_config=system_paasta_config,
+                zk=zk,
+            )
+            for service, instance in service_instances
+        ]
+        return [
+            (service, instance, future.result())
+            for (service, instance), future in zip(service_instances, futures)
+        ]
+    finally:
+        executor.shutdown(wait=True)
+
+
+def main():
+    """Set up every marathon service instance in the cluster.
+    Exits 1 if any of the deployments failed.
+
+    - Load the system paasta and marathon configuration once
+    - Connect to marathon and zookeeper once
+    - Take a snapshot of the apps in marathon
+    - Set up each service instance, JOBS at a time"""
+    configure_log()
+    args = parse_args()
+    if args.verbose:
+        log.setLevel(logging.DEBUG)
+    else:
+        log.setLevel(logging.WARNING)
+
+    system_paasta_config = load_system_paasta_config()
+    service_instances = get_services_for_cluster(
+        cluster=system_paasta_config.get_cluster(),
+        instance_type='marathon',
+        soa_dir=args.soa_dir,
+    )
+    # Like `shuf` in deploy_marathon_services, so one slow instance doesn't always delay the same others
+    random.shuffle(service_instances)
+
+    marathon_config = get_main_marathon_config()
+    client = marathon_tools.get_marathon_client(marathon_config.get_url(), marathon_config.get_username(),
+                                                marathon_config.get_password())
+    marathon_snapshot = marathon_tools.fetch_marathon_snapshot(client)
+
+    zk = get_zookeeper_client(system_paasta_config.get_zk_hosts(), timeout=bounce_lib.ZK_LOCK_CONNECT_TIMEOUT_S)
+    results = setup_service_instances(
+        service_instances=service_instances,
+        client=client,
+        marathon_config=marathon_config,
+        soa_dir=args.soa_dir,
+        jobs=args.jobs,
+        marathon_snapshot=marathon_snapshot,
+        system_paasta_config=system_paasta_config,
+        zk=zk,
+    )
+
+    failed = [compose_job_id(service, instance) for service, instance, exit_code in results if exit_code != 0]
+    if failed:
+        log.error("Failed to set up: %s" % ', '.join(failed))
+        sys.exit(1)
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -13,37 +13,227 @@
 # limitations under the License.
 
 import csv
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+
+import concurrent.futures
+from concurrent.futures import ThreadPoolExecutor
 import requests
 
 DEFAULT_SYNAPSE_HOST = 'localhost'
 DEFAULT_SYNAPSE_PORT = 3212
 SYNAPSE_HAPROXY_PATH = "http://{0}/;csv;norefresh"
+DEFAULT_HAPROXY_STATS_SOCKET = '/var/run/synapse/haproxy.sock'
+# The hosts whose haproxy can be read from the local stats socket, besides our own fqdn
+LOCAL_SYNAPSE_HOSTS = ('localhost', '127.0.0.1')
+# The <type> bitmask of 'show stat' that selects server lines
+HAPROXY_STAT_TYPE_SERVERS = 4
+# How long a downloaded haproxy CSV is reused for, so that the lookups made by a
+# single command share one download per synapse host.
+HAPROXY_CSV_CACHE_TTL_S = 5
+# The most locations query_locations asks at the same time
+MAX_LOCATION_QUERY_JOBS = 32
+# How many hosts of a location query_location may ask, one after the other, before giving up
+MAX_HOSTS_PER_LOCATION = 3
+# How long query_location waits for a host to answer before also asking the next one
+SYNAPSE_HEDGE_DELAY_S = 1
+# A host that failed this many queries in a row is only asked when no other host is left...
+MAX_SYNAPSE_HOST_FAILURES = 3
+# ...until this many seconds after its last failure
+SYNAPSE_HOST_FAILURE_MEMORY_S = 300
+# The columns of the haproxy csv that paasta reads
+HAPROXY_BACKEND_FIELDS = (
+    'pxname',
+    'svname',
+    'status',
+    'check_status',
+    'check_code',
+    'check_duration',
+    'lastchg',
+)
 
+log = logging.getLogger('__main__')
 
-def retrieve_haproxy_csv(synapse_host=DEFAULT_SYNAPSE_HOST, synapse_port=DEFAULT_SYNAPSE_PORT):
-    """Retrieves the haproxy csv from the haproxy web interface
+_haproxy_session = None
+_haproxy_session_lock = threading.Lock()
+_haproxy_csv_cache = {}
+_haproxy_csv_cache_lock = threading.Lock()
+_synapse_host_failures = {}
+_synapse_host_failures_lock = threading.Lock()
 
-    :param synapse_host_port: A string in host:port format that this check
-                              should contact for replication information.
-    :returns reader: a csv.DictReader object
+
+def get_haproxy_session():
+    """Returns the requests.Session shared by every haproxy request this process makes,
+    so connections to synapse hosts are pooled and kept alive between requests."""
+    global _haproxy_session
+    with _haproxy_session_lock:
+        if _haproxy_session is None:
+            session = requests.Session()
+            # retry 3 times
+            session.mount('http://', requests.adapters.HTTPAdapter(max_retries=3))
+            session.mount('https://', requests.adapters.HTTPAdapter(max_retries=3))
+            _haproxy_session = session
+        return _haproxy_session
+
+
+def is_local_synapse_host(synapse_host):
+    return synapse_host in LOCAL_SYNAPSE_HOSTS or synapse_host == socket.getfqdn()
+
+
+def fetch_haproxy_csv_from_socket(stats_socket=DEFAULT_HAPROXY_STATS_SOCKET, proxy_id=-1):
+    """Reads the haproxy csv with a ``show stat`` on haproxy's UNIX stats socket.
+    Only server lines are requested, as the FRONTEND/BACKEND ones are never used.
+
+    :param stats_socket: The path of the haproxy stats socket
+    :param proxy_id: The numeric id of the only proxy to show, or -1 for all of them
+    :returns csv: The text of the csv
     """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(1)
+        sock.connect(stats_socket)
+        sock.sendall('show stat %d %d -1\n' % (proxy_id, HAPROXY_STAT_TYPE_SERVERS))
+        chunks = []
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    finally:
+        sock.close()
+    return ''.join(chunks)
+
+
+def fetch_haproxy_csv(synapse_host=DEFAULT_SYNAPSE_HOST, synapse_port=DEFAULT_SYNAPSE_PORT,
+                      stats_socket=DEFAULT_HAPROXY_STATS_SOCKET):
+    """Downloads the haproxy csv, from haproxy's stats socket if synapse_host is this
+    host and the socket exists, or from the haproxy web interface otherwise.
+
+    :param synapse_host: The host to contact for replication information
+    :param synapse_port: The port to contact for replication information
+    :param stats_socket: The path of the local haproxy stats socket, or None to always use http
+    :returns csv: The text of the csv
+    """
+    # is_local_synapse_host may resolve this host's fqdn, so only after the cheap check
+    if stats_socket is not None and os.path.exists(stats_socket) and is_local_synapse_host(synapse_host):
+        try:
+            return fetch_haproxy_csv_from_socket(stats_socket)
+        except socket.error as e:
+            log.debug("Couldn't read haproxy stats from %s, falling back to http: %s" % (stats_socket, e))
+
     synapse_host_port = "%s:%s" % (synapse_host, synapse_port)
     synapse_uri = SYNAPSE_HAPROXY_PATH.format(synapse_host_port)
 
-    # timeout after 1 second and retry 3 times
-    haproxy_request = requests.Session()
-    haproxy_request.mount(
-        'http://',
-        requests.adapters.HTTPAdapter(max_retries=3))
-    haproxy_request.mount(
-        'https://',
-        requests.adapters.HTTPAdapter(max_retries=3))
-    haproxy_response = haproxy_request.get(synapse_uri, timeout=1)
-    haproxy_data = haproxy_response.text
+    # timeout after 1 second
+    haproxy_response = get_haproxy_session().get(synapse_uri, timeout=1)
+    return haproxy_response.text
+
+
+def retrieve_haproxy_csv(synapse_host=DEFAULT_SYNAPSE_HOST, synapse_port=DEFAULT_SYNAPSE_PORT,
+                         stats_socket=DEFAULT_HAPROXY_STATS_SOCKET):
+    """Retrieves the haproxy csv from the local haproxy stats socket or the haproxy web interface
+
+    :param synapse_host_port: A string in host:port format that this check
+                              should contact for replication information.
+    :param stats_socket: The path of the local haproxy stats socket, or None to always use http
+    :returns reader: a csv.DictReader object
+    """
+    haproxy_data = fetch_haproxy_csv(synapse_host, synapse_port, stats_socket)
     reader = csv.DictReader(haproxy_data.splitlines())
     return reader
 
 
+def get_haproxy_csv(synapse_host=DEFAULT_SYNAPSE_HOST, synapse_port=DEFAULT_SYNAPSE_PORT,
+                    ttl=HAPROXY_CSV_CACHE_TTL_S):
+    """Returns the haproxy csv of a synapse host, downloading it at most once every ttl seconds.
+
+    :param synapse_host: The host to contact for replication information
+    :param synapse_port: The port to contact for replication information
+    :param ttl: How many seconds an earlier download of the csv may be reused for
+    :returns csv: The text of the csv
+    """
+    key = (synapse_host, synapse_port)
+    with _haproxy_csv_cache_lock:
+        cached = _haproxy_csv_cache.get(key)
+    if cached is not None and time.time() - cached[0] < ttl:
+        return cached[1]
+
+    timestamp = time.time()
+    haproxy_data = fetch_haproxy_csv(synapse_host, synapse_port)
+    with _haproxy_csv_cache_lock:
+        _haproxy_csv_cache[key] = (timestamp, haproxy_data)
+    return haproxy_data
+
+
+class HaproxyBackend(object):
+    """A server line of the haproxy csv, keeping only the columns in HAPROXY_BACKEND_FIELDS.
+    Columns are read like the keys of a dict: ``backend['status']``."""
+    __slots__ = HAPROXY_BACKEND_FIELDS
+
+    def __init__(self, *values):
+        for field, value in zip(HAPROXY_BACKEND_FIELDS, values):
+            setattr(self, field, value)
+
+    def __getitem__(self, field):
+        try:
+            return getattr(self, field)
+        except AttributeError:
+            raise KeyError(field)
+
+    def get(self, field, default=None):
+        return getattr(self, field, default)
+
+    def _values(self):
+        return tuple(self.get(field) for field in HAPROXY_BACKEND_FIELDS)
+
+    def __eq__(self, other):
+        return isinstance(other, HaproxyBackend) and self._values() == other._values()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'HaproxyBackend(%s)' % ', '.join('%s=%r' % item for item in zip(HAPROXY_BACKEND_FIELDS, self._values()))
+
+
+def parse_haproxy_backends(haproxy_data, services=None):
+    """Parses the server lines out of an haproxy csv, ignoring the fictional
+    FRONTEND/BACKEND hosts.
+
+    Only the columns in HAPROXY_BACKEND_FIELDS are kept, and the lines of other
+    services are skipped before they are split into columns.
+
+    :param haproxy_data: The text of the csv
+    :param services: If specified, only return backends for these particular services.
+    :returns backends: A list of HaproxyBackend
+    """
+    lines = haproxy_data.splitlines()
+    if not lines:
+        return []
+    # there's a leading "# " on the header for no good reason
+    header = next(csv.reader([lines[0].lstrip('# ')]))
+    columns = [header.index(field) if field in header else None for field in HAPROXY_BACKEND_FIELDS]
+    svname_column = header.index('svname')
+
+    if services is not None:
+        services = set(services)
+        # pxname is the first column, so lines can be filtered without parsing them
+        lines = (line for line in lines[1:] if line.split(',', 1)[0] in services)
+    else:
+        lines = lines[1:]
+
+    backends = []
+    for row in csv.reader(lines):
+        if row[svname_column] in ('FRONTEND', 'BACKEND'):
+            continue
+        backends.append(HaproxyBackend(*[row[column] if column is not None else None for column in columns]))
+    return backends
+
+
 def get_backends(service=None, synapse_host=DEFAULT_SYNAPSE_HOST, synapse_port=DEFAULT_SYNAPSE_PORT):
     """Fetches the CSV from haproxy and returns a list of backends,
     regardless of their state.
@@ -52,7 +242,7 @@ def get_backends(service=None, synapse_host=DEFAULT_SYNAPSE_HOST, synapse_port=D
                     service
     :param synapse_host_port: A string in host:port format that this check
                               should contact for replication information.
-    :returns backends: A list of dicts representing the backends of all
+    :returns backends: A list of HaproxyBackend representing the backends of all
                        services or the requested service
     """
     if service:
@@ -70,25 +260,109 @@ def get_multiple_backends(services=None, synapse_host=DEFAULT_SYNAPSE_HOST, syna
                      services.
     :param synapse_host_port: A string in host:port format that this check
                               should contact for replication information.
-    :returns backends: A list of dicts representing the backends of all
+    :returns backends: A list of HaproxyBackend representing the backends of all
                        services or the requested service
     """
+    return parse_haproxy_backends(get_haproxy_csv(synapse_host, synapse_port), services)
 
-    reader = retrieve_haproxy_csv(synapse_host, synapse_port)
-    backends = []
 
-    for line in reader:
-        # clean up two irregularities of the CSV output, relative to
-        # DictReader's behavior there's a leading "# " for no good reason:
-        line['pxname'] = line.pop('# pxname')
-        # and there's a trailing comma on every line:
-        line.pop('')
+def record_synapse_host_result(synapse_host, succeeded):
+    """Remembers whether a query to a synapse host succeeded, for is_synapse_host_failing."""
+    with _synapse_host_failures_lock:
+        if succeeded:
+            _synapse_host_failures.pop(synapse_host, None)
+        else:
+            failures, _ = _synapse_host_failures.get(synapse_host, (0, None))
+            _synapse_host_failures[synapse_host] = (failures + 1, time.time())
 
-        # Look for the service in question and ignore the fictional
-        # FRONTEND/BACKEND hosts, use starts_with so that hosts that are UP
-        # with 1/X healthchecks to go before going down get counted as UP:
-        ha_slave, ha_service = line['svname'], line['pxname']
-        if (services is None or ha_service in services) and ha_slave not in ('FRONTEND', 'BACKEND'):
-            backends.append(line)
 
-    return backends
+def is_synapse_host_failing(synapse_host):
+    """Whether a synapse host failed its last MAX_SYNAPSE_HOST_FAILURES queries,
+    the last of them less than SYNAPSE_HOST_FAILURE_MEMORY_S ago."""
+    with _synapse_host_failures_lock:
+        failures, last_failure = _synapse_host_failures.get(synapse_host, (0, None))
+    return failures >= MAX_SYNAPSE_HOST_FAILURES and time.time() - last_failure < SYNAPSE_HOST_FAILURE_MEMORY_S
+
+
+def query_location(hosts, query, hedge_delay_s=SYNAPSE_HEDGE_DELAY_S, max_hosts=MAX_HOSTS_PER_LOCATION):
+    """Runs a query against the hosts of a location until one of them answers.
+
+    The first host is asked first. If it hasn't answered within hedge_delay_s, or as
+    soon as it fails, the next host is asked as well, and so on, and the first answer
+    wins. Hosts that keep failing are moved to the back of the line.
+
+    :param hosts: The hosts in the location, in the order they should be tried
+    :param query: A function that takes the synapse host to query and returns its result
+    :param hedge_delay_s: How long to wait for a host before also asking the next one
+    :param max_hosts: The most hosts to ask
+    :returns: The result of the first query to succeed. If they all failed, the
+              exception of the first host is raised instead.
+    """
+    candidates = iter(
+        ([host for host in hosts if not is_synapse_host_failing(host)] +
+         [host for host in hosts if is_synapse_host_failing(host)])[:max_hosts]
+    )
+    executor = ThreadPoolExecutor(max_workers=max_hosts)
+    pending = {}
+    errors = []
+
+    def ask_next_host():
+        host = next(candidates, None)
+        if host is not None:
+            pending[executor.submit(query, host)] = host
+
+    try:
+        ask_next_host()
+        while pending:
+            done, _ = concurrent.futures.wait(
+                pending, timeout=hedge_delay_s, return_when=concurrent.futures.FIRST_COMPLETED)
+            if not done:
+                log.debug("Synapse hosts %s are slow to answer, asking another one" % pending.values())
+                ask_next_host()
+                continue
+            for future in done:
+                host = pending.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    log.debug("Synapse host %s failed to answer: %s" % (host, e))
+                    record_synapse_host_result(host, False)
+                    # future.result() raises with the query's own traceback, keep it
+                    errors.append(sys.exc_info())
+                else:
+                    record_synapse_host_result(host, True)
+                    return result
+            ask_next_host()
+        exc_type, exc_value, exc_traceback = errors[0]
+        raise exc_type, exc_value, exc_traceback
+    finally:
+        # Don't wait for the hosts that lost the race, but still keep track of how they did
+        for future, host in pending.items():
+            future.add_done_callback(lambda f, host=host: record_synapse_host_result(host, f.exception() is None))
+        executor.shutdown(wait=False)
+
+
+def query_locations(locations, query, jobs=MAX_LOCATION_QUERY_JOBS, **kwargs):
+    """Runs a query against each location with query_location, querying all of the
+    locations at the same time, so that it takes as long as the slowest location
+    rather than as long as all of them put together.
+
+    :param locations: A dictionary of location to the list of hosts in it, like the one
+                      returned by mesos_tools.get_mesos_slaves_grouped_by_attribute
+    :param query: A function that takes the synapse host to query and returns its result
+    :param jobs: The most locations to query at the same time
+    :param kwargs: Passed on to query_location
+    :returns: A dictionary of location to the result of its query. If all of the hosts of
+              a location failed, the exception of the first such location is raised instead.
+    """
+    if not locations:
+        return {}
+    executor = ThreadPoolExecutor(max_workers=min(jobs, len(locations)))
+    try:
+        futures = [
+            (location, executor.submit(query_location, hosts, query, **kwargs))
+            for location, hosts in locations.items()
+        ]
+        return dict((location, future.result()) for location, future in futures)
+    finally:
+        executor.shutdown(wait=True)
@@ -14,6 +14,8 @@
 
 from __future__ import print_function
 import contextlib
+import cPickle
+import copy
 import datetime
 import errno
 import glob
@@ -27,6 +29,7 @@ import signal
 import sys
 import tempfile
 import threading
+import time
 from functools import wraps
 from subprocess import PIPE
 from subprocess import Popen
@@ -47,6 +50,10 @@ SPACER = '.'
 INFRA_ZK_PATH = '/nail/etc/zookeeper_discovery/infrastructure/'
 PATH_TO_SYSTEM_PAASTA_CONFIG_DIR = '/etc/paasta/'
 DEFAULT_SOA_DIR = service_configuration_lib.DEFAULT_SOA_DIR
+DEFAULT_SOA_SNAPSHOT_PATH = '/var/cache/paasta/soa_snapshot.pickle'
+SOA_SNAPSHOT_VERSION = 2
+DEFAULT_MESOS_STATE_CACHE_TTL_S = 30
+DEFAULT_MARATHON_APP_CREATION_LEASES = 1
 DEPLOY_PIPELINE_NON_DEPLOY_STEPS = (
     'itest',
     'security-check',
@@ -406,7 +413,7 @@ def get_git_url(service, soa_dir=DEFAULT_SOA_DIR):
 
     :param service: The service name to get a URL for
     :returns: A git url to the service's repository"""
-    general_config = service_configuration_lib.read_service_configuration(
+    general_config = read_service_configuration(
         service,
         soa_dir=soa_dir,
     )
@@ -527,6 +534,16 @@ def load_system_paasta_config(path=PATH_TO_SYSTEM_PAASTA_CONFIG_DIR):
     return SystemPaastaConfig(config, path)
 
 
+def get_system_paasta_config_signature(path=PATH_TO_SYSTEM_PAASTA_CONFIG_DIR):
+    """Returns a value which changes whenever one of the json files in the system paasta
+    configuration directory, which load_system_paasta_config reads, is added, removed,
+    modified or replaced."""
+    return tuple(
+        (config_file, _get_file_signature(config_file))
+        for config_file in get_readable_files_in_glob("%s/*.json" % path)
+    )
+
+
 class SystemPaastaConfig(dict):
 
     def __init__(self, config, directory):
@@ -591,6 +608,24 @@ class SystemPaastaConfig(dict):
         except KeyError:
             raise PaastaNotConfiguredError('Could not find scribe_map in configuration directory: %s' % self.directory)
 
+    def get_mesos_state_cache_ttl(self):
+        """Get how long, in seconds, a cached copy of the mesos master state may be used for.
+
+        :returns: The mesos_state_cache_ttl_s from the paasta configuration, or
+                  DEFAULT_MESOS_STATE_CACHE_TTL_S if it isn't set
+        """
+        return self.get('mesos_state_cache_ttl_s', DEFAULT_MESOS_STATE_CACHE_TTL_S)
+
+    def get_marathon_app_creation_leases(self):
+        """Get how many marathon apps may be created or deleted in the cluster at the same time.
+        It is shared with the rest of the cluster through zookeeper, and takes effect once
+        nobody holds the lock; see bounce_lib.get_app_creation_leases.
+
+        :returns: The marathon_app_creation_leases from the paasta configuration, or
+                  DEFAULT_MARATHON_APP_CREATION_LEASES if it isn't set
+        """
+        return int(self.get('marathon_app_creation_leases', DEFAULT_MARATHON_APP_CREATION_LEASES))
+
 
 def _run(command, env=os.environ, timeout=None, log=False, stream=False, stdin=None, **kwargs):
     """Given a command, run it. Return a tuple of the return code and any
@@ -868,7 +903,7 @@ def get_service_instance_list(service, cluster=None, instance_type=None, soa_dir
     for srv_instance_type in instance_types:
         conf_file = "%s-%s" % (srv_instance_type, cluster)
         log.info("Enumerating all instances for config file: %s/*/%s.yaml" % (soa_dir, conf_file))
-        instances = service_configuration_lib.read_extra_service_information(
+        instances = read_extra_service_information(
             service,
             conf_file,
             soa_dir=soa_dir
@@ -956,11 +991,227 @@ class NoDeploymentsAvailable(Exception):
     pass
 
 
+# Maps the path of a file in the SOA config dir to (signature, parsed contents),
+# so that each file is parsed at most once per process unless it changes on disk.
+_soa_config_index = {}
+_soa_config_index_lock = threading.Lock()
+
+
+def _get_file_signature(path):
+    """Returns a tuple which changes whenever the file at path is modified or
+    replaced, or None if the file can't be stat'ed."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_mtime, stat.st_size, stat.st_ino)
+
+
+def get_soa_service_signature(service, soa_dir=DEFAULT_SOA_DIR):
+    """Returns a value which changes whenever one of the files paasta reads from a service's
+    dir in the SOA config dir (its yaml files and deployments.json) is added, removed,
+    modified or replaced, or None if the service dir can't be listed."""
+    service_dir = os.path.join(soa_dir, service)
+    try:
+        filenames = os.listdir(service_dir)
+    except OSError:
+        return None
+    return tuple(sorted(
+        (filename, _get_file_signature(os.path.join(service_dir, filename)))
+        for filename in filenames
+        if filename.endswith('.yaml') or filename == 'deployments.json'
+    ))
+
+
+def _load_yaml_file(path):
+    with open(path) as f:
+        return service_configuration_lib.load_yaml(f.read()) or {}
+
+
+def _load_json_file(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def read_soa_config_file(path, parse, read_missing=None):
+    """Read a file from the SOA config dir through the process-wide index.
+
+    :param path: The path of the file to read
+    :param parse: A function which takes a path and returns its parsed contents
+    :param read_missing: A function to call, uncached, if path can't be stat'ed.
+                         Defaults to calling parse on path.
+    :returns: A copy of the parsed contents of path, which the caller is free to modify"""
+    signature = _get_file_signature(path)
+    if signature is None:
+        return read_missing() if read_missing is not None else parse(path)
+    with _soa_config_index_lock:
+        entry = _soa_config_index.get(path)
+    if entry is None or entry[0] != signature:
+        found, data = _read_from_soa_snapshot(path, signature)
+        if not found:
+            data = parse(path)
+        entry = (signature, data)
+        with _soa_config_index_lock:
+            _soa_config_index[path] = entry
+    return copy.deepcopy(entry[1])
+
+
+class SoaSnapshotNotAvailable(Exception):
+    pass
+
+
+def compile_soa_snapshot(soa_dir=DEFAULT_SOA_DIR):
+    """Parse every yaml file and deployments.json in each service dir of soa_dir.
+
+    Files which fail to parse are left out, so that readers fall back to parsing
+    them and see the error themselves.
+
+    :param soa_dir: The SOA config directory to compile
+    :returns: A dictionary with the version, soa_dir and timestamp of the snapshot, and a
+              tuple of (file signature, parsed contents) for each file keyed by its path
+              relative to soa_dir"""
+    soa_dir = os.path.abspath(soa_dir)
+    timestamp = time.time()
+    files = {}
+    for service in sorted(os.listdir(soa_dir)):
+        service_dir = os.path.join(soa_dir, service)
+        if not os.path.isdir(service_dir):
+            continue
+        for filename in sorted(os.listdir(service_dir)):
+            if filename.endswith('.yaml'):
+                parse = _load_yaml_file
+            elif filename == 'deployments.json':
+                parse = _load_json_file
+            else:
+                continue
+            path = os.path.join(service_dir, filename)
+            signature = _get_file_signature(path)
+            try:
+                data = parse(path)
+            except Exception as e:
+                log.warning("Leaving %s out of the SOA snapshot: %s" % (path, e))
+                continue
+            # A file changed while it was parsed can't be matched to what was parsed, so readers parse it themselves
+            if signature is not None and signature == _get_file_signature(path):
+                files[os.path.join(service, filename)] = (signature, data)
+    return {
+        'version': SOA_SNAPSHOT_VERSION,
+        'soa_dir': soa_dir,
+        'timestamp': timestamp,
+        'files': files,
+    }
+
+
+def write_soa_snapshot(snapshot, path=DEFAULT_SOA_SNAPSHOT_PATH):
+    with atomic_file_write(path) as f:
+        cPickle.dump(snapshot, f, cPickle.HIGHEST_PROTOCOL)
+
+
+def load_soa_snapshot(path=DEFAULT_SOA_SNAPSHOT_PATH):
+    """Load a snapshot written by write_soa_snapshot.
+
+    :raises SoaSnapshotNotAvailable: if the snapshot can't be read or was written by another version"""
+    try:
+        with open(path, 'rb') as f:
+            snapshot = cPickle.load(f)
+    except (IOError, EOFError, cPickle.UnpicklingError) as e:
+        raise SoaSnapshotNotAvailable("Could not load SOA snapshot %s: %s" % (path, e))
+    if not isinstance(snapshot, dict) or snapshot.get('version') != SOA_SNAPSHOT_VERSION:
+        raise SoaSnapshotNotAvailable("SOA snapshot %s was not written by this version of paasta" % path)
+    return snapshot
+
+
+# (signature of the snapshot file, snapshot or None), so the snapshot is loaded
+# at most once per process unless paasta_compile_soa rewrites it.
+_soa_snapshot = (None, None)
+_soa_snapshot_lock = threading.Lock()
+
+
+def get_soa_snapshot(path=DEFAULT_SOA_SNAPSHOT_PATH):
+    """Returns the snapshot at path, or None if there isn't a usable one."""
+    global _soa_snapshot
+    signature = _get_file_signature(path)
+    if signature is None:
+        return None
+    with _soa_snapshot_lock:
+        if _soa_snapshot[0] != signature:
+            try:
+                snapshot = load_soa_snapshot(path)
+            except SoaSnapshotNotAvailable as e:
+                log.warning(str(e))
+                snapshot = None
+            _soa_snapshot = (signature, snapshot)
+        return _soa_snapshot[1]
+
+
+def _read_from_soa_snapshot(path, signature):
+    """Look path up in the SOA snapshot, if path still has the signature it had when the
+    snapshot was compiled. Comparing the whole signature rather than only checking that the
+    file is older than the snapshot catches files copied in with their mtime preserved.
+
+    :returns: A tuple of (found, parsed contents)"""
+    snapshot = get_soa_snapshot()
+    if snapshot is None:
+        return False, None
+    path = os.path.abspath(path)
+    if not path.startswith(snapshot['soa_dir'] + os.sep):
+        return False, None
+    entry = snapshot['files'].get(os.path.relpath(path, snapshot['soa_dir']))
+    if entry is None or entry[0] != signature:
+        return False, None
+    return True, entry[1]
+
+
+def read_extra_service_information(service, extra_info, soa_dir=DEFAULT_SOA_DIR):
+    """Like service_configuration_lib.read_extra_service_information, but only
+    re-parses <soa_dir>/<service>/<extra_info>.yaml when it changes on disk.
+
+    :param service: The service name
+    :param extra_info: The name of the yaml file to read, without its extension, e.g. marathon-norcal-devc
+    :param soa_dir: The SOA config directory to read from
+    :returns: A dictionary of the contents of the file, or {} if it doesn't exist"""
+    path = os.path.join(os.path.abspath(soa_dir), service, extra_info + '.yaml')
+    return read_soa_config_file(
+        path,
+        _load_yaml_file,
+        read_missing=lambda: service_configuration_lib.read_extra_service_information(
+            service,
+            extra_info,
+            soa_dir=soa_dir,
+        ),
+    )
+
+
+def read_service_configuration(service, soa_dir=DEFAULT_SOA_DIR):
+    """Like service_configuration_lib.read_service_configuration, but each of the
+    files making up the service's configuration is only re-parsed when it changes on disk.
+
+    :param service: The service name
+    :param soa_dir: The SOA config directory to read from
+    :returns: A dictionary of the general configuration of the service"""
+    service_dir = os.path.join(os.path.abspath(soa_dir), service)
+    if not os.path.isdir(service_dir):
+        return service_configuration_lib.read_service_configuration(service, soa_dir=soa_dir)
+
+    def read_yaml(name):
+        return read_soa_config_file(os.path.join(service_dir, name), _load_yaml_file, read_missing=dict)
+
+    return service_configuration_lib.generate_service_info(
+        read_yaml('service.yaml'),
+        port=service_configuration_lib.read_port(os.path.join(service_dir, 'port')),
+        vip=service_configuration_lib.read_vip(os.path.join(service_dir, 'vip')),
+        lb_extras=read_yaml('lb.yaml'),
+        monitoring=read_yaml('monitoring.yaml'),
+        deploy=read_yaml('deploy.yaml'),
+        data=read_yaml('data.yaml'),
+        smartstack=read_yaml('smartstack.yaml'),
+    )
+
+
 def load_deployments_json(service, soa_dir=DEFAULT_SOA_DIR):
     deployment_file = os.path.join(soa_dir, service, 'deployments.json')
     if os.path.isfile(deployment_file):
-        with open(deployment_file) as f:
-            return DeploymentsJson(json.load(f)['v1'])
+        return DeploymentsJson(read_soa_config_file(deployment_file, _load_json_file)['v1'])
     else:
         raise NoDeploymentsAvailable
 
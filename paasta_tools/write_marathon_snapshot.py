@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# Copyright 2015 Yelp Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Usage: ./write_marathon_snapshot.py <path> [options]
+
+Lists every app in Marathon (with their tasks) once and writes the result to
+<path>, so that every setup_marathon_job in a deploy_marathon_services cycle
+can read it with --marathon-snapshot instead of listing all apps itself.
+
+Command line options:
+
+- -v, --verbose: Verbose output
+"""
+import argparse
+import logging
+import sys
+
+from paasta_tools import marathon_tools
+
+log = logging.getLogger('__main__')
+logging.basicConfig()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Writes a snapshot of all marathon apps to a file.')
+    parser.add_argument('path', help="The file to write the snapshot to")
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        dest="verbose", default=False)
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = parse_args()
+    if args.verbose:
+        log.setLevel(logging.DEBUG)
+    else:
+        log.setLevel(logging.WARNING)
+
+    marathon_config = marathon_tools.load_marathon_config()
+    client = marathon_tools.get_marathon_client(marathon_config.get_url(), marathon_config.get_username(),
+                                                marathon_config.get_password())
+    snapshot = marathon_tools.fetch_marathon_snapshot(client)
+    marathon_tools.write_marathon_snapshot(snapshot, args.path)
+    log.info("Wrote a snapshot of %d marathon apps to %s", len(snapshot.apps), args.path)
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
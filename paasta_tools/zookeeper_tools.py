@@ -0,0 +1,120 @@
+# Copyright 2015 Yelp Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import atexit
+import logging
+import threading
+
+from kazoo.client import KazooClient
+from kazoo.client import KazooState
+
+from paasta_tools.utils import load_system_paasta_config
+
+log = logging.getLogger('__main__')
+
+DEFAULT_ZK_CONNECT_TIMEOUT_S = 10.0  # seconds to wait to connect to zookeeper
+
+
+class ZookeeperClientManager(object):
+    """Hands out one started KazooClient per zookeeper ensemble for the whole process,
+    so that every lock and lookup shares a single session instead of paying for a
+    new session handshake each time.
+
+    Clients are started the first time they are asked for. Kazoo reconnects them on
+    its own after a connection or session loss; the manager counts the lost sessions,
+    so that holders of ephemeral nodes such as locks can find out their node is gone.
+    Every client is stopped and closed when the process exits."""
+
+    def __init__(self):
+        self._clients = {}
+        self._lost_sessions = {}
+        self._lock = threading.Lock()
+        self._registered_atexit = False
+
+    def get_client(self, hosts, read_only=False, timeout=DEFAULT_ZK_CONNECT_TIMEOUT_S):
+        """Returns the started KazooClient for an ensemble, starting it if needed.
+
+        :param hosts: The zookeeper hosts, in the format KazooClient takes
+        :param read_only: Whether the client may connect to read-only servers
+        :param timeout: How many seconds to wait to connect, the first time
+        :returns: A started KazooClient
+        """
+        key = (hosts, read_only)
+        with self._lock:
+            if key not in self._clients:
+                client = KazooClient(hosts=hosts, timeout=timeout, read_only=read_only)
+                client.add_listener(lambda state: self._on_state_change(key, state))
+                try:
+                    client.start(timeout=timeout)
+                except Exception:
+                    client.stop()
+                    client.close()
+                    raise
+                self._clients[key] = client
+                self._lost_sessions[key] = 0
+                if not self._registered_atexit:
+                    atexit.register(self.close_all)
+                    self._registered_atexit = True
+            return self._clients[key]
+
+    def _on_state_change(self, key, state):
+        # Kazoo calls listeners from its connection thread, so this must not block
+        if state == KazooState.LOST:
+            log.warning("Lost the zookeeper session to %s, ephemeral nodes and locks are gone" % key[0])
+            self._lost_sessions[key] = self._lost_sessions.get(key, 0) + 1
+        elif state == KazooState.SUSPENDED:
+            log.debug("Disconnected from zookeeper %s, reconnecting" % key[0])
+
+    def get_lost_sessions(self, client):
+        """Returns how many times a client handed out by this manager has lost its session.
+        Compare two answers to find out whether the session was lost in between."""
+        for key, managed_client in self._clients.items():
+            if managed_client is client:
+                return self._lost_sessions[key]
+        return 0
+
+    def close_all(self):
+        """Stops and closes every client. Later calls to get_client start new ones."""
+        with self._lock:
+            clients = self._clients.values()
+            self._clients = {}
+            self._lost_sessions = {}
+        for client in clients:
+            try:
+                client.stop()
+                client.close()
+            except Exception as e:
+                log.warning("Failed to close zookeeper client: %s" % e)
+
+
+_client_manager = ZookeeperClientManager()
+
+
+def get_zookeeper_client(hosts=None, read_only=False, timeout=DEFAULT_ZK_CONNECT_TIMEOUT_S):
+    """Returns this process's started KazooClient for a zookeeper ensemble.
+    It is shared with the rest of the process, so don't stop or close it.
+
+    :param hosts: The zookeeper hosts, or None for the zk_hosts of the system paasta config
+    :param read_only: Whether the client may connect to read-only servers
+    :param timeout: How many seconds to wait to connect, the first time
+    :returns: A started KazooClient
+    """
+    if hosts is None:
+        hosts = load_system_paasta_config().get_zk_hosts()
+    return _client_manager.get_client(hosts, read_only=read_only, timeout=timeout)
+
+
+def get_lost_zookeeper_sessions(client):
+    """Returns how many times a client from get_zookeeper_client has lost its session."""
+    return _client_manager.get_lost_sessions(client)
@@ -37,8 +37,10 @@ setup(
         # Don't update this unless you have confirmed the client works with the Docker version deployed on PaaSTA servers
         'docker-py == 1.2.3',
         'dulwich == 0.10.0',
+        'futures >= 3.0.1',
         'humanize >= 0.5.1',
         'httplib2 >= 0.9, <= 1.0',
+        'ijson >= 2.2',
         'isodate >= 0.5.0',
         'kazoo >= 2.0.0',
         'marathon >= 0.7.5',
@@ -74,12 +76,16 @@ setup(
         'paasta_tools/monitoring/check_synapse_replication.py',
         'paasta_tools/cli/cli.py',
         'paasta_tools/cli/paasta_tabcomplete.sh',
+        'paasta_tools/paasta_bounced.py',
+        'paasta_tools/paasta_compile_soa.py',
         'paasta_tools/paasta_execute_docker_command.py',
         'paasta_tools/paasta_metastatus.py',
         'paasta_tools/paasta_serviceinit.py',
         'paasta_tools/setup_chronos_job.py',
         'paasta_tools/setup_marathon_job.py',
+        'paasta_tools/setup_marathon_jobs.py',
         'paasta_tools/synapse_srv_namespaces_fact.py',
+        'paasta_tools/write_marathon_snapshot.py',
     ] + glob.glob('paasta_tools/contrib/*'),
     package_data = {'': ['cli/fsm/templates/*.tmpl']},
 )
@@ -12,13 +12,18 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import contextlib
 import os
+import socket
 
 import mock
 import requests
 
+from paasta_tools import smartstack_tools
+from paasta_tools.monitoring import replication_utils
 from paasta_tools.monitoring.replication_utils import (
     get_registered_marathon_tasks,
+    get_replication_for_all_services,
     get_replication_for_services,
     ip_port_hostname_from_svname,
     match_backends_and_tasks,
@@ -36,7 +41,10 @@ def test_get_replication_for_service():
     mock_response.text = mock_haproxy_data
     mock_get = mock.Mock(return_value=(mock_response))
 
-    with mock.patch.object(requests.Session, 'get', mock_get):
+    with contextlib.nested(
+        mock.patch.object(requests.Session, 'get', mock_get),
+        mock.patch.object(smartstack_tools, '_haproxy_csv_cache', {}),
+    ):
         replication_result = get_replication_for_services(
             'fake_host',
             6666,
@@ -51,6 +59,28 @@ def test_get_replication_for_service():
         assert expected == replication_result
 
 
+def test_get_replication_for_all_services():
+    testdir = os.path.dirname(os.path.realpath(__file__))
+    testdata = os.path.join(testdir, 'haproxy_snapshot.txt')
+    with open(testdata, 'r') as fd:
+        mock_haproxy_data = fd.read()
+
+    mock_response = mock.Mock()
+    mock_response.text = mock_haproxy_data
+    mock_get = mock.Mock(return_value=(mock_response))
+
+    with contextlib.nested(
+        mock.patch.object(requests.Session, 'get', mock_get),
+        mock.patch.object(smartstack_tools, '_haproxy_csv_cache', {}),
+    ):
+        replication_result = get_replication_for_all_services('fake_host', 6666)
+        assert mock_get.call_count == 1
+        assert replication_result['service1'] == 18
+        assert replication_result['service2'] == 19
+        assert replication_result['service3'] == 0
+        assert replication_result['service4'] == 3
+
+
 def test_get_registered_marathon_tasks():
     backends = [
         {"pxname": "servicename.main", "svname": "10.50.2.4:31000_box4", "status": "UP"},
@@ -82,10 +112,12 @@ def test_get_registered_marathon_tasks():
         'paasta_tools.monitoring.replication_utils.get_multiple_backends',
         return_value=backends
     ):
-        with mock.patch(
-            'paasta_tools.monitoring.replication_utils.'
-                'socket.gethostbyname',
-            side_effect=lambda x: hostnames[x],
+        with contextlib.nested(
+            mock.patch(
+                'paasta_tools.monitoring.replication_utils.socket.gethostbyname',
+                side_effect=lambda x: hostnames[x],
+            ),
+            mock.patch.object(replication_utils, '_dns_cache', {}),
         ):
             actual = get_registered_marathon_tasks(
                 'fake_host',
@@ -132,10 +164,12 @@ def test_match_backends_and_tasks():
     bad_task = mock.Mock(host='box7', ports=[31000])
     tasks = [good_task1, good_task2, bad_task]
 
-    with mock.patch(
-        'paasta_tools.monitoring.replication_utils.'
-            'socket.gethostbyname',
-        side_effect=lambda x: hostnames[x],
+    with contextlib.nested(
+        mock.patch(
+            'paasta_tools.monitoring.replication_utils.socket.gethostbyname',
+            side_effect=lambda x: hostnames[x],
+        ),
+        mock.patch.object(replication_utils, '_dns_cache', {}),
     ):
         expected = [
             (backends[0], good_task1),
@@ -147,3 +181,64 @@ def test_match_backends_and_tasks():
         ]
         actual = match_backends_and_tasks(backends, tasks)
         assert sorted(actual) == sorted(expected)
+
+
+def test_gethostbyname_caches_answers():
+    with contextlib.nested(
+        mock.patch('paasta_tools.monitoring.replication_utils.socket.gethostbyname', autospec=True,
+                   return_value='10.0.0.1'),
+        mock.patch('paasta_tools.monitoring.replication_utils.time.time', autospec=True),
+        mock.patch.object(replication_utils, '_dns_cache', {}),
+    ) as (
+        mock_gethostbyname,
+        mock_time,
+        _,
+    ):
+        mock_time.return_value = 1000
+        assert replication_utils.gethostbyname('box1', ttl=60) == '10.0.0.1'
+        mock_time.return_value = 1059
+        assert replication_utils.gethostbyname('box1', ttl=60) == '10.0.0.1'
+        assert mock_gethostbyname.call_count == 1
+        mock_time.return_value = 1060
+        replication_utils.gethostbyname('box1', ttl=60)
+        assert mock_gethostbyname.call_count == 2
+
+
+def test_resolve_hostnames_resolves_each_host_once():
+    def fake_gethostbyname(hostname):
+        if hostname == 'unknown_box':
+            raise socket.gaierror()
+        return '10.0.0.%s' % hostname[-1]
+
+    with contextlib.nested(
+        mock.patch('paasta_tools.monitoring.replication_utils.socket.gethostbyname', autospec=True,
+                   side_effect=fake_gethostbyname),
+        mock.patch.object(replication_utils, '_dns_cache', {}),
+    ) as (
+        mock_gethostbyname,
+        _,
+    ):
+        replication_utils.resolve_hostnames(['box1', 'box2', 'box1', 'unknown_box'])
+        assert mock_gethostbyname.call_count == 3
+        assert replication_utils.gethostbyname('box1') == '10.0.0.1'
+        assert replication_utils.gethostbyname('box2') == '10.0.0.2'
+        assert mock_gethostbyname.call_count == 3
+
+        replication_utils.resolve_hostnames(['box1', 'box2'])
+        assert mock_gethostbyname.call_count == 3
+
+
+def test_match_backends_and_tasks_pre_resolves():
+    tasks = [mock.Mock(host='box1', ports=[31000]), mock.Mock(host='box2', ports=[31000])]
+    backends = [{"pxname": "servicename.main", "svname": "10.0.0.1:31000_box1", "status": "UP"}]
+    with contextlib.nested(
+        mock.patch('paasta_tools.monitoring.replication_utils.resolve_hostnames', autospec=True),
+        mock.patch('paasta_tools.monitoring.replication_utils.gethostbyname', autospec=True,
+                   side_effect=lambda hostname: '10.0.0.%s' % hostname[-1]),
+    ) as (
+        mock_resolve_hostnames,
+        _,
+    ):
+        actual = match_backends_and_tasks(backends, iter(tasks), pre_resolve=True)
+        assert list(mock_resolve_hostnames.call_args[0][0]) == ['box1', 'box2']
+    assert actual == [(backends[0], tasks[0]), (None, tasks[1])]
@@ -14,8 +14,16 @@
 
 import contextlib
 import datetime
+import logging
 import mock
 import marathon
+import threading
+
+from kazoo.exceptions import BadVersionError
+from kazoo.exceptions import LockTimeout
+from kazoo.exceptions import NoNodeError
+from kazoo.exceptions import SessionExpiredError
+from pytest import raises
 
 from paasta_tools import bounce_lib
 from paasta_tools.smartstack_tools import DEFAULT_SYNAPSE_PORT
@@ -47,31 +55,250 @@ class TestBounceLib:
     def test_bounce_lock_zookeeper(self):
         lock_name = 'watermelon'
         fake_lock = mock.Mock()
-        fake_zk = mock.MagicMock(Lock=mock.Mock(return_value=fake_lock))
-        fake_zk_hosts = 'awjti42ior'
+        fake_zk = mock.MagicMock(Lock=mock.Mock(return_value=fake_lock), get=mock.Mock(side_effect=NoNodeError))
         with contextlib.nested(
-            mock.patch('paasta_tools.bounce_lib.KazooClient', return_value=fake_zk, autospec=True),
-            mock.patch(
-                'paasta_tools.bounce_lib.load_system_paasta_config',
-                return_value=mock.Mock(
-                    get_zk_hosts=lambda: fake_zk_hosts
-                ),
-                autospec=True,
-            ),
+            mock.patch('paasta_tools.bounce_lib.get_zookeeper_client', return_value=fake_zk, autospec=True),
+            mock.patch('paasta_tools.bounce_lib.get_lost_zookeeper_sessions', return_value=0, autospec=True),
         ) as (
             client_patch,
-            hosts_patch,
+            _,
         ):
             with bounce_lib.bounce_lock_zookeeper(lock_name):
                 pass
-            hosts_patch.assert_called_once_with()
-            client_patch.assert_called_once_with(hosts=fake_zk_hosts,
-                                                 timeout=bounce_lib.ZK_LOCK_CONNECT_TIMEOUT_S)
-            fake_zk.start.assert_called_once_with()
+            client_patch.assert_called_once_with(timeout=bounce_lib.ZK_LOCK_CONNECT_TIMEOUT_S)
+            fake_zk.Lock.assert_called_once_with('%s/%s' % (bounce_lib.ZK_LOCK_PATH, lock_name))
+            fake_lock.acquire.assert_called_once_with(timeout=1)
+            fake_lock.release.assert_called_once_with()
+            assert fake_zk.stop.call_count == 0
+
+    def test_bounce_lock_zookeeper_with_existing_client(self):
+        lock_name = 'watermelon'
+        fake_lock = mock.Mock()
+        fake_zk = mock.MagicMock(Lock=mock.Mock(return_value=fake_lock))
+        with mock.patch('paasta_tools.bounce_lib.get_zookeeper_client', autospec=True) as client_patch:
+            with bounce_lib.bounce_lock_zookeeper(lock_name, zk=fake_zk):
+                pass
+            assert client_patch.call_count == 0
             fake_zk.Lock.assert_called_once_with('%s/%s' % (bounce_lib.ZK_LOCK_PATH, lock_name))
             fake_lock.acquire.assert_called_once_with(timeout=1)
             fake_lock.release.assert_called_once_with()
-            fake_zk.stop.assert_called_once_with()
+            assert fake_zk.start.call_count == 0
+            assert fake_zk.stop.call_count == 0
+
+    def test_bounce_lock_zookeeper_held(self):
+        fake_lock = mock.Mock()
+        fake_lock.acquire.side_effect = LockTimeout
+        fake_zk = mock.MagicMock(Lock=mock.Mock(return_value=fake_lock))
+        with raises(bounce_lib.LockHeldException):
+            with bounce_lib.bounce_lock_zookeeper('watermelon', zk=fake_zk):
+                pass
+        assert fake_lock.release.call_count == 0
+
+    def test_bounce_lock_zookeeper_survives_lost_session(self):
+        fake_lock = mock.Mock()
+        fake_lock.release.side_effect = SessionExpiredError
+        fake_zk = mock.MagicMock(Lock=mock.Mock(return_value=fake_lock))
+        with contextlib.nested(
+            mock.patch('paasta_tools.bounce_lib.get_lost_zookeeper_sessions', side_effect=[0, 0, 1], autospec=True),
+            mock.patch('paasta_tools.bounce_lib.log', autospec=True),
+        ) as (
+            _,
+            log_patch,
+        ):
+            with bounce_lib.bounce_lock_zookeeper('watermelon', zk=fake_zk):
+                pass
+            assert log_patch.error.call_count == 1
+            assert log_patch.warning.call_count == 1
+        fake_lock.release.assert_called_once_with()
+
+    def test_bounce_lock_zookeeper_flags_lost_session(self):
+        fake_zk = mock.MagicMock()
+        with mock.patch('paasta_tools.bounce_lib.get_lost_zookeeper_sessions', return_value=0, autospec=True):
+            with bounce_lib.bounce_lock_zookeeper('watermelon', zk=fake_zk):
+                bounce_lib.check_zookeeper_locks()
+                listener = fake_zk.add_listener.call_args[0][0]
+                listener(bounce_lib.KazooState.SUSPENDED)
+                bounce_lib.check_zookeeper_locks()
+                listener(bounce_lib.KazooState.LOST)
+                with raises(bounce_lib.LockLostException):
+                    bounce_lib.check_zookeeper_locks()
+        fake_zk.remove_listener.assert_called_once_with(listener)
+        # Once the lock is released, nothing is left to lose
+        bounce_lib.check_zookeeper_locks()
+
+    def test_bounce_lock_zookeeper_flags_session_lost_before_listening(self):
+        fake_zk = mock.MagicMock()
+        with mock.patch('paasta_tools.bounce_lib.get_lost_zookeeper_sessions', side_effect=[0, 1, 1], autospec=True):
+            with bounce_lib.bounce_lock_zookeeper('watermelon', zk=fake_zk):
+                with raises(bounce_lib.LockLostException):
+                    bounce_lib.check_zookeeper_locks()
+
+    def test_kill_old_ids_stops_once_lock_is_lost(self):
+        with contextlib.nested(
+            mock.patch('paasta_tools.bounce_lib.delete_marathon_app', autospec=True),
+            mock.patch('paasta_tools.bounce_lib.check_zookeeper_locks', autospec=True,
+                       side_effect=[None, bounce_lib.LockLostException]),
+        ) as (delete_marathon_app_patch, _):
+            with raises(bounce_lib.LockLostException):
+                bounce_lib.kill_old_ids(['app1', 'app2'], mock.Mock())
+        assert delete_marathon_app_patch.call_count == 1
+
+    def test_create_app_lock_shares_zookeeper_client(self):
+        fake_lock = mock.Mock()
+        fake_zk = mock.MagicMock(Lock=mock.Mock(return_value=fake_lock), get=mock.Mock(side_effect=NoNodeError))
+        with contextlib.nested(
+            mock.patch('paasta_tools.bounce_lib.get_zookeeper_client', return_value=fake_zk, autospec=True),
+            mock.patch('paasta_tools.bounce_lib.get_lost_zookeeper_sessions', return_value=0, autospec=True),
+        ) as (
+            client_patch,
+            _,
+        ):
+            with bounce_lib.bounce_lock_zookeeper('watermelon'):
+                with bounce_lib.create_app_lock(leases=1):
+                    pass
+            assert client_patch.call_count == 2
+            assert fake_zk.Lock.call_args_list == [
+                mock.call('%s/watermelon' % bounce_lib.ZK_LOCK_PATH),
+                mock.call(bounce_lib.CREATE_APP_LOCK_PATH),
+            ]
+            assert fake_zk.Semaphore.call_count == 0
+            assert fake_zk.start.call_count == 0
+            assert fake_zk.stop.call_count == 0
+
+    def test_create_app_lock(self):
+        fake_semaphore = mock.Mock()
+        fake_zk = mock.MagicMock(
+            Semaphore=mock.Mock(return_value=fake_semaphore),
+            get=mock.Mock(side_effect=NoNodeError),
+            get_children=mock.Mock(return_value=[]),
+        )
+        with contextlib.nested(
+            mock.patch('paasta_tools.bounce_lib.load_system_paasta_config', autospec=True),
+            mock.patch('paasta_tools.bounce_lib.log_app_creation_lease_timing', autospec=True),
+        ) as (
+            load_system_paasta_config_patch,
+            log_app_creation_lease_timing_patch,
+        ):
+            load_system_paasta_config_patch.return_value.get_marathon_app_creation_leases.return_value = 3
+            with bounce_lib.create_app_lock(zk=fake_zk):
+                assert fake_semaphore.release.call_count == 0
+            fake_zk.create.assert_called_once_with(bounce_lib.CREATE_APP_SEMAPHORE_PATH, '3', makepath=True)
+            fake_zk.Semaphore.assert_called_once_with(bounce_lib.CREATE_APP_SEMAPHORE_PATH, max_leases=3)
+            fake_semaphore.acquire.assert_called_once_with(timeout=bounce_lib.CREATE_APP_LOCK_TIMEOUT_S)
+            fake_semaphore.release.assert_called_once_with()
+            assert [c[0][0] for c in log_app_creation_lease_timing_patch.call_args_list] == ['wait', 'hold']
+            assert log_app_creation_lease_timing_patch.call_args[0][2] == 3
+
+    def test_create_app_lock_timeout(self):
+        fake_semaphore = mock.Mock()
+        fake_semaphore.acquire.side_effect = LockTimeout
+        fake_zk = mock.MagicMock(
+            Semaphore=mock.Mock(return_value=fake_semaphore),
+            get=mock.Mock(side_effect=NoNodeError),
+            get_children=mock.Mock(return_value=[]),
+        )
+        with mock.patch('paasta_tools.bounce_lib.log_app_creation_lease_timing', autospec=True) as timing_patch:
+            with raises(bounce_lib.LockHeldException):
+                with bounce_lib.create_app_lock(zk=fake_zk, leases=2):
+                    pass
+            assert timing_patch.call_args[0][0] == 'wait_timeout'
+        assert fake_semaphore.release.call_count == 0
+
+    def test_get_app_creation_leases_raises_stored_count(self):
+        fake_zk = mock.Mock(
+            get=mock.Mock(return_value=('2', mock.Mock(version=7))),
+            get_children=mock.Mock(return_value=[]),
+        )
+        assert bounce_lib.get_app_creation_leases(fake_zk, 4) == 4
+        fake_zk.set.assert_called_once_with(bounce_lib.CREATE_APP_SEMAPHORE_PATH, '4', version=7)
+
+    def test_get_app_creation_leases_lowers_stored_count(self):
+        fake_zk = mock.MagicMock(
+            get=mock.Mock(return_value=('3', mock.Mock(version=7))),
+            get_children=mock.Mock(return_value=[]),
+        )
+        with mock.patch('paasta_tools.bounce_lib.log_app_creation_lease_timing', autospec=True):
+            with bounce_lib.create_app_lock(zk=fake_zk, leases=1):
+                pass
+        fake_zk.set.assert_called_once_with(bounce_lib.CREATE_APP_SEMAPHORE_PATH, '1', version=7)
+        fake_zk.Lock.assert_called_once_with('%s/create_marathon_app_lock' % bounce_lib.ZK_LOCK_PATH)
+        assert fake_zk.Semaphore.call_count == 0
+
+    def test_get_app_creation_leases_unchanged(self):
+        fake_zk = mock.Mock(get=mock.Mock(side_effect=NoNodeError))
+        assert bounce_lib.get_app_creation_leases(fake_zk, 1) == 1
+        fake_zk.get.return_value, fake_zk.get.side_effect = ('3', mock.Mock(version=7)), None
+        assert bounce_lib.get_app_creation_leases(fake_zk, 3) == 3
+        assert fake_zk.get_children.call_count == 0
+        assert fake_zk.set.call_count == 0
+        assert fake_zk.create.call_count == 0
+
+    def test_get_app_creation_leases_keeps_stored_count_while_held(self):
+        fake_zk = mock.Mock(get=mock.Mock(return_value=('4', mock.Mock(version=7))))
+        fake_zk.get_children.side_effect = lambda path: (
+            ['lease'] if path == bounce_lib.CREATE_APP_SEMAPHORE_PATH else []
+        )
+        assert bounce_lib.get_app_creation_leases(fake_zk, 1) == 4
+        assert fake_zk.set.call_count == 0
+
+    def test_get_app_creation_leases_does_not_create_semaphore_while_lock_held(self):
+        fake_zk = mock.Mock(get=mock.Mock(side_effect=NoNodeError))
+        fake_zk.get_children.side_effect = lambda path: ['lock'] if path == bounce_lib.CREATE_APP_LOCK_PATH else []
+        assert bounce_lib.get_app_creation_leases(fake_zk, 3) == 1
+        assert fake_zk.create.call_count == 0
+
+    def test_get_app_creation_leases_changed_by_another_host(self):
+        fake_zk = mock.Mock(
+            get=mock.Mock(return_value=('2', mock.Mock(version=7))),
+            get_children=mock.Mock(return_value=[]),
+            set=mock.Mock(side_effect=BadVersionError),
+        )
+        assert bounce_lib.get_app_creation_leases(fake_zk, 4) == 2
+
+    def test_log_app_creation_lease_timing_at_default_verbosity(self):
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        root_logger = logging.getLogger()
+        with contextlib.nested(
+            mock.patch.object(root_logger, 'level', logging.WARNING),
+            mock.patch.object(logging.getLogger('__main__'), 'level', logging.WARNING),
+        ):
+            root_logger.addHandler(handler)
+            try:
+                bounce_lib.log_app_creation_lease_timing('wait', 1.5, 2)
+            finally:
+                root_logger.removeHandler(handler)
+        assert [record.getMessage() for record in records] == ['create_app_lock wait_s=1.500 leases=2']
+
+    def test_create_app_lock_leases_changed_while_waiting(self):
+        fake_zk = mock.MagicMock(get=mock.Mock(return_value=('2', mock.Mock())))
+        fake_zk.Semaphore.return_value.acquire.side_effect = ValueError('Inconsistent max leases')
+        with raises(bounce_lib.LockHeldException):
+            with bounce_lib.create_app_lock(zk=fake_zk, leases=2):
+                pass
+        assert fake_zk.Semaphore.return_value.release.call_count == 0
+
+    def test_time_limit_outside_main_thread(self):
+        results = []
+
+        def run():
+            with mock.patch('time.time', return_value=1000):
+                with bounce_lib.time_limit(1):
+                    bounce_lib.check_time_limit()
+                    results.append('within limit')
+                    with mock.patch('time.time', return_value=1061):
+                        try:
+                            bounce_lib.check_time_limit()
+                        except bounce_lib.TimeoutException:
+                            results.append('timed out')
+            bounce_lib.check_time_limit()
+            results.append('limit cleared')
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        thread.join()
+        assert results == ['within limit', 'timed out', 'limit cleared']
 
     def test_create_marathon_app(self):
         marathon_client_mock = mock.create_autospec(marathon.MarathonClient)
@@ -80,17 +307,20 @@ class TestBounceLib:
         with contextlib.nested(
             mock.patch('paasta_tools.bounce_lib.create_app_lock', spec=contextlib.contextmanager),
             mock.patch('paasta_tools.bounce_lib.wait_for_create'),
+            mock.patch('paasta_tools.marathon_tools.MarathonEventStream', autospec=True),
         ) as (
             lock_patch,
             wait_patch,
+            stream_patch,
         ):
+            stream_patch.return_value.__enter__.return_value = stream_patch.return_value
             bounce_lib.create_marathon_app('fake_creation', fake_config, fake_client)
             assert lock_patch.called
             assert fake_client.create_app.call_count == 1
             actual_call_args = fake_client.create_app.call_args
             actual_config = actual_call_args[0][1]
             assert actual_config.id == 'fake_creation'
-            wait_patch.assert_called_once_with(fake_config['id'], fake_client)
+            wait_patch.assert_called_once_with(fake_config['id'], fake_client, stream_patch.return_value)
 
     def test_delete_marathon_app(self):
         fake_client = mock.Mock(delete_app=mock.Mock())
@@ -98,17 +328,20 @@ class TestBounceLib:
         with contextlib.nested(
             mock.patch('paasta_tools.bounce_lib.create_app_lock', spec=contextlib.contextmanager),
             mock.patch('paasta_tools.bounce_lib.wait_for_delete'),
+            mock.patch('paasta_tools.marathon_tools.MarathonEventStream', autospec=True),
             mock.patch('time.sleep')
         ) as (
             lock_patch,
             wait_patch,
+            stream_patch,
             sleep_patch
         ):
+            stream_patch.return_value.__enter__.return_value = stream_patch.return_value
             bounce_lib.delete_marathon_app(fake_id, fake_client)
             fake_client.scale_app.assert_called_once_with(fake_id, instances=0, force=True)
             fake_client.delete_app.assert_called_once_with(fake_id, force=True)
             sleep_patch.assert_called_once_with(1)
-            wait_patch.assert_called_once_with(fake_id, fake_client)
+            wait_patch.assert_called_once_with(fake_id, fake_client, stream_patch.return_value)
             assert lock_patch.called
 
     def test_kill_old_ids(self):
@@ -120,75 +353,151 @@ class TestBounceLib:
                 delete_patch.assert_any_call(old_id, fake_client)
             assert delete_patch.call_count == len(old_ids)
 
+    def test_kill_tasks_in_bulk(self):
+        fake_tasks = [mock.Mock(id='fake_task_1', app_id='fake_app'), mock.Mock(id='fake_task_2', app_id='fake_app')]
+        fake_client = mock.Mock()
+        with mock.patch('paasta_tools.marathon_tools.kill_given_tasks', autospec=True) as kill_given_tasks_patch:
+            assert bounce_lib.kill_tasks(fake_tasks, fake_client) == {}
+        kill_given_tasks_patch.assert_called_once_with(fake_client, ['fake_task_1', 'fake_task_2'], scale=True)
+        assert fake_client.kill_task.call_count == 0
+
+    def test_kill_tasks_reports_failures_per_task(self):
+        fake_task_1 = mock.Mock(id='fake_task_1', app_id='fake_app')
+        fake_task_2 = mock.Mock(id='fake_task_2', app_id='fake_app')
+        fake_error = marathon.MarathonError('no such task')
+        fake_client = mock.Mock()
+        fake_client.kill_task.side_effect = [None, fake_error]
+        with mock.patch(
+            'paasta_tools.marathon_tools.kill_given_tasks',
+            autospec=True,
+            side_effect=marathon.MarathonError('bulk kill failed'),
+        ):
+            assert bounce_lib.kill_tasks([fake_task_1, fake_task_2], fake_client) == {fake_task_2: fake_error}
+        fake_client.kill_task.assert_any_call('fake_app', 'fake_task_1', scale=True)
+        fake_client.kill_task.assert_any_call('fake_app', 'fake_task_2', scale=True)
+
+    def test_kill_tasks_nothing_to_kill(self):
+        fake_client = mock.Mock()
+        with mock.patch('paasta_tools.marathon_tools.kill_given_tasks', autospec=True) as kill_given_tasks_patch:
+            assert bounce_lib.kill_tasks(set(), fake_client) == {}
+        assert kill_given_tasks_patch.call_count == 0
+
     def test_wait_for_create_slow(self):
         fake_id = 'my_created'
         fake_client = mock.Mock(spec='paasta_tools.setup_marathon_job.MarathonClient')
-        fake_is_app_running_values = [False, False, True]
+        fake_is_app_present_values = [False, False, True]
         with contextlib.nested(
-            mock.patch('paasta_tools.marathon_tools.is_app_id_running'),
+            mock.patch('paasta_tools.marathon_tools.is_app_id_present'),
             mock.patch('time.sleep'),
         ) as (
-            is_app_id_running_patch,
+            is_app_id_present_patch,
             sleep_patch,
         ):
-            is_app_id_running_patch.side_effect = fake_is_app_running_values
+            is_app_id_present_patch.side_effect = fake_is_app_present_values
             bounce_lib.wait_for_create(fake_id, fake_client)
         assert sleep_patch.call_count == 2
-        assert is_app_id_running_patch.call_count == 3
+        assert is_app_id_present_patch.call_count == 3
 
     def test_wait_for_create_fast(self):
         fake_id = 'my_created'
         fake_client = mock.Mock(spec='paasta_tools.setup_marathon_job.MarathonClient')
-        fake_is_app_running_values = [True]
+        fake_is_app_present_values = [True]
         with contextlib.nested(
-            mock.patch('paasta_tools.marathon_tools.is_app_id_running'),
+            mock.patch('paasta_tools.marathon_tools.is_app_id_present'),
             mock.patch('time.sleep'),
         ) as (
-            is_app_id_running_patch,
+            is_app_id_present_patch,
             sleep_patch,
         ):
-            is_app_id_running_patch.side_effect = fake_is_app_running_values
+            is_app_id_present_patch.side_effect = fake_is_app_present_values
             bounce_lib.wait_for_create(fake_id, fake_client)
         assert sleep_patch.call_count == 0
-        assert is_app_id_running_patch.call_count == 1
+        assert is_app_id_present_patch.call_count == 1
 
     def test_wait_for_delete_slow(self):
         fake_id = 'my_deleted'
         fake_client = mock.Mock(spec='paasta_tools.setup_marathon_job.MarathonClient')
-        fake_is_app_running_values = [True, True, False]
+        fake_is_app_present_values = [True, True, False]
         with contextlib.nested(
-            mock.patch('paasta_tools.marathon_tools.is_app_id_running'),
+            mock.patch('paasta_tools.marathon_tools.is_app_id_present'),
             mock.patch('time.sleep'),
         ) as (
-            is_app_id_running_patch,
+            is_app_id_present_patch,
             sleep_patch,
         ):
-            is_app_id_running_patch.side_effect = fake_is_app_running_values
+            is_app_id_present_patch.side_effect = fake_is_app_present_values
             bounce_lib.wait_for_delete(fake_id, fake_client)
         assert sleep_patch.call_count == 2
-        assert is_app_id_running_patch.call_count == 3
+        assert is_app_id_present_patch.call_count == 3
 
     def test_wait_for_delete_fast(self):
         fake_id = 'my_deleted'
         fake_client = mock.Mock(spec='paasta_tools.setup_marathon_job.MarathonClient')
-        fake_is_app_running_values = [False]
+        fake_is_app_present_values = [False]
         with contextlib.nested(
-            mock.patch('paasta_tools.marathon_tools.is_app_id_running'),
+            mock.patch('paasta_tools.marathon_tools.is_app_id_present'),
             mock.patch('time.sleep'),
         ) as (
-            is_app_id_running_patch,
+            is_app_id_present_patch,
             sleep_patch,
         ):
-            is_app_id_running_patch.side_effect = fake_is_app_running_values
+            is_app_id_present_patch.side_effect = fake_is_app_present_values
             bounce_lib.wait_for_delete(fake_id, fake_client)
         assert sleep_patch.call_count == 0
-        assert is_app_id_running_patch.call_count == 1
+        assert is_app_id_present_patch.call_count == 1
+
+    def test_wait_for_create_with_events(self):
+        fake_id = 'my_created'
+        fake_client = mock.Mock(spec='paasta_tools.setup_marathon_job.MarathonClient')
+        fake_events = mock.Mock()
+        with contextlib.nested(
+            mock.patch('paasta_tools.marathon_tools.is_app_id_present', side_effect=[False, True]),
+            mock.patch('time.sleep'),
+        ) as (
+            is_app_id_present_patch,
+            sleep_patch,
+        ):
+            bounce_lib.wait_for_create(fake_id, fake_client, fake_events)
+        fake_events.wait_for_app_event.assert_called_once_with(fake_id, bounce_lib.WAIT_CREATE_S)
+        assert sleep_patch.call_count == 0
+        assert is_app_id_present_patch.call_count == 2
+
+    def test_wait_for_delete_with_events(self):
+        fake_id = 'my_deleted'
+        fake_client = mock.Mock(spec='paasta_tools.setup_marathon_job.MarathonClient')
+        fake_events = mock.Mock()
+        with contextlib.nested(
+            mock.patch('paasta_tools.marathon_tools.is_app_id_present', side_effect=[True, True, False]),
+            mock.patch('time.sleep'),
+        ) as (
+            is_app_id_present_patch,
+            sleep_patch,
+        ):
+            bounce_lib.wait_for_delete(fake_id, fake_client, fake_events)
+        assert fake_events.wait_for_app_event.call_count == 2
+        fake_events.wait_for_app_event.assert_called_with(fake_id, bounce_lib.WAIT_DELETE_S)
+        assert sleep_patch.call_count == 0
+        assert is_app_id_present_patch.call_count == 3
 
     def test_get_bounce_method_func(self):
         actual = bounce_lib.get_bounce_method_func('brutal')
         expected = bounce_lib.brutal_bounce
         assert actual == expected
 
+    def test_get_bounce_method_params(self):
+        params = {'max_surge': 2, 'check_haproxy': False, 'min_task_uptime': 30}
+        assert bounce_lib.get_bounce_method_params(bounce_lib.rolling_bounce, params) == (
+            {'max_surge': 2},
+            ['check_haproxy', 'min_task_uptime'],
+        )
+
+    def test_get_bounce_method_params_never_sets_required_args(self):
+        params = {'new_config': {}, 'max_surge': 2}
+        assert bounce_lib.get_bounce_method_params(bounce_lib.crossover_bounce, params) == (
+            {},
+            ['max_surge', 'new_config'],
+        )
+
     def test_get_happy_tasks_when_running_without_healthchecks_defined(self):
         """All running tasks with no health checks results are healthy if the app does not define healthchecks"""
         tasks = [mock.Mock(health_check_results=[]) for _ in xrange(5)]
@@ -289,10 +598,12 @@ class TestBounceLib:
 
         tasks = [mock.Mock(health_check_results=[mock.Mock(alive=True)]) for i in xrange(5)]
         fake_app = mock.Mock(tasks=tasks, health_checks=[])
+        registered_tasks_by_host = {'fake_host1': tasks[2:3], 'fake_host2': tasks[3:]}
         with contextlib.nested(
             mock.patch(
                 'paasta_tools.bounce_lib.get_registered_marathon_tasks',
-                side_effect=[tasks[2:3], tasks[3:]], autospec=True,
+                side_effect=lambda synapse_host, *args: registered_tasks_by_host[synapse_host],
+                autospec=True,
             ),
             mock.patch('paasta_tools.mesos_tools.get_mesos_slaves_grouped_by_attribute', autospec=True),
         ) as (
@@ -331,6 +642,7 @@ class TestBrutalBounce:
             new_app_running=False,
             happy_new_tasks=happy_tasks,
             old_app_live_tasks={},
+            old_app_draining_tasks={},
         ) == {
             "create_app": True,
             "tasks_to_drain": set(),
@@ -349,6 +661,7 @@ class TestBrutalBounce:
             new_app_running=True,
             happy_new_tasks=happy_tasks,
             old_app_live_tasks={},
+            old_app_draining_tasks={},
         ) == {
             "create_app": False,
             "tasks_to_drain": set(),
@@ -370,6 +683,7 @@ class TestBrutalBounce:
             new_app_running=True,
             happy_new_tasks=happy_tasks,
             old_app_live_tasks=old_app_live_tasks,
+            old_app_draining_tasks={},
         ) == {
             "create_app": False,
             "tasks_to_drain": old_app_live_tasks['app1'] | old_app_live_tasks['app2'],
@@ -391,6 +705,7 @@ class TestBrutalBounce:
             new_app_running=False,
             happy_new_tasks=[],
             old_app_live_tasks=old_app_live_tasks,
+            old_app_draining_tasks={},
         ) == {
             "create_app": True,
             "tasks_to_drain": old_app_live_tasks['app1'] | old_app_live_tasks['app2'],
@@ -410,6 +725,7 @@ class TestUpthendownBounce:
             new_app_running=False,
             happy_new_tasks=happy_tasks,
             old_app_live_tasks={},
+            old_app_draining_tasks={},
         ) == {
             "create_app": True,
             "tasks_to_drain": set(),
@@ -431,6 +747,7 @@ class TestUpthendownBounce:
             new_app_running=False,
             happy_new_tasks=[],
             old_app_live_tasks=old_app_live_tasks,
+            old_app_draining_tasks={},
         ) == {
             "create_app": True,
             "tasks_to_drain": set(),
@@ -453,6 +770,7 @@ class TestUpthendownBounce:
             new_app_running=True,
             happy_new_tasks=happy_tasks,
             old_app_live_tasks=old_app_live_tasks,
+            old_app_draining_tasks={},
         ) == {
             "create_app": False,
             "tasks_to_drain": set(),
@@ -475,6 +793,7 @@ class TestUpthendownBounce:
             new_app_running=True,
             happy_new_tasks=happy_tasks,
             old_app_live_tasks=old_app_live_tasks,
+            old_app_draining_tasks={},
         ) == {
             "create_app": False,
             "tasks_to_drain": old_app_live_tasks['app1'] | old_app_live_tasks['app2'],
@@ -494,6 +813,7 @@ class TestUpthendownBounce:
             new_app_running=True,
             happy_new_tasks=happy_tasks,
             old_app_live_tasks=old_app_live_tasks,
+            old_app_draining_tasks={},
         ) == {
             "create_app": False,
             "tasks_to_drain": set(),
@@ -514,6 +834,7 @@ class TestCrossoverBounce:
             new_app_running=False,
             happy_new_tasks=happy_tasks,
             old_app_live_tasks=old_app_live_tasks,
+            old_app_draining_tasks={},
         ) == {
             "create_app": True,
             "tasks_to_drain": set(),
@@ -535,6 +856,7 @@ class TestCrossoverBounce:
             new_app_running=False,
             happy_new_tasks=happy_tasks,
             old_app_live_tasks=old_app_live_tasks,
+            old_app_draining_tasks={},
         ) == {
             "create_app": True,
             "tasks_to_drain": set(),
@@ -556,6 +878,7 @@ class TestCrossoverBounce:
             new_app_running=True,
             happy_new_tasks=happy_tasks,
             old_app_live_tasks=old_app_live_tasks,
+            old_app_draining_tasks={},
         )
 
         assert actual['create_app'] is False
@@ -578,6 +901,7 @@ class TestCrossoverBounce:
             new_app_running=True,
             happy_new_tasks=happy_tasks,
             old_app_live_tasks=old_app_live_tasks,
+            old_app_draining_tasks={},
         ) == {
             "create_app": False,
             "tasks_to_drain": set(),
@@ -597,9 +921,152 @@ class TestCrossoverBounce:
             new_app_running=True,
             happy_new_tasks=happy_tasks,
             old_app_live_tasks=old_app_live_tasks,
+            old_app_draining_tasks={},
+        ) == {
+            "create_app": False,
+            "tasks_to_drain": set(),
+        }
+
+
+class TestRollingBounce(object):
+
+    def test_get_bounce_margin(self):
+        assert bounce_lib.get_bounce_margin(3, 10, round_up=True) == 3
+        assert bounce_lib.get_bounce_margin(30, 10, round_up=True) == 10
+        assert bounce_lib.get_bounce_margin('25%', 10, round_up=True) == 3
+        assert bounce_lib.get_bounce_margin('25%', 10, round_up=False) == 2
+        assert bounce_lib.get_bounce_margin('0%', 10, round_up=True) == 0
+
+    def test_rolling_bounce_no_existing_apps(self):
+        """When marathon is unaware of a service, rolling bounce should create the new app at full size."""
+        new_config = {'id': 'foo.bar.12345', 'instances': 5}
+
+        assert bounce_lib.rolling_bounce(
+            new_config=new_config,
+            new_app_running=False,
+            happy_new_tasks=[],
+            old_app_live_tasks={},
+            old_app_draining_tasks={},
+        ) == {
+            "create_app": True,
+            "tasks_to_drain": set(),
+            "new_app_instances": 5,
+        }
+
+    def test_rolling_bounce_old_but_no_new(self):
+        """When marathon only has old apps for this service, rolling bounce should start the new app with only
+        max_surge instances, and drain up to max_unavailable old tasks."""
+        new_config = {'id': 'foo.bar.12345', 'instances': 10}
+        old_tasks = [mock.Mock(id='old%d' % i) for i in xrange(10)]
+        old_app_live_tasks = {
+            'app1': set(old_tasks[:6]),
+            'app2': set(old_tasks[6:]),
+        }
+
+        actual = bounce_lib.rolling_bounce(
+            new_config=new_config,
+            new_app_running=False,
+            happy_new_tasks=[],
+            old_app_live_tasks=old_app_live_tasks,
+            old_app_draining_tasks={},
+            max_surge=3,
+            max_unavailable='20%',
+        )
+
+        assert actual['create_app'] is True
+        assert actual['new_app_instances'] == 3
+        assert actual['tasks_to_drain'] == set(old_tasks[8:])
+
+    def test_rolling_bounce_mid_bounce(self):
+        """When some new tasks are happy, rolling bounce should drain as many old tasks as it can while keeping
+        instances - max_unavailable tasks up, and let the new app grow into the room left by drained tasks."""
+        new_config = {'id': 'foo.bar.12345', 'instances': 10}
+        happy_tasks = [mock.Mock() for _ in xrange(4)]
+        old_tasks = [mock.Mock(id='old%d' % i) for i in xrange(7)]
+
+        actual = bounce_lib.rolling_bounce(
+            new_config=new_config,
+            new_app_running=True,
+            happy_new_tasks=happy_tasks,
+            old_app_live_tasks={'app1': set(old_tasks)},
+            old_app_draining_tasks={},
+            max_surge=2,
+            max_unavailable=1,
+        )
+
+        assert actual['create_app'] is False
+        assert actual['new_app_instances'] == 5
+        assert actual['tasks_to_drain'] == set(old_tasks[5:])
+
+    def test_rolling_bounce_counts_draining_tasks_against_surge(self):
+        """Old tasks which are draining still run until they are killed, so the new app must not grow into their
+        room yet."""
+        new_config = {'id': 'foo.bar.12345', 'instances': 10}
+        happy_tasks = [mock.Mock() for _ in xrange(3)]
+        old_tasks = [mock.Mock(id='old%d' % i) for i in xrange(10)]
+
+        actual = bounce_lib.rolling_bounce(
+            new_config=new_config,
+            new_app_running=True,
+            happy_new_tasks=happy_tasks,
+            old_app_live_tasks={'app1': set(old_tasks[:7])},
+            old_app_draining_tasks={'app1': set(old_tasks[7:])},
+            max_surge=3,
+        )
+
+        assert actual['new_app_instances'] == 3
+        assert actual['tasks_to_drain'] == set()
+
+    def test_rolling_bounce_defaults(self):
+        """By default rolling bounce never drops below instances, and surges by 25% of instances."""
+        new_config = {'id': 'foo.bar.12345', 'instances': 10}
+        happy_tasks = [mock.Mock() for _ in xrange(3)]
+        old_tasks = [mock.Mock(id='old%d' % i) for i in xrange(10)]
+
+        actual = bounce_lib.rolling_bounce(
+            new_config=new_config,
+            new_app_running=True,
+            happy_new_tasks=happy_tasks,
+            old_app_live_tasks={'app1': set(old_tasks)},
+            old_app_draining_tasks={},
+        )
+
+        assert actual['new_app_instances'] == 3
+        assert actual['tasks_to_drain'] == set(old_tasks[7:])
+
+    def test_rolling_bounce_always_makes_progress(self):
+        """A max_surge and max_unavailable of 0 would never replace any task, so a surge of 1 is used instead."""
+        new_config = {'id': 'foo.bar.12345', 'instances': 5}
+        old_tasks = [mock.Mock(id='old%d' % i) for i in xrange(5)]
+
+        actual = bounce_lib.rolling_bounce(
+            new_config=new_config,
+            new_app_running=False,
+            happy_new_tasks=[],
+            old_app_live_tasks={'app1': set(old_tasks)},
+            old_app_draining_tasks={},
+            max_surge=0,
+            max_unavailable=0,
+        )
+
+        assert actual['new_app_instances'] == 1
+        assert actual['tasks_to_drain'] == set()
+
+    def test_rolling_bounce_done(self):
+        """When all old tasks are gone, rolling bounce should scale the new app up to full size."""
+        new_config = {'id': 'foo.bar.12345', 'instances': 5}
+        happy_tasks = [mock.Mock() for _ in xrange(4)]
+
+        assert bounce_lib.rolling_bounce(
+            new_config=new_config,
+            new_app_running=True,
+            happy_new_tasks=happy_tasks,
+            old_app_live_tasks={'app1': set()},
+            old_app_draining_tasks={},
         ) == {
             "create_app": False,
             "tasks_to_drain": set(),
+            "new_app_instances": 5,
         }
 
 
@@ -617,6 +1084,7 @@ class TestDownThenUpBounce(object):
             new_app_running=False,
             happy_new_tasks=happy_tasks,
             old_app_live_tasks=old_app_live_tasks,
+            old_app_draining_tasks={},
         ) == {
             "create_app": True,
             "tasks_to_drain": set(),
@@ -637,6 +1105,7 @@ class TestDownThenUpBounce(object):
             new_app_running=False,
             happy_new_tasks=happy_tasks,
             old_app_live_tasks=old_app_live_tasks,
+            old_app_draining_tasks={},
         ) == {
             "create_app": False,
             "tasks_to_drain": old_app_live_tasks['app1'] | old_app_live_tasks['app2'],
@@ -655,6 +1124,7 @@ class TestDownThenUpBounce(object):
             new_app_running=True,
             happy_new_tasks=happy_tasks,
             old_app_live_tasks=old_app_live_tasks,
+            old_app_draining_tasks={},
         ) == {
             "create_app": False,
             "tasks_to_drain": set(),
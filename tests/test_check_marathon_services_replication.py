@@ -12,6 +12,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import collections
 import mock
 import contextlib
 
@@ -520,6 +521,7 @@ def test_check_service_replication_for_normal_smartstack():
             soa_dir=None,
             crit_threshold=None,
             expected_count=100,
+            replication_checker=None,
         )
 
 
@@ -549,7 +551,8 @@ def test_check_service_replication_for_non_smartstack():
             cluster=cluster,
             soa_dir=None,
             crit_threshold=None,
-            expected_count=100)
+            expected_count=100,
+            task_index=None)
 
 
 def test_get_healthy_marathon_instances_for_short_app_id_correctly_counts_alive_tasks():
@@ -593,6 +596,26 @@ def test_get_healthy_marathon_instances_for_short_app_id_considers_new_tasks_not
     assert actual == 3
 
 
+def test_get_healthy_marathon_instances_for_short_app_id_uses_task_index():
+    fake_client = mock.Mock()
+    fakes = []
+    for app_id in ['/service.instance.foo.bar', '/service.instance2.foo.bar', '/other.instance.foo.bar']:
+        fake_task = mock.Mock()
+        fake_task.app_id = app_id
+        fake_task.started_at = datetime.now() - timedelta(minutes=2)
+        fake_task.health_check_results = []
+        fakes.append(fake_task)
+    task_index = check_marathon_services_replication.marathon_tools.MarathonTaskIndex(fakes)
+    actual = check_marathon_services_replication.get_healthy_marathon_instances_for_short_app_id(
+        fake_client,
+        'service.instance',
+        task_index=task_index,
+    )
+    # '/service.instance2' also starts with '/service.instance', just like without the index
+    assert actual == 2
+    assert fake_client.list_tasks.call_count == 0
+
+
 @mock.patch('paasta_tools.check_marathon_services_replication.send_event_if_under_replication')
 @mock.patch('paasta_tools.check_marathon_services_replication.get_healthy_marathon_instances_for_short_app_id')
 def test_check_healthy_marathon_tasks_for_service_instance(mock_healthy_instances,
@@ -642,6 +665,48 @@ def test_check_service_replication_for_namespace_with_no_deployments():
         assert mock_get_proxy_port_for_instance.call_count == 0
 
 
+def test_check_service_replication_uses_expected_counts():
+    service = 'test_service'
+    instance = 'worker'
+    cluster = 'fake_cluster'
+    with contextlib.nested(
+        mock.patch('paasta_tools.marathon_tools.get_proxy_port_for_instance', autospec=True, return_value=None),
+        mock.patch('paasta_tools.marathon_tools.get_expected_instance_count_for_namespace', autospec=True),
+        mock.patch('paasta_tools.check_marathon_services_replication.check_healthy_marathon_tasks_for_service_instance',
+                   autospec=True),
+    ) as (
+        mock_get_proxy_port_for_instance,
+        mock_get_expected_count,
+        mock_check_healthy_marathon_tasks,
+    ):
+        mock_client = mock.Mock()
+        check_marathon_services_replication.check_service_replication(
+            client=mock_client, service=service, instance=instance, cluster=cluster, crit_threshold=None,
+            soa_dir=None, expected_counts={(service, instance): 7})
+        assert mock_get_expected_count.call_count == 0
+        mock_check_healthy_marathon_tasks.assert_called_once_with(
+            client=mock_client,
+            service=service,
+            instance=instance,
+            cluster=cluster,
+            soa_dir=None,
+            crit_threshold=None,
+            expected_count=7,
+            task_index=None)
+
+
+def test_check_service_replication_missing_from_expected_counts():
+    service = 'test_service'
+    instance = 'worker'
+    cluster = 'fake_cluster'
+    with mock.patch('paasta_tools.marathon_tools.get_proxy_port_for_instance', autospec=True) as \
+            mock_get_proxy_port_for_instance:
+        check_marathon_services_replication.check_service_replication(
+            client=mock.Mock(), service=service, instance=instance, cluster=cluster, crit_threshold=None,
+            soa_dir=None, expected_counts={})
+        assert mock_get_proxy_port_for_instance.call_count == 0
+
+
 def test_send_event_if_under_replication_handles_0_expected():
     service = 'test_service'
     instance = 'worker'
@@ -755,6 +820,56 @@ def test_get_smartstack_replication_for_attribute():
         )
 
 
+def test_smartstack_replication_checker_downloads_each_csv_once():
+    fake_slaves = [
+        {'hostname': 'fake_host_1', 'attributes': {'fake_attribute': 'fake_value_1'}},
+        {'hostname': 'fake_host_2', 'attributes': {'fake_attribute': 'fake_value_2'}},
+        {'hostname': 'fake_host_3', 'attributes': {'fake_attribute': 'fake_value_1'}},
+    ]
+    fake_replication = {
+        'fake_host_1': collections.Counter({'fake_service.main': 2, 'other_service.main': 1}),
+        'fake_host_2': collections.Counter({'fake_service.main': 3}),
+    }
+    with mock.patch(
+        'paasta_tools.monitoring.replication_utils.get_replication_for_all_services',
+        autospec=True,
+        side_effect=lambda synapse_host, synapse_port: fake_replication[synapse_host],
+    ) as mock_get_replication_for_all_services:
+        checker = check_marathon_services_replication.SmartstackReplicationChecker(fake_slaves)
+        assert checker.get_replication_for_attribute(
+            attribute='fake_attribute', service='fake_service', namespace='main', blacklist=[]) == {
+            'fake_value_1': {'fake_service.main': 2},
+            'fake_value_2': {'fake_service.main': 3},
+        }
+        assert checker.get_replication_for_attribute(
+            attribute='fake_attribute', service='other_service', namespace='main', blacklist=[]) == {
+            'fake_value_1': {'other_service.main': 1},
+            'fake_value_2': {'other_service.main': 0},
+        }
+        assert mock_get_replication_for_all_services.call_count == 2
+        mock_get_replication_for_all_services.assert_any_call(
+            synapse_host='fake_host_1',
+            synapse_port=DEFAULT_SYNAPSE_PORT,
+        )
+
+
+def test_smartstack_replication_checker_uses_blacklist():
+    fake_slaves = [
+        {'hostname': 'fake_host_1', 'attributes': {'fake_attribute': 'fake_value_1'}},
+        {'hostname': 'fake_host_2', 'attributes': {'fake_attribute': 'fake_value_2'}},
+    ]
+    with mock.patch(
+        'paasta_tools.monitoring.replication_utils.get_replication_for_all_services',
+        autospec=True,
+        return_value=collections.Counter({'fake_service.main': 2}),
+    ):
+        checker = check_marathon_services_replication.SmartstackReplicationChecker(fake_slaves)
+        actual = checker.get_replication_for_attribute(
+            attribute='fake_attribute', service='fake_service', namespace='main',
+            blacklist=[['fake_attribute', 'fake_value_2']])
+        assert actual == {'fake_value_1': {'fake_service.main': 2}}
+
+
 def test_main():
     soa_dir = 'anw'
     crit = 1
@@ -769,13 +884,20 @@ def test_main():
                    autospec=True),
         mock.patch('paasta_tools.check_marathon_services_replication.load_system_paasta_config',
                    autospec=True),
-        mock.patch('paasta_tools.check_marathon_services_replication.marathon_tools.load_marathon_config')
+        mock.patch('paasta_tools.check_marathon_services_replication.marathon_tools.load_marathon_config'),
+        mock.patch('paasta_tools.marathon_tools.get_expected_instance_counts_by_namespace', autospec=True),
+        mock.patch('paasta_tools.mesos_tools.get_mesos_state_cache', autospec=True,
+                   return_value={'state': {'slaves': []}}),
+        mock.patch('paasta_tools.marathon_tools.get_marathon_client', autospec=True),
     ) as (
         mock_parse_args,
         mock_get_services_for_cluster,
         mock_check_service_replication,
         mock_load_system_paasta_config,
         mock_load_marathon_config,
+        mock_get_expected_counts,
+        mock_get_mesos_state_cache,
+        mock_get_marathon_client,
     ):
         mock_config = mock.Mock()
         mock_load_marathon_config.return_value = mock_config
@@ -784,3 +906,18 @@ def test_main():
         mock_parse_args.assert_called_once_with()
         mock_get_services_for_cluster.assert_called_once_with(
             cluster='fake_cluster', instance_type='marathon', soa_dir=soa_dir)
+        mock_get_expected_counts.assert_called_once_with(services, cluster='fake_cluster', soa_dir=soa_dir)
+        assert mock_check_service_replication.call_count == 3
+        mock_check_service_replication.assert_any_call(
+            client=mock_get_marathon_client.return_value,
+            service='b',
+            instance='main',
+            cluster='fake_cluster',
+            crit_threshold=crit,
+            soa_dir=soa_dir,
+            expected_counts=mock_get_expected_counts.return_value,
+            replication_checker=mock.ANY,
+            task_index=mock.ANY,
+        )
+        assert mock_get_mesos_state_cache.call_count == 1
+        assert mock_get_marathon_client.return_value.list_tasks.call_count == 1
@@ -12,7 +12,10 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import contextlib
+
 import mock
+from pytest import raises
 
 from paasta_tools import drain_lib
 
@@ -27,8 +30,23 @@ def test_register_drain_method():
         assert type(drain_lib.get_drain_method('FAKEDRAINMETHOD', 'srv', 'inst', 'ns')) == FakeDrainMethod
 
 
+def test_get_hacheck_session_grows_pools_for_jobs():
+    with contextlib.nested(
+        mock.patch('paasta_tools.drain_lib._hacheck_session', None),
+        mock.patch('paasta_tools.drain_lib._hacheck_session_pool_maxsize', 0),
+    ):
+        session = drain_lib.get_hacheck_session(4)
+        assert session.get_adapter('http://fake_host')._pool_maxsize == 4
+        assert drain_lib.get_hacheck_session(2) is session
+        bigger_session = drain_lib.get_hacheck_session(32)
+        assert bigger_session.get_adapter('http://fake_host')._pool_maxsize == 32
+        assert drain_lib.get_hacheck_session() is bigger_session
+
+
 class TestHacheckDrainMethod(object):
-    drain_method = drain_lib.HacheckDrainMethod("srv", "inst", "ns", hacheck_port=12345)
+
+    def setup_method(self, method):
+        self.drain_method = drain_lib.HacheckDrainMethod("srv", "inst", "ns", hacheck_port=12345)
 
     def test_spool_url(self):
         fake_task = mock.Mock(host="fake_host", ports=[54321])
@@ -43,8 +61,10 @@ class TestHacheckDrainMethod(object):
             text="Service service in down state since 1435694078.778886 until 1435694178.780000: Drained by Paasta",
         )
         fake_task = mock.Mock(host="fake_host", ports=[54321])
-        with mock.patch('requests.get', return_value=fake_response):
+        with mock.patch('paasta_tools.drain_lib.get_hacheck_session', autospec=True) as session_patch:
+            session_patch.return_value.get.return_value = fake_response
             actual = self.drain_method.get_spool(fake_task)
+        session_patch.assert_called_once_with(drain_lib.DEFAULT_HACHECK_JOBS)
 
         expected = {
             'service': 'service',
@@ -61,7 +81,8 @@ class TestHacheckDrainMethod(object):
             text="Service service in down state since 1435694078.778886 until 1435694178.780000: Drained by Paasta",
         )
         fake_task = mock.Mock(host="fake_host", ports=[54321])
-        with mock.patch('requests.get', return_value=fake_response):
+        with mock.patch('paasta_tools.drain_lib.get_hacheck_session', autospec=True) as session_patch:
+            session_patch.return_value.get.return_value = fake_response
             assert self.drain_method.is_draining(fake_task) is True
 
     def test_is_draining_no(self):
@@ -70,5 +91,98 @@ class TestHacheckDrainMethod(object):
             text="",
         )
         fake_task = mock.Mock(host="fake_host", ports=[54321])
-        with mock.patch('requests.get', return_value=fake_response):
+        with mock.patch('paasta_tools.drain_lib.get_hacheck_session', autospec=True) as session_patch:
+            session_patch.return_value.get.return_value = fake_response
+            assert self.drain_method.is_draining(fake_task) is False
+
+    def test_is_safe_to_kill_many(self):
+        fake_tasks = [mock.Mock(host="fake_host%d" % i, ports=[54321]) for i in range(3)]
+        fake_spools = {
+            fake_tasks[0]: {'state': 'up'},
+            fake_tasks[1]: {'state': 'down', 'since': 1},
+            fake_tasks[2]: {'state': 'down', 'since': 1435694078.778886},
+        }
+        with contextlib.nested(
+            mock.patch.object(self.drain_method, 'get_spool', side_effect=lambda task: fake_spools[task]),
+            mock.patch('time.time', return_value=1435694078.778886 + 60),
+        ) as (get_spool_patch, _):
+            actual = self.drain_method.is_safe_to_kill_many(fake_tasks)
+        assert actual == {fake_tasks[0]: False, fake_tasks[1]: True, fake_tasks[2]: False}
+        assert get_spool_patch.call_count == 3
+
+    def test_is_draining_many(self):
+        fake_tasks = [mock.Mock(host="fake_host%d" % i, ports=[54321]) for i in range(2)]
+        fake_spools = {fake_tasks[0]: {'state': 'up'}, fake_tasks[1]: {'state': 'down'}}
+        with mock.patch.object(self.drain_method, 'get_spool', side_effect=lambda task: fake_spools[task]):
+            assert self.drain_method.is_draining_many(fake_tasks) == {fake_tasks[0]: False, fake_tasks[1]: True}
+
+    def test_drain_many(self):
+        fake_tasks = [mock.Mock(host="fake_host%d" % i, ports=[54321]) for i in range(20)]
+        with mock.patch.object(self.drain_method, 'post_spool') as post_spool_patch:
+            self.drain_method.drain_many(fake_tasks)
+        assert post_spool_patch.call_count == 20
+        for task in fake_tasks:
+            post_spool_patch.assert_any_call(task, 'down')
+
+    def test_map_tasks_raises_failures(self):
+        def fail_on_second(task):
+            if task == 2:
+                raise ValueError('hacheck is down')
+            return task * 2
+
+        with raises(ValueError):
+            self.drain_method.map_tasks(fail_on_second, [1, 2, 3])
+        assert self.drain_method.map_tasks(fail_on_second, [1, 3]) == {1: 2, 3: 6}
+        assert self.drain_method.map_tasks(fail_on_second, []) == {}
+
+    def test_get_spool_is_cached(self):
+        fake_task = mock.Mock(host="fake_host", ports=[54321])
+        with mock.patch.object(self.drain_method, 'fetch_spool', return_value={'state': 'up'}) as fetch_spool_patch:
+            assert self.drain_method.get_spool(fake_task) == {'state': 'up'}
+            assert self.drain_method.is_draining(fake_task) is False
+            assert self.drain_method.is_safe_to_kill(fake_task) is False
+        fetch_spool_patch.assert_called_once_with('http://fake_host:12345/spool/srv.ns/54321/status')
+
+    def test_posting_a_new_status_invalidates_cached_spool(self):
+        fake_task = mock.Mock(host="fake_host", ports=[54321])
+        with contextlib.nested(
+            mock.patch.object(self.drain_method, 'fetch_spool', side_effect=[
+                {'state': 'up'},
+                {'state': 'down', 'since': 1},
+                {'state': 'up'},
+            ]),
+            mock.patch('paasta_tools.drain_lib.get_hacheck_session', autospec=True),
+        ) as (fetch_spool_patch, _):
+            assert self.drain_method.is_draining(fake_task) is False
+            self.drain_method.drain(fake_task)
+            assert self.drain_method.is_draining(fake_task) is True
+            # Re-draining a draining task keeps its cached spool
+            self.drain_method.drain(fake_task)
+            assert self.drain_method.is_safe_to_kill(fake_task) is True
+            assert fetch_spool_patch.call_count == 2
+            self.drain_method.stop_draining(fake_task)
+            assert self.drain_method.is_draining(fake_task) is False
+            assert fetch_spool_patch.call_count == 3
+
+    def test_failed_post_keeps_cached_spool(self):
+        fake_task = mock.Mock(host="fake_host", ports=[54321])
+        with contextlib.nested(
+            mock.patch.object(self.drain_method, 'fetch_spool', return_value={'state': 'up'}),
+            mock.patch('paasta_tools.drain_lib.get_hacheck_session', autospec=True),
+        ) as (fetch_spool_patch, session_patch):
+            session_patch.return_value.post.return_value.raise_for_status.side_effect = ValueError('hacheck is down')
             assert self.drain_method.is_draining(fake_task) is False
+            with raises(ValueError):
+                self.drain_method.drain(fake_task)
+            assert self.drain_method.is_draining(fake_task) is False
+        assert fetch_spool_patch.call_count == 1
+
+
+def test_drain_method_batch_methods_call_per_task_methods():
+    drain_method = drain_lib.TestDrainMethod('srv', 'inst', 'ns')
+    fake_tasks = [mock.Mock(id='fake_task_1'), mock.Mock(id='fake_task_2')]
+    with mock.patch.object(drain_lib.TestDrainMethod, 'downed_task_ids', set()):
+        drain_method.drain_many(fake_tasks)
+        assert drain_method.is_draining_many(fake_tasks) == {fake_tasks[0]: True, fake_tasks[1]: True}
+        drain_method.stop_draining_many(fake_tasks[:1])
+        assert drain_method.is_draining_many(fake_tasks) == {fake_tasks[0]: False, fake_tasks[1]: True}
@@ -22,6 +22,8 @@ import marathon
 import mock
 
 from paasta_tools import marathon_tools, marathon_serviceinit
+from paasta_tools import mesos_tools
+from paasta_tools.monitoring import replication_utils
 from paasta_tools.smartstack_tools import DEFAULT_SYNAPSE_PORT
 from paasta_tools.utils import compose_job_id
 from paasta_tools.utils import NoDockerImageError
@@ -751,9 +753,9 @@ def test_get_short_task_id():
 
 
 def test_status_mesos_tasks_working():
-    with mock.patch('paasta_tools.marathon_serviceinit.get_running_tasks_from_active_frameworks') as mock_tasks:
+    with mock.patch('paasta_tools.mesos_tools.get_current_tasks', autospec=True) as mock_tasks:
         mock_tasks.return_value = [
-            {'id': 1}, {'id': 2}
+            {'id': 1, 'state': 'TASK_RUNNING'}, {'id': 2, 'state': 'TASK_RUNNING'}
         ]
         normal_count = 2
         actual = marathon_serviceinit.status_mesos_tasks('unused', 'unused', normal_count)
@@ -761,9 +763,9 @@ def test_status_mesos_tasks_working():
 
 
 def test_status_mesos_tasks_warning():
-    with mock.patch('paasta_tools.marathon_serviceinit.get_running_tasks_from_active_frameworks') as mock_tasks:
+    with mock.patch('paasta_tools.mesos_tools.get_current_tasks', autospec=True) as mock_tasks:
         mock_tasks.return_value = [
-            {'id': 1}, {'id': 2}
+            {'id': 1, 'state': 'TASK_RUNNING'}, {'id': 2, 'state': 'TASK_RUNNING'}
         ]
         normal_count = 4
         actual = marathon_serviceinit.status_mesos_tasks('unused', 'unused', normal_count)
@@ -771,13 +773,22 @@ def test_status_mesos_tasks_warning():
 
 
 def test_status_mesos_tasks_critical():
-    with mock.patch('paasta_tools.marathon_serviceinit.get_running_tasks_from_active_frameworks') as mock_tasks:
+    with mock.patch('paasta_tools.mesos_tools.get_current_tasks', autospec=True) as mock_tasks:
         mock_tasks.return_value = []
         normal_count = 10
         actual = marathon_serviceinit.status_mesos_tasks('unused', 'unused', normal_count)
         assert 'Critical' in actual
 
 
+def test_status_mesos_tasks_uses_task_query():
+    fake_task_query = mock.Mock(spec=mesos_tools.MesosTaskQuery)
+    fake_task_query.get_running_tasks.return_value = [{'id': 1}]
+    actual = marathon_serviceinit.status_mesos_tasks('fake_service', 'fake_instance', 1, task_query=fake_task_query)
+    assert 'Healthy' in actual
+    fake_task_query.get_running_tasks.assert_called_once_with(
+        marathon_tools.format_job_id('fake_service', 'fake_instance'))
+
+
 def test_perform_command_handles_no_docker_and_doesnt_raise():
     fake_service = 'fake_service'
     fake_instance = 'fake_instance'
@@ -840,9 +851,11 @@ def test_pretty_print_smartstack_backends_for_locations_verbose():
         mock.patch('paasta_tools.marathon_serviceinit.get_backends', autospec=True,
                    side_effect=lambda _, synapse_host, synapse_port: [backends[synapse_host]]),
         mock.patch('socket.gethostbyname', side_effect=lambda name: host_ip_mapping[name], autospec=True),
+        mock.patch.object(replication_utils, '_dns_cache', {}),
     ) as (
         mock_get_backends,
         mock_gethostbyname,
+        _,
     ):
         actual = marathon_serviceinit.pretty_print_smartstack_backends_for_locations(
             service_instance='fake_service.fake_instance',
@@ -13,6 +13,11 @@
 # limitations under the License.
 
 import contextlib
+import inspect
+import os
+import shutil
+import tempfile
+import threading
 
 from marathon.models import MarathonApp
 import mock
@@ -83,8 +88,8 @@ class TestMarathonTools:
         fake_dir = '/nail/home/sanfran'
         with contextlib.nested(
             mock.patch('paasta_tools.marathon_tools.load_deployments_json', autospec=True),
-            mock.patch('service_configuration_lib.read_service_configuration', autospec=True),
-            mock.patch('service_configuration_lib.read_extra_service_information', autospec=True),
+            mock.patch('paasta_tools.marathon_tools.read_service_configuration', autospec=True),
+            mock.patch('paasta_tools.marathon_tools.read_extra_service_information', autospec=True),
         ) as (
             mock_load_deployments_json,
             mock_read_service_configuration,
@@ -108,8 +113,8 @@ class TestMarathonTools:
         fake_dir = '/nail/home/sanfran'
         with contextlib.nested(
             mock.patch('paasta_tools.marathon_tools.load_deployments_json', autospec=True),
-            mock.patch('service_configuration_lib.read_service_configuration', autospec=True),
-            mock.patch('service_configuration_lib.read_extra_service_information', autospec=True),
+            mock.patch('paasta_tools.marathon_tools.read_service_configuration', autospec=True),
+            mock.patch('paasta_tools.marathon_tools.read_extra_service_information', autospec=True),
         ) as (
             mock_load_deployments_json,
             mock_read_service_configuration,
@@ -272,7 +277,7 @@ class TestMarathonTools:
         }
         expected = [('vvvvvv.t2', t2_dict), ('vvvvvv.t1', t1_dict)]
         expected_short = [('t2', t2_dict), ('t1', t1_dict)]
-        with mock.patch('service_configuration_lib.read_service_configuration', autospec=True,
+        with mock.patch('paasta_tools.marathon_tools.read_service_configuration', autospec=True,
                         return_value=fake_smartstack) as read_service_configuration_patch:
             actual = marathon_tools.get_all_namespaces_for_service(name, soa_dir)
             read_service_configuration_patch.assert_any_call(name, soa_dir)
@@ -417,7 +422,7 @@ class TestMarathonTools:
                 'Host': 'example.com'
             },
         }
-        with mock.patch('service_configuration_lib.read_service_configuration',
+        with mock.patch('paasta_tools.marathon_tools.read_service_configuration',
                         autospec=True,
                         return_value=fake_config) as read_service_configuration_patch:
             actual = marathon_tools.load_service_namespace_config(name, namespace, soa_dir)
@@ -429,7 +434,7 @@ class TestMarathonTools:
         namespace = 'ecapseman'
         soa_dir = 'rid_aos'
         fake_config = {}
-        with mock.patch('service_configuration_lib.read_service_configuration',
+        with mock.patch('paasta_tools.marathon_tools.read_service_configuration',
                         autospec=True,
                         return_value=fake_config) as read_service_configuration_patch:
             actual = marathon_tools.load_service_namespace_config(name, namespace, soa_dir)
@@ -445,7 +450,7 @@ class TestMarathonTools:
                 namespace: {'proxy_port': 9001},
             },
         }
-        with mock.patch('service_configuration_lib.read_service_configuration',
+        with mock.patch('paasta_tools.marathon_tools.read_service_configuration',
                         autospec=True,
                         return_value=fake_config) as read_service_configuration_patch:
             actual = marathon_tools.load_service_namespace_config(name, namespace, soa_dir)
@@ -457,13 +462,13 @@ class TestMarathonTools:
         namespace = 'a_boat'
         soa_dir = 'an_adventure'
 
-        with mock.patch('service_configuration_lib.read_service_configuration',
+        with mock.patch('paasta_tools.marathon_tools.read_service_configuration',
                         side_effect=Exception) as read_service_configuration_patch:
             with raises(Exception):
                 marathon_tools.load_service_namespace_config(name, namespace, soa_dir)
             read_service_configuration_patch.assert_called_once_with(name, soa_dir)
 
-    @mock.patch('service_configuration_lib.read_extra_service_information', autospec=True)
+    @mock.patch('paasta_tools.marathon_tools.read_extra_service_information', autospec=True)
     def test_read_namespace_for_service_instance_has_value(self, read_info_patch):
         name = 'dont_worry'
         instance = 'im_a_professional'
@@ -475,7 +480,7 @@ class TestMarathonTools:
         assert actual == namespace
         read_info_patch.assert_called_once_with(name, 'marathon-%s' % cluster, soa_dir)
 
-    @mock.patch('service_configuration_lib.read_extra_service_information', autospec=True)
+    @mock.patch('paasta_tools.marathon_tools.read_extra_service_information', autospec=True)
     def test_read_namespace_for_service_instance_no_value(self, read_info_patch):
         name = 'wall_light'
         instance = 'ceiling_light'
@@ -886,6 +891,27 @@ class TestMarathonTools:
         )
         assert fake_conf.get_bounce_method() == 'crossover'
 
+    def test_get_bounce_method_params_in_config(self):
+        fake_param = {'max_surge': '50%', 'max_unavailable': 1}
+        fake_conf = marathon_tools.MarathonServiceConfig(
+            service='fake_name',
+            cluster='fake_cluster',
+            instance='fake_instance',
+            config_dict={'bounce_method_params': fake_param},
+            branch_dict={},
+        )
+        assert fake_conf.get_bounce_method_params() == fake_param
+
+    def test_get_bounce_method_params_default(self):
+        fake_conf = marathon_tools.MarathonServiceConfig(
+            service='fake_name',
+            cluster='fake_cluster',
+            instance='fake_instance',
+            config_dict={},
+            branch_dict={},
+        )
+        assert fake_conf.get_bounce_method_params() == {}
+
     def test_get_bounce_health_params_in_config(self):
         fake_param = 'fake_param'
         fake_conf = marathon_tools.MarathonServiceConfig(
@@ -1138,6 +1164,41 @@ class TestMarathonTools:
             assert marathon_tools.is_app_id_running(fake_id, fake_client) is False
             list_all_marathon_app_ids_patch.assert_called_once_with(fake_client)
 
+    def test_is_app_id_present_true(self):
+        fake_client = mock.Mock()
+        assert marathon_tools.is_app_id_present('fake_app1', fake_client) is True
+        fake_client.get_app.assert_called_once_with('fake_app1')
+        assert fake_client.list_apps.call_count == 0
+
+    def test_is_app_id_present_false(self):
+        fake_client = mock.Mock()
+        fake_response = mock.Mock(status_code=404, json=mock.Mock(return_value={'message': 'not found'}))
+        fake_client.get_app.side_effect = marathon_tools.NotFoundError(fake_response)
+        assert marathon_tools.is_app_id_present('fake_app3', fake_client) is False
+
+    def test_kill_given_tasks(self):
+        fake_client = mock.Mock()
+        with mock.patch('paasta_tools.marathon_tools.marathon_request', autospec=True) as request_patch:
+            marathon_tools.kill_given_tasks(fake_client, ['fake_task_1', 'fake_task_2'], scale=True)
+        request_patch.assert_called_once_with(
+            fake_client,
+            'POST',
+            '/v2/tasks/delete',
+            params={'scale': True},
+            data='{"ids": ["fake_task_1", "fake_task_2"]}',
+        )
+
+    def test_marathon_request_matches_client(self):
+        # _do_request is private to the marathon client, so this fails if an upgrade changes it
+        fake_client = mock.create_autospec(marathon_tools.MarathonClient)
+        fake_response = fake_client._do_request.return_value
+        actual = marathon_tools.marathon_request(fake_client, 'POST', '/v2/tasks/delete', params={'scale': False},
+                                                 data='{}')
+        assert actual == fake_response
+        fake_client._do_request.assert_called_once_with('POST', '/v2/tasks/delete', params={'scale': False}, data='{}')
+        assert inspect.getargspec(marathon_tools.MarathonClient._do_request) == inspect.ArgSpec(
+            args=['self', 'method', 'path', 'params', 'data'], varargs=None, keywords=None, defaults=(None, None))
+
     @patch('paasta_tools.marathon_tools.MarathonClient.list_tasks')
     def test_app_has_tasks_exact(self, patch_list_tasks):
         fake_client = mock.Mock()
@@ -1315,6 +1376,42 @@ class TestMarathonTools:
             read_config_patch.assert_any_call(service, 'blue', 'fake_cluster', soa_dir=soa_dir)
             read_config_patch.assert_any_call(service, 'green', 'fake_cluster', soa_dir=soa_dir)
 
+    def test_get_expected_instance_counts_by_namespace(self):
+        soa_dir = 'que_esta'
+        fake_service_instances = [('red', 'blue'), ('red', 'green'), ('red', 'rojo'), ('blue', 'main')]
+        fake_configs = {
+            ('red', 'blue'): {'nerve_ns': 'rojo', 'instances': 11},
+            ('red', 'green'): {'nerve_ns': 'amarillo', 'instances': 2},
+            ('red', 'rojo'): {'instances': 3},
+        }
+
+        def config_helper(service, instance, cluster, soa_dir=None):
+            if service == 'blue':
+                raise marathon_tools.NoDeploymentsAvailable
+            return marathon_tools.MarathonServiceConfig(
+                service=service,
+                cluster=cluster,
+                instance=instance,
+                config_dict=fake_configs[(service, instance)],
+                branch_dict={},
+            )
+
+        with mock.patch('paasta_tools.marathon_tools.load_marathon_service_config',
+                        autospec=True, side_effect=config_helper) as read_config_patch:
+            actual = marathon_tools.get_expected_instance_counts_by_namespace(
+                fake_service_instances,
+                cluster='fake_cluster',
+                soa_dir=soa_dir,
+            )
+            assert actual == {
+                ('red', 'blue'): 0,
+                ('red', 'green'): 0,
+                ('red', 'rojo'): 14,
+                ('red', 'amarillo'): 2,
+            }
+            assert read_config_patch.call_count == 4
+            read_config_patch.assert_any_call('red', 'blue', 'fake_cluster', soa_dir=soa_dir)
+
     def test_get_matching_appids(self):
         apps = [
             mock.Mock(id='/fake--service.fake--instance.bouncingold'),
@@ -2144,3 +2241,220 @@ def test_create_complete_config_utilizes_extra_volumes():
 
         # Assert that the complete config can be inserted into the MarathonApp model
         assert MarathonApp(**actual)
+
+
+def test_fetch_marathon_snapshot():
+    fake_apps = [mock.Mock(id='/fake--service.fake--instance.git1.config1')]
+    fake_client = mock.Mock(list_apps=mock.Mock(return_value=fake_apps))
+    with mock.patch('time.time', autospec=True, return_value=1234.0):
+        actual = marathon_tools.fetch_marathon_snapshot(fake_client)
+    fake_client.list_apps.assert_called_once_with(embed_failures=True)
+    assert actual.apps == fake_apps
+    assert actual.timestamp == 1234.0
+    assert actual.list_apps(embed_failures=True) == fake_apps
+
+
+def test_marathon_snapshot_is_stale():
+    snapshot = marathon_tools.MarathonSnapshot(apps=[], timestamp=1000.0)
+    with mock.patch('time.time', autospec=True, return_value=1000.0 + marathon_tools.MARATHON_SNAPSHOT_MAX_AGE_S + 1):
+        assert snapshot.is_stale()
+    with mock.patch('time.time', autospec=True, return_value=1001.0):
+        assert not snapshot.is_stale()
+
+
+def test_shared_marathon_snapshot_refetches_when_stale():
+    fake_client = mock.Mock()
+    snapshot = marathon_tools.MarathonSnapshot(apps=[], timestamp=1000.0)
+    shared = marathon_tools.SharedMarathonSnapshot(fake_client, snapshot, max_age_s=60)
+    with contextlib.nested(
+        mock.patch('time.time', autospec=True, return_value=1030.0),
+        mock.patch('paasta_tools.marathon_tools.fetch_marathon_snapshot', autospec=True),
+    ) as (time_patch, fetch_marathon_snapshot_patch):
+        assert shared.get() is snapshot
+        assert fetch_marathon_snapshot_patch.call_count == 0
+
+        time_patch.return_value = 1061.0
+        assert shared.get() is fetch_marathon_snapshot_patch.return_value
+        fetch_marathon_snapshot_patch.assert_called_once_with(fake_client)
+
+
+def test_write_and_load_marathon_snapshot_itest():
+    fake_app = MarathonApp.from_json({
+        'id': '/fake--service.fake--instance.git1.config1',
+        'instances': 1,
+        'tasks': [{
+            'id': 'fake--service.fake--instance.git1.config1.task1',
+            'appId': '/fake--service.fake--instance.git1.config1',
+            'host': 'fake_host',
+            'ports': [31000],
+            'startedAt': '2015-10-01T12:34:56.789Z',
+            'healthCheckResults': [{'alive': True, 'taskId': 'fake--service.fake--instance.git1.config1.task1'}],
+        }],
+    })
+    tempdir = tempfile.mkdtemp()
+    snapshot_path = os.path.join(tempdir, 'marathon_snapshot.json')
+    try:
+        marathon_tools.write_marathon_snapshot(
+            marathon_tools.MarathonSnapshot(apps=[fake_app], timestamp=1234.0),
+            snapshot_path,
+        )
+        actual = marathon_tools.load_marathon_snapshot(snapshot_path)
+        assert actual.timestamp == 1234.0
+        assert [app.to_json() for app in actual.apps] == [fake_app.to_json()]
+        assert actual.apps[0].tasks[0].started_at == fake_app.tasks[0].started_at
+        assert actual.apps[0].tasks[0].health_check_results[0].alive is True
+    finally:
+        shutil.rmtree(tempdir)
+
+
+def test_load_marathon_snapshot_missing():
+    with raises(marathon_tools.MarathonSnapshotNotAvailable):
+        marathon_tools.load_marathon_snapshot('/this/path/does/not/exist')
+
+
+def test_marathon_task_index_get_tasks_with_app_id_prefix():
+    fake_tasks = [
+        mock.Mock(app_id='/c.main.git1.config1'),
+        mock.Mock(app_id='/a.main.git1.config1'),
+        mock.Mock(app_id='/b.main.git1.config1'),
+        mock.Mock(app_id='/b.main.git2.config2'),
+        mock.Mock(app_id='/b.canary.git1.config1'),
+    ]
+    task_index = marathon_tools.MarathonTaskIndex(fake_tasks)
+    assert task_index.get_tasks_with_app_id_prefix('/b.main') == [fake_tasks[2], fake_tasks[3]]
+    assert task_index.get_tasks_with_app_id_prefix('/b.') == [fake_tasks[4], fake_tasks[2], fake_tasks[3]]
+    assert task_index.get_tasks_with_app_id_prefix('/d') == []
+    assert task_index.get_tasks_with_app_id_prefix('/c.main.git1.config1') == [fake_tasks[0]]
+
+
+class TestMarathonEventStream:
+
+    fake_client = mock.Mock(servers=['http://fake_marathon:8080/'], auth=('user', 'pass'))
+
+    def fake_response(self, body, status_code=200, error=None, wait_for=None):
+        def iter_content(chunk_size):
+            # Split the body in odd places, such as between \r and \n
+            for i in xrange(0, len(body), 7):
+                yield body[i:i + 7]
+            if wait_for is not None:
+                wait_for.wait()
+            if error is not None:
+                raise error
+        return mock.Mock(status_code=status_code, iter_content=iter_content, raw=mock.Mock(chunked=True))
+
+    def test_wait_for_app_event_sees_event(self):
+        body = (
+            'event: status_update_event\r\ndata: {"appId": "/other_app", "taskStatus": "TASK_RUNNING"}\r\n\r\n'
+            'event: app_terminated_event\r\ndata: {"appId": "/fake_app", "eventType": "app_terminated_event"}\r\n\r\n'
+        )
+        fake_response = self.fake_response(body)
+        with mock.patch('requests.get', autospec=True, return_value=fake_response) as get_patch:
+            with marathon_tools.MarathonEventStream(self.fake_client) as events:
+                assert events.wait_for_app_event('fake_app', 5) is True
+        get_patch.assert_called_once_with(
+            'http://fake_marathon:8080/v2/events',
+            headers={'Accept': 'text/event-stream'},
+            auth=('user', 'pass'),
+            stream=True,
+            timeout=(
+                marathon_tools.MARATHON_EVENT_STREAM_CONNECT_TIMEOUT_S,
+                marathon_tools.MARATHON_EVENT_STREAM_READ_TIMEOUT_S,
+            ),
+        )
+        fake_response.close.assert_called_once_with()
+
+    def test_iter_events(self):
+        body = (
+            'event: status_update_event\r\ndata: {"appId": "/fake_app"}\r\n\r\n'
+            ': a comment\r\n\r\n'
+            'event: deployment_success\r\ndata: {"id": "fake_deployment"}\r\n\r\n'
+        )
+        error = marathon_tools.requests.exceptions.ConnectionError('Read timed out')
+        fake_response = self.fake_response(body, error=error)
+        with mock.patch('requests.get', autospec=True, return_value=fake_response):
+            events = marathon_tools.MarathonEventStream(self.fake_client)
+            assert list(events.iter_events()) == [
+                ('status_update_event', '{"appId": "/fake_app"}'),
+                ('deployment_success', '{"id": "fake_deployment"}'),
+            ]
+            assert events.is_available() is True
+        fake_response.close.assert_called_once_with()
+
+    def test_iter_events_without_event_stream(self):
+        with mock.patch('requests.get', autospec=True, return_value=self.fake_response('', status_code=404)):
+            events = marathon_tools.MarathonEventStream(self.fake_client)
+            assert list(events.iter_events()) == []
+            assert events.is_available() is False
+
+    def test_wait_for_app_event_ignores_app_id_prefixes(self):
+        body = 'event: app_terminated_event\r\ndata: {"appId": "/fake_app_two"}\r\n\r\n'
+        with contextlib.nested(
+            mock.patch('requests.get', autospec=True, return_value=self.fake_response(body)),
+            mock.patch('paasta_tools.marathon_tools.sleep', autospec=True),
+        ):
+            events = marathon_tools.MarathonEventStream(self.fake_client)
+            assert events.wait_for_app_event('fake_app', 5) is False
+
+    def test_wait_for_app_event_reopens_after_read_timeout(self):
+        error = marathon_tools.requests.exceptions.ConnectionError('Read timed out')
+        with contextlib.nested(
+            mock.patch('requests.get', autospec=True, side_effect=[
+                self.fake_response('', error=error),
+                self.fake_response('data: {"appId": "/fake_app"}\r\n'),
+            ]),
+            mock.patch('paasta_tools.marathon_tools.sleep', autospec=True),
+        ) as (
+            get_patch,
+            sleep_patch,
+        ):
+            events = marathon_tools.MarathonEventStream(self.fake_client)
+            assert events.wait_for_app_event('fake_app', 5) is False
+            assert sleep_patch.call_count == 1
+            assert events.wait_for_app_event('fake_app', 5) is True
+        assert get_patch.call_count == 2
+
+    def test_wait_for_app_event_keeps_stream_open(self):
+        body = 'data: {"appId": "/fake_app"}\r\n\r\ndata: {"appId": "/fake_app"}\r\n\r\n'
+        quiet_until = threading.Event()
+        fake_response = self.fake_response(body, wait_for=quiet_until)
+        with mock.patch('requests.get', autospec=True, return_value=fake_response) as get_patch:
+            events = marathon_tools.MarathonEventStream(self.fake_client)
+            assert events.wait_for_app_event('fake_app', 5) is True
+            assert events.wait_for_app_event('fake_app', 5) is True
+            assert events.wait_for_app_event('fake_app', 0.01) is False
+            assert fake_response.close.call_count == 0
+            quiet_until.set()
+            events.close()
+        assert get_patch.call_count == 1
+
+    def test_iter_lines_reads_chunks(self):
+        fake_response = mock.Mock(raw=mock.Mock(chunked=True))
+        fake_response.iter_content.return_value = iter(['event: a\r', '\ndata: {}\r\n\r\nda', 'ta: x\r\n'])
+        assert list(marathon_tools.MarathonEventStream._iter_lines(fake_response)) == [
+            'event: a', 'data: {}', '', 'data: x',
+        ]
+        fake_response.iter_content.assert_called_once_with(
+            chunk_size=marathon_tools.MARATHON_EVENT_STREAM_CHUNK_SIZE)
+
+    def test_wait_for_app_event_without_event_stream(self):
+        with contextlib.nested(
+            mock.patch('requests.get', autospec=True, return_value=self.fake_response('', status_code=404)),
+            mock.patch('paasta_tools.marathon_tools.sleep', autospec=True),
+        ) as (
+            get_patch,
+            sleep_patch,
+        ):
+            events = marathon_tools.MarathonEventStream(self.fake_client)
+            assert events.wait_for_app_event('fake_app', 5) is False
+            assert events.wait_for_app_event('fake_app', 5) is False
+        assert get_patch.call_count == 1
+        assert sleep_patch.call_count == 2
+
+    def test_open_tries_every_server(self):
+        fake_client = mock.Mock(servers=['http://marathon1', 'http://marathon2'], auth=None)
+        with mock.patch('requests.get', autospec=True, side_effect=[
+            marathon_tools.requests.exceptions.ConnectionError('Connection refused'),
+            self.fake_response(''),
+        ]) as get_patch:
+            assert marathon_tools.MarathonEventStream(fake_client).open() is True
+        assert get_patch.call_args[0][0] == 'http://marathon2/v2/events'
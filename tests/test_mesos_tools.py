@@ -14,6 +14,13 @@
 
 import contextlib
 import datetime
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from StringIO import StringIO
 
 import mesos
 import mock
@@ -47,18 +54,20 @@ def test_filter_not_running_tasks():
 
 def test_status_mesos_tasks_verbose():
     with contextlib.nested(
-        mock.patch('paasta_tools.mesos_tools.get_running_tasks_from_active_frameworks', autospec=True,),
-        mock.patch('paasta_tools.mesos_tools.get_non_running_tasks_from_active_frameworks', autospec=True,),
+        mock.patch('paasta_tools.mesos_tools.get_current_tasks', autospec=True,),
+        mock.patch('paasta_tools.mesos_tools.get_running_task_stats', autospec=True,),
         mock.patch('paasta_tools.mesos_tools.format_running_mesos_task_row', autospec=True,),
         mock.patch('paasta_tools.mesos_tools.format_non_running_mesos_task_row', autospec=True,),
     ) as (
-        get_running_mesos_tasks_patch,
-        get_non_running_mesos_tasks_patch,
+        get_current_tasks_patch,
+        get_running_task_stats_patch,
         format_running_mesos_task_row_patch,
         format_non_running_mesos_task_row_patch,
     ):
-        get_running_mesos_tasks_patch.return_value = ['doing a lap']
-        get_non_running_mesos_tasks_patch.return_value = ['eating a burrito']
+        running_task = {'id': 'doing a lap', 'state': 'TASK_RUNNING'}
+        non_running_task = {'id': 'eating a burrito', 'state': 'TASK_FINISHED'}
+        get_current_tasks_patch.return_value = [running_task, non_running_task]
+        get_running_task_stats_patch.return_value = {'doing a lap': {'cpus_limit': 1.1}}
         format_running_mesos_task_row_patch.return_value = ['id', 'host', 'mem', 'cpu', 'time']
         format_non_running_mesos_task_row_patch.return_value = ['id', 'host', 'time', 'state']
         job_id = format_job_id('fake_service', 'fake_instance'),
@@ -66,79 +75,237 @@ def test_status_mesos_tasks_verbose():
         actual = mesos_tools.status_mesos_tasks_verbose(job_id,  get_short_task_id)
         assert 'Running Tasks' in actual
         assert 'Non-Running Tasks' in actual
-        format_running_mesos_task_row_patch.assert_called_once_with('doing a lap', get_short_task_id)
-        format_non_running_mesos_task_row_patch.assert_called_once_with('eating a burrito', get_short_task_id)
+        get_current_tasks_patch.assert_called_once_with(job_id)
+        get_running_task_stats_patch.assert_called_once_with([running_task])
+        format_running_mesos_task_row_patch.assert_called_once_with(
+            running_task, get_short_task_id, {'cpus_limit': 1.1})
+        format_non_running_mesos_task_row_patch.assert_called_once_with(non_running_task, get_short_task_id)
+
+
+def test_split_tasks_by_state_keeps_most_recent_non_running_tasks():
+    tasks = [{'id': i, 'state': 'TASK_FAILED'} for i in range(5)]
+    tasks.insert(2, {'id': 'running', 'state': 'TASK_RUNNING'})
+    actual = mesos_tools.split_tasks_by_state(iter(tasks), max_non_running_tasks=3)
+    assert actual.running == [{'id': 'running', 'state': 'TASK_RUNNING'}]
+    assert [task['id'] for task in actual.non_running] == [4, 3, 2]
+
+
+def test_mesos_task_query_fetches_each_job_id_once():
+    with mock.patch('paasta_tools.mesos_tools.get_current_tasks', autospec=True) as get_current_tasks_patch:
+        get_current_tasks_patch.return_value = [
+            {'id': 'service.instance.git1.config1.uuid1', 'state': 'TASK_RUNNING'},
+            {'id': 'service.instance.git2.config2.uuid2', 'state': 'TASK_RUNNING'},
+            {'id': 'service.instance.git1.config1.uuid3', 'state': 'TASK_KILLED'},
+        ]
+        task_query = mesos_tools.MesosTaskQuery()
+        assert len(task_query.get_running_tasks('service.instance')) == 2
+        assert len(task_query.get_non_running_tasks('service.instance')) == 1
+        assert task_query.get_running_tasks('service.instance.git1.config1') == [
+            {'id': 'service.instance.git1.config1.uuid1', 'state': 'TASK_RUNNING'},
+        ]
+        assert task_query.get_non_running_tasks('service.instance.git2.config2') == []
+        get_current_tasks_patch.assert_called_once_with('service.instance')
+
+        task_query.get_tasks('another_service.main')
+        assert get_current_tasks_patch.call_count == 2
+
+
+def test_mesos_task_query_caps_non_running_tasks_per_job_id():
+    with mock.patch('paasta_tools.mesos_tools.get_current_tasks', autospec=True) as get_current_tasks_patch:
+        get_current_tasks_patch.return_value = (
+            [{'id': 'service.instance.git1.config1.uuid%d' % i, 'state': 'TASK_KILLED'} for i in range(3)] +
+            [{'id': 'service.instance.git2.config2.uuid%d' % i, 'state': 'TASK_FAILED'} for i in range(3)]
+        )
+        task_query = mesos_tools.MesosTaskQuery(max_non_running_tasks=2)
+        assert [task['id'] for task in task_query.get_non_running_tasks('service.instance')] == [
+            'service.instance.git2.config2.uuid2',
+            'service.instance.git2.config2.uuid1',
+        ]
+        assert [task['id'] for task in task_query.get_non_running_tasks('service.instance.git1.config1')] == [
+            'service.instance.git1.config1.uuid2',
+            'service.instance.git1.config1.uuid1',
+        ]
+        get_current_tasks_patch.assert_called_once_with('service.instance')
 
 
-def test_get_cpu_usage_good():
+def make_fake_running_task(duration_s):
     fake_task = mock.create_autospec(mesos.cli.task.Task)
-    fake_task.cpu_limit = .35
-    fake_duration = 100
-    fake_task.stats = {
-        'cpus_system_time_secs': 2.5,
-        'cpus_user_time_secs': 0.0,
-    }
     fake_task.__getitem__.return_value = [{
         'state': 'TASK_RUNNING',
-        'timestamp': int(datetime.datetime.now().strftime('%s')) - fake_duration,
+        'timestamp': int(datetime.datetime.now().strftime('%s')) - duration_s,
     }]
-    actual = mesos_tools.get_cpu_usage(fake_task)
+    return fake_task
+
+
+def test_get_cpu_usage_good():
+    fake_task = make_fake_running_task(100)
+    fake_stats = {
+        'cpus_limit': .35,
+        'cpus_system_time_secs': 2.5,
+        'cpus_user_time_secs': 0.0,
+    }
+    actual = mesos_tools.get_cpu_usage(fake_task, fake_stats)
     assert '10.0%' == actual
 
 
 def test_get_cpu_usage_bad():
-    fake_task = mock.create_autospec(mesos.cli.task.Task)
-    fake_task.cpu_limit = 1.1
-    fake_duration = 100
-    fake_task.stats = {
+    fake_task = make_fake_running_task(100)
+    fake_stats = {
+        'cpus_limit': 1.1,
         'cpus_system_time_secs': 50.0,
         'cpus_user_time_secs': 50.0,
     }
-    fake_task.__getitem__.return_value = [{
-        'state': 'TASK_RUNNING',
-        'timestamp': int(datetime.datetime.now().strftime('%s')) - fake_duration,
-    }]
-    actual = mesos_tools.get_cpu_usage(fake_task)
+    actual = mesos_tools.get_cpu_usage(fake_task, fake_stats)
     assert PaastaColors.red('100.0%') in actual
 
 
 def test_get_cpu_usage_handles_missing_stats():
-    fake_task = mock.create_autospec(mesos.cli.task.Task)
-    fake_task.cpu_limit = 1.1
-    fake_duration = 100
-    fake_task.stats = {}
-    fake_task.__getitem__.return_value = [{
-        'state': 'TASK_RUNNING',
-        'timestamp': int(datetime.datetime.now().strftime('%s')) - fake_duration,
-    }]
-    actual = mesos_tools.get_cpu_usage(fake_task)
+    fake_task = make_fake_running_task(100)
+    actual = mesos_tools.get_cpu_usage(fake_task, {'cpus_limit': 1.1})
     assert "0.0%" in actual
 
 
+def test_get_cpu_usage_handles_timeouts_and_missing_slaves():
+    fake_task = make_fake_running_task(100)
+    assert mesos_tools.get_cpu_usage(fake_task, mesos_tools.TimeoutError()) == "Timed Out"
+    assert mesos_tools.get_cpu_usage(fake_task, mesos.cli.exceptions.SlaveDoesNotExist()) == "None"
+    assert mesos_tools.get_cpu_usage(fake_task, None) == "None"
+
+
 def test_get_mem_usage_good():
-    fake_task = mock.create_autospec(mesos.cli.task.Task)
-    fake_task.rss = 1024 * 1024 * 10
-    fake_task.mem_limit = fake_task.rss * 10
-    actual = mesos_tools.get_mem_usage(fake_task)
+    fake_stats = {
+        'mem_rss_bytes': 1024 * 1024 * 10,
+        'mem_limit_bytes': 1024 * 1024 * 100,
+    }
+    actual = mesos_tools.get_mem_usage(fake_stats)
     assert actual == '10/100MB'
 
 
 def test_get_mem_usage_bad():
-    fake_task = mock.create_autospec(mesos.cli.task.Task)
-    fake_task.rss = 1024 * 1024 * 100
-    fake_task.mem_limit = fake_task.rss
-    actual = mesos_tools.get_mem_usage(fake_task)
+    fake_stats = {
+        'mem_rss_bytes': 1024 * 1024 * 100,
+        'mem_limit_bytes': 1024 * 1024 * 100,
+    }
+    actual = mesos_tools.get_mem_usage(fake_stats)
     assert actual == PaastaColors.red('100/100MB')
 
 
 def test_get_mem_usage_divide_by_zero():
-    fake_task = mock.create_autospec(mesos.cli.task.Task)
-    fake_task.rss = 1024 * 1024 * 10
-    fake_task.mem_limit = 0
-    actual = mesos_tools.get_mem_usage(fake_task)
+    fake_stats = {
+        'mem_rss_bytes': 1024 * 1024 * 10,
+        'mem_limit_bytes': 0,
+    }
+    actual = mesos_tools.get_mem_usage(fake_stats)
     assert actual == "Undef"
 
 
+def test_get_mem_usage_handles_timeouts_and_missing_slaves():
+    assert mesos_tools.get_mem_usage(mesos_tools.TimeoutError()) == "Timed Out"
+    assert mesos_tools.get_mem_usage(mesos.cli.exceptions.SlaveDoesNotExist()) == "None"
+    assert mesos_tools.get_mem_usage(None) == "None"
+
+
+def make_fake_slave_response(body):
+    fake_response = mock.Mock()
+    fake_response.raw = StringIO(json.dumps(body))
+    fake_response.json.return_value = body
+    return fake_response
+
+
+def test_get_task_stats_from_slave_joins_statistics_by_executor_id():
+    fake_slave = mock.MagicMock()
+    fake_state = {'frameworks': [{'executors': [
+        {'id': 'executor1', 'tasks': [{'id': 'task1'}]},
+        {'id': 'executor2', 'tasks': [{'id': 'task2'}]},
+        {'id': 'executor3', 'tasks': [{'id': 'task3'}]},
+    ]}]}
+    fake_statistics = [
+        {'executor_id': 'executor1', 'statistics': {'mem_rss_bytes': 1}},
+        {'executor_id': 'executor2', 'statistics': {'mem_rss_bytes': 2}},
+    ]
+    fake_slave.fetch.side_effect = [
+        make_fake_slave_response(fake_state),
+        make_fake_slave_response(fake_statistics),
+    ]
+    actual = mesos_tools.get_task_stats_from_slave(fake_slave, ['task1', 'task2', 'task3', 'task4'], time.time() + 10)
+    assert actual == {
+        'task1': {'mem_rss_bytes': 1},
+        'task2': {'mem_rss_bytes': 2},
+        'task3': {},
+        'task4': {},
+    }
+    assert fake_slave.fetch.call_count == 2
+    assert fake_slave.fetch.call_args[0] == ('/monitor/statistics.json',)
+    assert 0 < fake_slave.fetch.call_args[1]['timeout'] <= 10
+
+
+def test_get_task_stats_from_slave_raises_timeouts():
+    fake_slave = mock.MagicMock()
+    fake_slave.fetch.side_effect = requests.exceptions.Timeout
+    with raises(mesos_tools.TimeoutError):
+        mesos_tools.get_task_stats_from_slave(fake_slave, ['task1'], time.time() + 10)
+
+
+def make_fake_task(task_id, slave_id):
+    fake_task = mock.MagicMock()
+    fake_task.__getitem__.side_effect = {'id': task_id, 'slave_id': slave_id}.__getitem__
+    fake_task.slave = slave_id
+    return fake_task
+
+
+def test_get_running_task_stats_queries_each_slave_once():
+    tasks = [
+        make_fake_task('task1', 'slave1'),
+        make_fake_task('task2', 'slave1'),
+        make_fake_task('task3', 'slave2'),
+    ]
+
+    def fake_get_task_stats_from_slave(slave, task_ids, deadline):
+        return dict((task_id, {'slave': slave}) for task_id in task_ids)
+
+    with mock.patch(
+        'paasta_tools.mesos_tools.get_task_stats_from_slave',
+        autospec=True,
+        side_effect=fake_get_task_stats_from_slave,
+    ) as get_task_stats_from_slave_patch:
+        actual = mesos_tools.get_running_task_stats(tasks)
+    assert actual == {
+        'task1': {'slave': 'slave1'},
+        'task2': {'slave': 'slave1'},
+        'task3': {'slave': 'slave2'},
+    }
+    assert get_task_stats_from_slave_patch.call_count == 2
+
+
+def test_get_running_task_stats_reports_slow_and_missing_slaves():
+    tasks = [
+        make_fake_task('task1', 'slow_slave'),
+        make_fake_task('task2', 'missing_slave'),
+        make_fake_task('task3', 'good_slave'),
+    ]
+    slow_slave_release = threading.Event()
+
+    def fake_get_task_stats_from_slave(slave, task_ids, deadline):
+        if slave == 'slow_slave':
+            slow_slave_release.wait(5)
+        elif slave == 'missing_slave':
+            raise mesos.cli.exceptions.SlaveDoesNotExist()
+        return dict((task_id, {}) for task_id in task_ids)
+
+    with mock.patch(
+        'paasta_tools.mesos_tools.get_task_stats_from_slave',
+        autospec=True,
+        side_effect=fake_get_task_stats_from_slave,
+    ):
+        try:
+            actual = mesos_tools.get_running_task_stats(tasks, timeout_s=0.1)
+        finally:
+            slow_slave_release.set()
+    assert isinstance(actual['task1'], mesos_tools.TimeoutError)
+    assert isinstance(actual['task2'], mesos.cli.exceptions.SlaveDoesNotExist)
+    assert actual['task3'] == {}
+
+
 def test_get_zookeeper_config():
     zk_hosts = '1.1.1.1:1111,2.2.2.2:2222,3.3.3.3:3333'
     zk_path = 'fake_path'
@@ -177,15 +344,49 @@ def test_is_mesos_leader(mock_get_mesos_leader):
     mock_get_mesos_leader.assert_called_once_with(fake_host)
 
 
-@mock.patch('paasta_tools.mesos_tools.KazooClient')
+@mock.patch('paasta_tools.mesos_tools.get_zookeeper_client', autospec=True)
 def test_get_number_of_mesos_masters(
-    mock_kazoo,
+    mock_get_zookeeper_client,
 ):
     fake_zk_config = {'hosts': '1.1.1.1', 'path': 'fake_path'}
 
-    zk = mock_kazoo.return_value
+    zk = mock_get_zookeeper_client.return_value
     zk.get_children.return_value = ['log_11', 'state', 'info_1', 'info_2']
     assert mesos_tools.get_number_of_mesos_masters(fake_zk_config) == 2
+    mock_get_zookeeper_client.assert_called_once_with('1.1.1.1', read_only=True)
+    zk.get_children.assert_called_once_with('fake_path')
+    assert zk.stop.call_count == 0
+
+
+@mock.patch('requests.get')
+@mock.patch('socket.getfqdn')
+def test_get_local_slave_state(
+    mock_getfqdn,
+    mock_requests_get,
+):
+    mock_getfqdn.return_value = 'fake_hostname'
+    mock_requests_get.return_value.raw = StringIO(json.dumps({
+        'hostname': 'fake_hostname',
+        'frameworks': [{
+            'name': 'marathon',
+            'executors': [{
+                'id': 'fake_executor_id',
+                'resources': {'ports': '[31000-31000]'},
+                'tasks': [{'state': 'TASK_RUNNING', 'statuses': []}],
+            }],
+        }],
+    }))
+    assert mesos_tools.get_local_slave_state() == {
+        'frameworks': [{
+            'name': 'marathon',
+            'executors': [{
+                'id': 'fake_executor_id',
+                'resources': {'ports': '[31000-31000]'},
+                'tasks': [{'state': 'TASK_RUNNING'}],
+            }],
+        }],
+    }
+    mock_requests_get.assert_called_once_with('http://fake_hostname:5051/state.json', timeout=10, stream=True)
 
 
 @mock.patch('requests.get')
@@ -205,12 +406,12 @@ def test_get_local_slave_state_connection_error(
         mesos_tools.get_local_slave_state()
 
 
-@mock.patch('paasta_tools.mesos_tools.get_mesos_state_from_leader', autospec=True)
-def test_get_mesos_slaves_grouped_by_attribute(mock_fetch_state):
+@mock.patch('paasta_tools.mesos_tools.get_mesos_state_cache', autospec=True)
+def test_get_mesos_slaves_grouped_by_attribute(mock_get_mesos_state_cache):
     fake_attribute = 'fake_attribute'
     fake_value_1 = 'fake_value_1'
     fake_value_2 = 'fake_value_2'
-    mock_fetch_state.return_value = {
+    fake_state = {
         'slaves': [
             {
                 'hostname': 'fake_host_1',
@@ -243,24 +444,40 @@ def test_get_mesos_slaves_grouped_by_attribute(mock_fetch_state):
         'fake_value_2': ['fake_host_2'],
         'fake_other_value': ['fake_host_4'],
     }
+    mock_get_mesos_state_cache.return_value = {
+        'state': fake_state,
+        'slaves_by_attribute': mesos_tools.get_slaves_by_attribute(fake_state['slaves']),
+    }
     actual = mesos_tools.get_mesos_slaves_grouped_by_attribute(fake_attribute)
     assert actual == expected
 
 
-@mock.patch('paasta_tools.mesos_tools.get_mesos_state_from_leader', autospec=True)
-def test_get_mesos_slaves_grouped_by_attribute_bombs_out_with_no_slaves(mock_fetch_state):
-    mock_fetch_state.return_value = {
-        'slaves': []
+@mock.patch('paasta_tools.mesos_tools.get_mesos_state_cache', autospec=True)
+def test_get_mesos_slaves_grouped_by_attribute_with_slaves(mock_fetch_state):
+    fake_slaves = [
+        {'hostname': 'fake_host_1', 'attributes': {'fake_attribute': 'fake_value_1'}},
+        {'hostname': 'fake_host_2', 'attributes': {'fake_attribute': 'fake_value_1'}},
+    ]
+    actual = mesos_tools.get_mesos_slaves_grouped_by_attribute('fake_attribute', slaves=fake_slaves)
+    assert actual == {'fake_value_1': ['fake_host_1', 'fake_host_2']}
+    assert mock_fetch_state.call_count == 0
+
+
+@mock.patch('paasta_tools.mesos_tools.get_mesos_state_cache', autospec=True)
+def test_get_mesos_slaves_grouped_by_attribute_bombs_out_with_no_slaves(mock_get_mesos_state_cache):
+    mock_get_mesos_state_cache.return_value = {
+        'state': {'slaves': []},
+        'slaves_by_attribute': {},
     }
     with raises(mesos_tools.NoSlavesAvailable):
         mesos_tools.get_mesos_slaves_grouped_by_attribute('fake_attribute')
 
 
-@mock.patch('paasta_tools.mesos_tools.get_mesos_state_from_leader', autospec=True)
+@mock.patch('paasta_tools.mesos_tools.get_mesos_state_cache', autospec=True)
 @mock.patch('paasta_tools.mesos_tools.filter_mesos_slaves_by_blacklist', autospec=True)
 def test_get_mesos_slaves_grouped_by_attribute_uses_blacklist(
     mock_filter_mesos_slaves_by_blacklist,
-    mock_fetch_state
+    mock_get_mesos_state_cache
 ):
     fake_blacklist = ['fake_blacklist']
     fake_slaves = [
@@ -277,7 +494,7 @@ def test_get_mesos_slaves_grouped_by_attribute_uses_blacklist(
             }
         }
     ]
-    mock_fetch_state.return_value = {'slaves': fake_slaves}
+    mock_get_mesos_state_cache.return_value = {'state': {'slaves': fake_slaves}}
     mock_filter_mesos_slaves_by_blacklist.return_value = fake_slaves
     mesos_tools.get_mesos_slaves_grouped_by_attribute('fake_attribute', blacklist=fake_blacklist)
     mock_filter_mesos_slaves_by_blacklist.assert_called_once_with(slaves=fake_slaves, blacklist=fake_blacklist)
@@ -364,8 +581,62 @@ def test_get_mesos_state_from_leader_works_on_elected_leader():
         "elected_time": 1439503288.00787,
         "failed_tasks": 1,
     }
-    mesos.cli.master.CURRENT.state = good_fake_state
-    assert mesos_tools.get_mesos_state_from_leader() == good_fake_state
+    with mock.patch.object(mesos.cli.master.CURRENT, 'fetch', autospec=True) as mock_fetch:
+        mock_fetch.return_value.raw = StringIO(json.dumps(good_fake_state))
+        assert mesos_tools.get_mesos_state_from_leader() == {'elected_time': 1439503288.00787}
+        mock_fetch.assert_called_once_with('/master/state.json', stream=True)
+
+
+def test_get_mesos_state_from_leader_only_keeps_what_paasta_reads():
+    fake_state = {
+        'elected_time': 1439503288.00787,
+        'flags': {'quorum': '1', 'zk': 'zk://1.1.1.1:2181/mesos'},
+        'slaves': [{
+            'id': 'fake_slave_id',
+            'hostname': 'fake_host',
+            'pid': 'slave(1)@1.1.1.1:5051',
+            'attributes': {'region': 'fake_region'},
+            'resources': {'cpus': 10, 'mem': 2048.5},
+        }],
+        'frameworks': [{
+            'id': 'fake_framework_id',
+            'name': 'marathon',
+            'active': True,
+            'tasks': [{
+                'id': 'fake_task_id',
+                'name': 'fake_task',
+                'framework_id': 'fake_framework_id',
+                'slave_id': 'fake_slave_id',
+                'state': 'TASK_RUNNING',
+                'resources': {'cpus': 0.25, 'mem': 1024},
+                'statuses': [{'state': 'TASK_RUNNING', 'timestamp': 1439503288.1}],
+            }],
+            'completed_tasks': [{'id': 'fake_old_task_id'}],
+        }],
+        'completed_frameworks': [{'id': 'fake_old_framework_id'}],
+    }
+    with mock.patch.object(mesos.cli.master.CURRENT, 'fetch', autospec=True) as mock_fetch:
+        mock_fetch.return_value.raw = StringIO(json.dumps(fake_state))
+        actual = mesos_tools.get_mesos_state_from_leader()
+    del fake_state['slaves'][0]['pid']
+    del fake_state['frameworks'][0]['tasks'][0]['statuses']
+    del fake_state['frameworks'][0]['completed_tasks']
+    del fake_state['completed_frameworks']
+    assert actual == fake_state
+
+
+def test_parse_json_fields():
+    fake_json = json.dumps({
+        'a': [{'b': 1, 'c': {'d': [1, 2]}}, {'b': 2.5, 'e': None}],
+        'f': {'g': 'h', 'i': [{'j': 'k'}]},
+        'l': 'm',
+    })
+    actual = mesos_tools.parse_json_fields(StringIO(fake_json), {'a': [{'b': True, 'e': True}], 'f': True})
+    assert actual == {
+        'a': [{'b': 1}, {'b': 2.5, 'e': None}],
+        'f': {'g': 'h', 'i': [{'j': 'k'}]},
+    }
+    assert isinstance(actual['a'][1]['b'], float)
 
 
 def test_get_mesos_state_from_leader_raises_on_non_elected_leader():
@@ -378,6 +649,86 @@ def test_get_mesos_state_from_leader_raises_on_non_elected_leader():
         "deactivated_slaves": 0,
         "failed_tasks": 1,
     }
-    mesos.cli.master.CURRENT.state = un_elected_fake_state
-    with raises(mesos_tools.MasterNotAvailableException):
-        assert mesos_tools.get_mesos_state_from_leader() == un_elected_fake_state
+    with mock.patch.object(mesos.cli.master.CURRENT, 'fetch', autospec=True) as mock_fetch:
+        mock_fetch.return_value.raw = StringIO(json.dumps(un_elected_fake_state))
+        with raises(mesos_tools.MasterNotAvailableException):
+            mesos_tools.get_mesos_state_from_leader()
+
+
+def test_get_slaves_by_attribute():
+    fake_slaves = [
+        {'hostname': 'fake_host_1', 'attributes': {'region': 'fake_region_1', 'habitat': 'fake_habitat_1'}},
+        {'hostname': 'fake_host_2', 'attributes': {'region': 'fake_region_1', 'habitat': 'fake_habitat_2'}},
+        {'hostname': 'fake_host_3', 'attributes': {}},
+    ]
+    assert mesos_tools.get_slaves_by_attribute(fake_slaves) == {
+        'region': {'fake_region_1': ['fake_host_1', 'fake_host_2']},
+        'habitat': {'fake_habitat_1': ['fake_host_1'], 'fake_habitat_2': ['fake_host_2']},
+    }
+
+
+def test_get_mesos_state_cache_fetches_and_shares_state_itest():
+    tempdir = tempfile.mkdtemp()
+    fake_path = os.path.join(tempdir, 'mesos_state.json')
+    fake_state = {'slaves': [{'hostname': 'fake_host', 'attributes': {'region': 'fake_region'}}]}
+    try:
+        with contextlib.nested(
+            mock.patch.object(mesos_tools, '_mesos_state_cache', None),
+            mock.patch('paasta_tools.mesos_tools.get_mesos_state_from_leader', autospec=True,
+                       return_value=fake_state),
+        ) as (
+            _,
+            mock_get_mesos_state_from_leader,
+        ):
+            actual = mesos_tools.get_mesos_state_cache(ttl=60, path=fake_path)
+            assert actual['state'] == fake_state
+            assert actual['slaves_by_attribute'] == {'region': {'fake_region': ['fake_host']}}
+            assert mock_get_mesos_state_from_leader.call_count == 1
+
+            # Another process finds the state in the file instead of asking the leader
+            mesos_tools._mesos_state_cache = None
+            assert mesos_tools.get_mesos_state_cache(ttl=60, path=fake_path)['state'] == fake_state
+            assert mock_get_mesos_state_from_leader.call_count == 1
+
+            # Once the cache is older than the ttl, the state is fetched again
+            assert mesos_tools.get_mesos_state_cache(ttl=0, path=fake_path)['state'] == fake_state
+            assert mock_get_mesos_state_from_leader.call_count == 2
+    finally:
+        shutil.rmtree(tempdir)
+
+
+def test_get_mesos_state_cache_keeps_numeric_attributes_itest():
+    tempdir = tempfile.mkdtemp()
+    fake_path = os.path.join(tempdir, 'mesos_state.json')
+    fake_state = {'slaves': [{'hostname': 'fake_host', 'attributes': {'rack': 3}}]}
+    try:
+        with contextlib.nested(
+            mock.patch.object(mesos_tools, '_mesos_state_cache', None),
+            mock.patch('paasta_tools.mesos_tools.get_mesos_state_from_leader', autospec=True,
+                       return_value=fake_state),
+        ):
+            fetched = mesos_tools.get_mesos_state_cache(ttl=60, path=fake_path)
+            mesos_tools._mesos_state_cache = None
+            read = mesos_tools.get_mesos_state_cache(ttl=60, path=fake_path)
+            assert read is not fetched
+            assert read['slaves_by_attribute'] == fetched['slaves_by_attribute'] == {'rack': {3: ['fake_host']}}
+            assert mesos_tools.get_mesos_slaves_grouped_by_attribute('rack') == {3: ['fake_host']}
+    finally:
+        shutil.rmtree(tempdir)
+
+
+def test_get_mesos_state_cache_survives_unwritable_cache():
+    fake_state = {'slaves': []}
+    with contextlib.nested(
+        mock.patch.object(mesos_tools, '_mesos_state_cache', None),
+        mock.patch('paasta_tools.mesos_tools.get_mesos_state_from_leader', autospec=True,
+                   return_value=fake_state),
+    ):
+        actual = mesos_tools.get_mesos_state_cache(ttl=60, path='/this/dir/does/not/exist/mesos_state.json')
+        assert actual['state'] == fake_state
+
+
+def test_get_mesos_state_cache_ttl_without_paasta_config():
+    with mock.patch('paasta_tools.mesos_tools.load_system_paasta_config', autospec=True,
+                    side_effect=mesos_tools.PaastaNotConfiguredError):
+        assert mesos_tools.get_mesos_state_cache_ttl() == mesos_tools.DEFAULT_MESOS_STATE_CACHE_TTL_S
@@ -180,7 +180,7 @@ class TestMonitoring_Tools:
     def test_get_monitoring_config_value_with_monitor_config(self):
         expected = 'monitor_test_team'
         with contextlib.nested(
-            mock.patch('service_configuration_lib.read_service_configuration', autospec=True,
+            mock.patch('paasta_tools.monitoring_tools.read_service_configuration', autospec=True,
                        return_value=self.fake_general_service_config),
             mock.patch('paasta_tools.monitoring_tools.read_monitoring_config',
                        autospec=True, return_value=self.fake_monitor_config),
@@ -199,7 +199,7 @@ class TestMonitoring_Tools:
     def test_get_monitoring_config_value_with_service_config(self):
         expected = 'general_test_team'
         with contextlib.nested(
-            mock.patch('service_configuration_lib.read_service_configuration', autospec=True,
+            mock.patch('paasta_tools.monitoring_tools.read_service_configuration', autospec=True,
                        return_value=self.fake_general_service_config),
             mock.patch('paasta_tools.monitoring_tools.read_monitoring_config',
                        autospec=True, return_value=self.empty_monitor_config),
@@ -218,7 +218,7 @@ class TestMonitoring_Tools:
     def test_get_monitoring_config_value_with_defaults(self):
         expected = None
         with contextlib.nested(
-            mock.patch('service_configuration_lib.read_service_configuration', autospec=True,
+            mock.patch('paasta_tools.monitoring_tools.read_service_configuration', autospec=True,
                        return_value=self.empty_job_config),
             mock.patch('paasta_tools.monitoring_tools.read_monitoring_config',
                        autospec=True, return_value=self.empty_monitor_config),
@@ -413,21 +413,11 @@ class TestMonitoring_Tools:
 
     def test_read_monitoring_config(self):
         fake_name = 'partial'
-        fake_fname = 'acronyms'
-        fake_path = 'ever_patched'
         fake_soa_dir = '/nail/cte/oas'
         fake_dict = {'e': 'quail', 'v': 'snail'}
-        with contextlib.nested(
-            mock.patch('os.path.abspath', autospec=True, return_value=fake_path),
-            mock.patch('os.path.join', autospec=True, return_value=fake_fname),
-            mock.patch('service_configuration_lib.read_monitoring', autospec=True, return_value=fake_dict)
-        ) as (
-            abspath_patch,
-            join_patch,
-            read_monitoring_patch
-        ):
+        with mock.patch(
+            'paasta_tools.monitoring_tools.read_extra_service_information', autospec=True, return_value=fake_dict,
+        ) as read_extra_service_information_patch:
             actual = monitoring_tools.read_monitoring_config(fake_name, fake_soa_dir)
             assert fake_dict == actual
-            abspath_patch.assert_called_once_with(fake_soa_dir)
-            join_patch.assert_called_once_with(fake_path, fake_name, 'monitoring.yaml')
-            read_monitoring_patch.assert_called_once_with(fake_fname)
+            read_extra_service_information_patch.assert_called_once_with(fake_name, 'monitoring', soa_dir=fake_soa_dir)
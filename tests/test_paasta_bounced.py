@@ -0,0 +1,381 @@
+# Copyright 2015 Yelp Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import contextlib
+import threading
+
+import mock
+
+from paasta_tools import marathon_tools
+from paasta_tools import paasta_bounced
+
+
+def make_daemon(**kwargs):
+    kwargs.setdefault('bounce_interval_s', 10)
+    kwargs.setdefault('full_sync_interval_s', 600)
+    return paasta_bounced.BounceDaemon(
+        cluster='fake_cluster',
+        soa_dir='fake_soa_dir',
+        client=mock.Mock(),
+        marathon_config=mock.Mock(),
+        system_paasta_config=mock.Mock(),
+        zk=mock.Mock(),
+        jobs=2,
+        **kwargs
+    )
+
+
+def test_get_app_id_from_event():
+    assert paasta_bounced.get_app_id_from_event(
+        'status_update_event',
+        '{"appId": "/fake--service.main.gitabc.configdef", "taskStatus": "TASK_RUNNING"}',
+    ) == '/fake--service.main.gitabc.configdef'
+    assert paasta_bounced.get_app_id_from_event(
+        'api_post_event',
+        '{"appDefinition": {"id": "/fake--service.main.gitabc.configdef"}}',
+    ) == '/fake--service.main.gitabc.configdef'
+    assert paasta_bounced.get_app_id_from_event('deployment_success', '{"id": "fake_deployment"}') is None
+    assert paasta_bounced.get_app_id_from_event('status_update_event', 'not json') is None
+
+
+def test_get_service_instance_for_app_id():
+    app_id = '/%s' % marathon_tools.format_job_id('fake_service', 'main', 'gitabc', 'configdef')
+    assert paasta_bounced.get_service_instance_for_app_id(app_id) == ('fake_service', 'main')
+    assert paasta_bounced.get_service_instance_for_app_id('/not_paasta') is None
+
+
+def test_count_apps_by_service_instance():
+    fake_snapshot = marathon_tools.MarathonSnapshot(apps=[
+        mock.Mock(id='/fake--service.main.gitold.configold'),
+        mock.Mock(id='/fake--service.main.gitnew.confignew'),
+        mock.Mock(id='/fake--service.canary.gitnew.confignew'),
+        mock.Mock(id='/not_paasta'),
+    ], timestamp=0)
+    assert paasta_bounced.count_apps_by_service_instance(fake_snapshot) == {
+        ('fake_service', 'main'): 2,
+        ('fake_service', 'canary'): 1,
+    }
+
+
+def test_scan_soa_dir_marks_changed_services_dirty():
+    daemon = make_daemon()
+    signatures = {'fake_service': 'sig1', 'other_service': 'sig1', 'gone_service': 'sig1'}
+    instances = {
+        'fake_service': [('fake_service', 'main'), ('fake_service', 'canary')],
+        'other_service': [('other_service', 'main')],
+        'gone_service': [('gone_service', 'main')],
+    }
+    with contextlib.nested(
+        mock.patch('os.listdir', autospec=True),
+        mock.patch(
+            'paasta_tools.paasta_bounced.get_soa_service_signature',
+            autospec=True,
+            side_effect=lambda service, soa_dir: signatures[service],
+        ),
+        mock.patch(
+            'paasta_tools.paasta_bounced.get_service_instance_list',
+            autospec=True,
+            side_effect=lambda service, **kwargs: instances[service],
+        ),
+    ) as (listdir_patch, _, get_service_instance_list_patch):
+        listdir_patch.return_value = ['fake_service', 'other_service', 'gone_service']
+        assert daemon.scan_soa_dir() == set([
+            ('fake_service', 'main'),
+            ('fake_service', 'canary'),
+            ('other_service', 'main'),
+            ('gone_service', 'main'),
+        ])
+        assert daemon.take_dirty() == daemon.get_service_instances()
+        assert daemon.wakeup.is_set()
+
+        signatures['other_service'] = 'sig2'
+        listdir_patch.return_value = ['fake_service', 'other_service']
+        assert daemon.scan_soa_dir() == set([('other_service', 'main')])
+        assert daemon.take_dirty() == set([('other_service', 'main')])
+        assert daemon.get_service_instances() == set([
+            ('fake_service', 'main'),
+            ('fake_service', 'canary'),
+            ('other_service', 'main'),
+        ])
+        assert get_service_instance_list_patch.call_count == 4
+
+
+def test_scan_soa_dir_retries_services_which_fail_to_read():
+    daemon = make_daemon()
+    with contextlib.nested(
+        mock.patch('os.listdir', autospec=True, return_value=['fake_service']),
+        mock.patch('paasta_tools.paasta_bounced.get_soa_service_signature', autospec=True, return_value='sig1'),
+        mock.patch(
+            'paasta_tools.paasta_bounced.get_service_instance_list',
+            autospec=True,
+            side_effect=[ValueError('bad yaml'), [('fake_service', 'main')]],
+        ),
+    ):
+        assert daemon.scan_soa_dir() == set()
+        assert daemon.scan_soa_dir() == set([('fake_service', 'main')])
+
+
+def test_reload_config_only_when_changed():
+    daemon = make_daemon(config_signature='old_signature')
+    old_client = daemon.client
+    old_zk = daemon.zk
+    daemon.marathon_config.get_url.return_value = 'http://marathon'
+    daemon.system_paasta_config.get_zk_hosts.return_value = 'zk1:2181'
+    daemon.last_full_sync = 1000
+    fake_marathon_config = mock.Mock()
+    fake_marathon_config.get_url.return_value = 'http://new_marathon'
+    fake_system_paasta_config = mock.Mock()
+    fake_system_paasta_config.get_zk_hosts.return_value = 'zk1:2181'
+    fake_system_paasta_config.get_cluster.return_value = 'fake_cluster'
+    with contextlib.nested(
+        mock.patch('paasta_tools.paasta_bounced.get_system_paasta_config_signature', autospec=True,
+                   return_value='old_signature'),
+        mock.patch('paasta_tools.paasta_bounced.load_system_paasta_config', autospec=True,
+                   return_value=fake_system_paasta_config),
+        mock.patch('paasta_tools.paasta_bounced.get_main_marathon_config', autospec=True,
+                   return_value=fake_marathon_config),
+        mock.patch('paasta_tools.marathon_tools.get_marathon_client', autospec=True),
+        mock.patch('paasta_tools.paasta_bounced.get_zookeeper_client', autospec=True),
+    ) as (
+        signature_patch,
+        load_system_paasta_config_patch,
+        _,
+        get_marathon_client_patch,
+        get_zookeeper_client_patch,
+    ):
+        assert daemon.reload_config() is False
+        assert load_system_paasta_config_patch.call_count == 0
+
+        signature_patch.return_value = 'new_signature'
+        assert daemon.reload_config() is True
+        assert daemon.config_signature == 'new_signature'
+        assert daemon.system_paasta_config is fake_system_paasta_config
+        assert daemon.marathon_config is fake_marathon_config
+        # Marathon moved, so the client is replaced, but the zookeeper hosts are the same
+        assert daemon.client is get_marathon_client_patch.return_value
+        assert daemon.client is not old_client
+        assert daemon.zk is old_zk
+        assert get_zookeeper_client_patch.call_count == 0
+        # Every instance is set up again with the new config
+        assert daemon.needs_full_sync is True
+        assert daemon.last_full_sync == 1000
+
+
+def test_mark_app_dirty():
+    daemon = make_daemon()
+    daemon.instances_by_service = {'fake_service': [('fake_service', 'main')]}
+    daemon.mark_app_dirty('/fake--service.main.gitabc.configdef')
+    daemon.mark_app_dirty('/fake--service.canary.gitabc.configdef')
+    daemon.mark_app_dirty('/not_paasta')
+    assert daemon.take_dirty() == set([('fake_service', 'main')])
+    assert daemon.take_dirty() == set()
+
+
+def test_watch_marathon_events():
+    daemon = make_daemon()
+    stop = threading.Event()
+    fake_events = mock.Mock(client=daemon.client)
+
+    def iter_events():
+        yield 'status_update_event', '{"appId": "/fake--service.main.gitabc.configdef"}'
+        yield 'deployment_success', '{"id": "fake_deployment"}'
+        stop.set()
+        yield 'status_update_event', '{"appId": "/other--service.main.gitabc.configdef"}'
+
+    fake_events.iter_events.side_effect = iter_events
+    fake_events.is_available.return_value = True
+    with contextlib.nested(
+        mock.patch('paasta_tools.marathon_tools.MarathonEventStream', autospec=True, return_value=fake_events),
+        mock.patch.object(daemon, 'mark_app_dirty', autospec=True),
+    ) as (_, mark_app_dirty_patch):
+        daemon.watch_marathon_events(stop)
+    mark_app_dirty_patch.assert_called_once_with('/fake--service.main.gitabc.configdef')
+    fake_events.close.assert_called_once_with()
+
+
+def test_watch_marathon_events_reopens_stream_with_new_client():
+    daemon = make_daemon()
+    stop = threading.Event()
+    old_events = mock.Mock(client=daemon.client)
+    new_events = mock.Mock()
+    new_client = mock.Mock()
+
+    def iter_old_events():
+        daemon.client = new_client
+        return iter([])
+
+    def iter_new_events():
+        stop.set()
+        return iter([])
+
+    old_events.iter_events.side_effect = iter_old_events
+    new_events.client = new_client
+    new_events.iter_events.side_effect = iter_new_events
+    with contextlib.nested(
+        mock.patch('paasta_tools.marathon_tools.MarathonEventStream', autospec=True,
+                   side_effect=[old_events, new_events]),
+        mock.patch('paasta_tools.paasta_bounced.EVENT_STREAM_RECONNECT_DELAY_S', 0),
+    ) as (event_stream_patch, _):
+        daemon.watch_marathon_events(stop)
+    assert event_stream_patch.call_args[0][0] is new_client
+    assert old_events.close.call_count == 1
+
+
+def test_run_survives_failing_soa_dir_scan():
+    daemon = make_daemon()
+    stop = threading.Event()
+
+    def run_once(now):
+        stop.set()
+        return set()
+
+    with contextlib.nested(
+        mock.patch.object(daemon, 'watch_marathon_events', autospec=True),
+        mock.patch.object(daemon, 'reload_config', autospec=True),
+        mock.patch.object(daemon, 'scan_soa_dir', autospec=True, side_effect=OSError('soa dir went away')),
+        mock.patch.object(daemon, 'run_once', autospec=True, side_effect=run_once),
+    ) as (_, _, scan_soa_dir_patch, run_once_patch):
+        daemon.run(stop, soa_scan_interval_s=0)
+    assert scan_soa_dir_patch.call_count == 1
+    assert run_once_patch.call_count == 1
+
+
+def test_watch_marathon_events_without_event_stream():
+    daemon = make_daemon()
+    stop = threading.Event()
+    fake_events = mock.Mock(client=daemon.client)
+    fake_events.iter_events.return_value = iter([])
+    fake_events.is_available.return_value = False
+    with mock.patch('paasta_tools.marathon_tools.MarathonEventStream', autospec=True, return_value=fake_events):
+        daemon.watch_marathon_events(stop)
+    assert fake_events.iter_events.call_count == 1
+
+
+def test_run_cycle_tracks_unsettled_instances():
+    daemon = make_daemon()
+    daemon.unsettled = set([('fake_service', 'main'), ('untouched_service', 'main')])
+    fake_snapshot = marathon_tools.MarathonSnapshot(apps=[
+        mock.Mock(id='/fake--service.main.gitnew.confignew'),
+        mock.Mock(id='/fake--service.canary.gitold.configold'),
+        mock.Mock(id='/fake--service.canary.gitnew.confignew'),
+        mock.Mock(id='/fresh--service.main.gitold.configold'),
+        mock.Mock(id='/broken--service.main.gitold.configold'),
+    ], timestamp=0)
+    service_instances = set([
+        ('fake_service', 'main'),
+        ('fake_service', 'canary'),
+        ('fresh_service', 'main'),
+        ('broken_service', 'main'),
+    ])
+    with contextlib.nested(
+        mock.patch('paasta_tools.marathon_tools.fetch_marathon_snapshot', autospec=True, return_value=fake_snapshot),
+        mock.patch(
+            'paasta_tools.paasta_bounced.setup_service_instances',
+            autospec=True,
+            side_effect=lambda service_instances, **kwargs: [
+                (service, instance, 1 if service == 'broken_service' else 0)
+                for service, instance in service_instances
+            ],
+        ),
+    ) as (_, setup_service_instances_patch):
+        daemon.run_cycle(service_instances, fresh=set([('fresh_service', 'main')]))
+    setup_service_instances_patch.assert_called_once_with(
+        service_instances=sorted(service_instances),
+        client=daemon.client,
+        marathon_config=daemon.marathon_config,
+        soa_dir='fake_soa_dir',
+        jobs=2,
+        marathon_snapshot=fake_snapshot,
+        system_paasta_config=daemon.system_paasta_config,
+        zk=daemon.zk,
+    )
+    # fake_service.main finished bouncing, fake_service.canary is still bouncing, fresh_service.main
+    # is set up once more to find out whether it started a bounce, and broken_service.main failed.
+    assert daemon.unsettled == set([
+        ('fake_service', 'canary'),
+        ('fresh_service', 'main'),
+        ('broken_service', 'main'),
+        ('untouched_service', 'main'),
+    ])
+
+
+def test_run_once():
+    daemon = make_daemon(bounce_interval_s=10, full_sync_interval_s=600)
+    daemon.instances_by_service = {
+        'fake_service': [('fake_service', 'main'), ('fake_service', 'canary')],
+    }
+    with contextlib.nested(
+        mock.patch('paasta_tools.paasta_bounced.is_mesos_leader', autospec=True, return_value=True),
+        mock.patch.object(daemon, 'run_cycle', autospec=True),
+    ) as (_, run_cycle_patch):
+        # The first cycle is a full sync, which doesn't make instances fresh
+        assert daemon.run_once(now=1000) == set([('fake_service', 'main'), ('fake_service', 'canary')])
+        run_cycle_patch.assert_called_once_with(set([('fake_service', 'main'), ('fake_service', 'canary')]), set())
+
+        # Nothing changed
+        assert daemon.run_once(now=1001) == set()
+        assert run_cycle_patch.call_count == 1
+
+        daemon.mark_dirty([('fake_service', 'main')])
+        daemon.unsettled = set([('fake_service', 'canary')])
+        daemon.last_bounce = 1001
+        assert daemon.run_once(now=1002) == set([('fake_service', 'main')])
+        run_cycle_patch.assert_called_with(set([('fake_service', 'main')]), set([('fake_service', 'main')]))
+
+        # Unsettled instances are set up every bounce_interval_s
+        assert daemon.run_once(now=1012) == set([('fake_service', 'canary')])
+        run_cycle_patch.assert_called_with(set([('fake_service', 'canary')]), set())
+        assert daemon.run_once(now=1013) == set()
+
+        assert daemon.run_once(now=1600) == set([('fake_service', 'main'), ('fake_service', 'canary')])
+
+        # So does a changed config, with fresh instances kept apart
+        daemon.needs_full_sync = True
+        daemon.mark_dirty([('fake_service', 'canary')])
+        assert daemon.run_once(now=1601) == set([('fake_service', 'main'), ('fake_service', 'canary')])
+        run_cycle_patch.assert_called_with(
+            set([('fake_service', 'main'), ('fake_service', 'canary')]), set([('fake_service', 'canary')]))
+        assert daemon.needs_full_sync is False
+
+
+def test_run_once_not_leader():
+    daemon = make_daemon()
+    daemon.instances_by_service = {'fake_service': [('fake_service', 'main')]}
+    daemon.last_full_sync = 1000
+    daemon.mark_dirty([('fake_service', 'main')])
+    daemon.wakeup.clear()
+    with contextlib.nested(
+        mock.patch('paasta_tools.paasta_bounced.is_mesos_leader', autospec=True, return_value=False),
+        mock.patch.object(daemon, 'run_cycle', autospec=True),
+    ) as (is_mesos_leader_patch, run_cycle_patch):
+        assert daemon.run_once(now=1001) == set()
+        # A standby doesn't keep marking instances dirty, which would wake it up straight away
+        assert daemon.run_once(now=1002) == set()
+        assert daemon.take_dirty() == set()
+        assert not daemon.wakeup.is_set()
+        assert is_mesos_leader_patch.call_count == 2
+        assert run_cycle_patch.call_count == 0
+
+        # A full sync is done as soon as this host becomes the leader
+        is_mesos_leader_patch.return_value = True
+        assert daemon.run_once(now=1003) == set([('fake_service', 'main')])
+        run_cycle_patch.assert_called_once_with(set([('fake_service', 'main')]), set())
+
+
+def test_run_once_nothing_to_do_skips_leader_check():
+    daemon = make_daemon()
+    daemon.last_full_sync = 1000
+    with mock.patch('paasta_tools.paasta_bounced.is_mesos_leader', autospec=True) as is_mesos_leader_patch:
+        assert daemon.run_once(now=1001) == set()
+    assert is_mesos_leader_patch.call_count == 0
@@ -15,11 +15,13 @@
 
 
 import contextlib
+import json
 import mock
 
 import marathon
 from pysensu_yelp import Status
 
+import pytest
 from pytest import raises
 from paasta_tools import marathon_tools, bounce_lib
 from paasta_tools.bounce_lib import list_bounce_methods
@@ -28,6 +30,16 @@ from paasta_tools.utils import decompose_job_id
 from paasta_tools.utils import NoDeploymentsAvailable
 from paasta_tools.utils import NoDockerImageError
 from paasta_tools import setup_marathon_job
+from paasta_tools import drain_lib
+
+
+def make_fake_drain_method(**kwargs):
+    """Returns a DrainMethod whose per-task methods are mocks, with the given side effects,
+    so that the batch methods it inherits call them."""
+    fake_drain_method = drain_lib.DrainMethod('fake_service', 'fake_instance', 'fake_nerve_ns')
+    for name in ('drain', 'stop_draining', 'is_draining', 'is_safe_to_kill'):
+        setattr(fake_drain_method, name, mock.Mock(side_effect=kwargs.get(name)))
+    return fake_drain_method
 
 
 class TestSetupMarathonJob:
@@ -58,6 +70,7 @@ class TestSetupMarathonJob:
         service_instance='what_is_love.bby_dont_hurt_me',
         soa_dir='no_more',
         verbose=False,
+        marathon_snapshot=None,
     )
     fake_service_namespace_config = marathon_tools.ServiceNamespaceConfig({
         'mode': 'http'
@@ -126,6 +139,9 @@ class TestSetupMarathonJob:
                 self.fake_marathon_config,
                 self.fake_marathon_service_config,
                 'no_more',
+                None,
+                system_paasta_config=load_system_paasta_config_patch.return_value,
+                zk=None,
             )
             sys_exit_patch.assert_called_once_with(0)
 
@@ -190,6 +206,9 @@ class TestSetupMarathonJob:
                 self.fake_marathon_config,
                 self.fake_marathon_service_config,
                 'no_more',
+                None,
+                system_paasta_config=load_system_paasta_config_patch.return_value,
+                zk=None,
             )
             sys_exit_patch.assert_called_once_with(0)
 
@@ -253,7 +272,8 @@ class TestSetupMarathonJob:
                 decompose_job_id(self.fake_args.service_instance)[1],
                 self.fake_args.soa_dir,
                 Status.CRITICAL,
-                expected_string
+                expected_string,
+                cluster=self.fake_cluster,
             )
             assert exc_info.value.code == 0
 
@@ -354,7 +374,7 @@ class TestSetupMarathonJob:
         self.fake_cluster = 'fake_cluster'
         fake_instance = 'fake_instance'
         fake_bounce_method = 'fake_bounce_method'
-        fake_drain_method = mock.Mock(is_safe_to_kill=lambda t: False)
+        fake_drain_method = make_fake_drain_method(is_safe_to_kill=lambda t: False)
         fake_marathon_jobid = 'fake.marathon.jobid'
         fake_client = mock.create_autospec(
             marathon.MarathonClient
@@ -417,7 +437,7 @@ class TestSetupMarathonJob:
         self.fake_cluster = 'fake_cluster'
         fake_instance = 'fake_instance'
         fake_bounce_method = 'fake_bounce_method'
-        fake_drain_method = mock.Mock(is_safe_to_kill=lambda t: False)
+        fake_drain_method = make_fake_drain_method(is_safe_to_kill=lambda t: False)
         fake_marathon_jobid = 'fake.marathon.jobid'
         fake_client = mock.create_autospec(
             marathon.MarathonClient
@@ -478,7 +498,7 @@ class TestSetupMarathonJob:
         self.fake_cluster = 'fake_cluster'
         fake_instance = 'fake_instance'
         fake_bounce_method = 'fake_bounce_method'
-        fake_drain_method = mock.Mock(is_safe_to_kill=lambda t: False)
+        fake_drain_method = make_fake_drain_method(is_safe_to_kill=lambda t: False)
         fake_marathon_jobid = 'fake.marathon.jobid'
         fake_client = mock.create_autospec(
             marathon.MarathonClient
@@ -520,6 +540,51 @@ class TestSetupMarathonJob:
             assert mock_kill_old_ids.call_count == 0
             assert fake_drain_method.drain.call_count == expected_drain_task_count
 
+    def test_do_bounce_when_tasks_fail_to_be_killed(self):
+        fake_killed_task = mock.Mock(id='fake_killed_task', app_id='fake_app_to_kill_1')
+        fake_unkillable_task = mock.Mock(id='fake_unkillable_task', app_id='fake_app_to_kill_1')
+        fake_bounce_func = mock.create_autospec(
+            bounce_lib.brutal_bounce,
+            return_value={'create_app': False, 'tasks_to_drain': []},
+        )
+        fake_drain_method = make_fake_drain_method(is_safe_to_kill=lambda t: True)
+        fake_client = mock.create_autospec(
+            marathon.MarathonClient
+        )
+
+        with contextlib.nested(
+            mock.patch('paasta_tools.setup_marathon_job._log', autospec=True),
+            mock.patch(
+                'paasta_tools.setup_marathon_job.bounce_lib.kill_tasks',
+                autospec=True,
+                return_value={fake_unkillable_task: marathon.MarathonError('no such task')},
+            ),
+            mock.patch('paasta_tools.setup_marathon_job.bounce_lib.kill_old_ids', autospec=True),
+        ) as (mock_log, mock_kill_tasks, mock_kill_old_ids):
+            setup_marathon_job.do_bounce(
+                bounce_func=fake_bounce_func,
+                drain_method=fake_drain_method,
+                config={'instances': 5},
+                new_app_running=True,
+                happy_new_tasks=['fake_one', 'fake_two', 'fake_three', 'fake_four', 'fake_five'],
+                old_app_live_tasks={'fake_app_to_kill_1': set()},
+                old_app_draining_tasks={'fake_app_to_kill_1': set([fake_killed_task, fake_unkillable_task])},
+                service='fake_service',
+                bounce_method='fake_bounce_method',
+                serviceinstance='fake_service.fake_instance',
+                cluster='fake_cluster',
+                instance='fake_instance',
+                marathon_jobid='fake.marathon.jobid',
+                client=fake_client,
+                soa_dir='fake_soa_dir',
+            )
+            mock_kill_tasks.assert_called_once_with(set([fake_killed_task, fake_unkillable_task]), fake_client)
+            logged_lines = [call[2]['line'] for call in mock_log.mock_calls]
+            assert 'fake_bounce_method bounce failed to kill drained task fake_unkillable_task: no such task' \
+                in logged_lines
+            # The old app still has a task, so it must not be removed yet
+            assert mock_kill_old_ids.call_count == 0
+
     def test_do_bounce_when_apps_to_kill(self):
         fake_bounce_func_return = {
             'create_app': False,
@@ -539,7 +604,7 @@ class TestSetupMarathonJob:
         self.fake_cluster = 'fake_cluster'
         fake_instance = 'fake_instance'
         fake_bounce_method = 'fake_bounce_method'
-        fake_drain_method = mock.Mock()
+        fake_drain_method = make_fake_drain_method()
         fake_marathon_jobid = 'fake.marathon.jobid'
         fake_client = mock.create_autospec(
             marathon.MarathonClient
@@ -603,7 +668,7 @@ class TestSetupMarathonJob:
         self.fake_cluster = 'fake_cluster'
         fake_instance = 'fake_instance'
         fake_bounce_method = 'fake_bounce_method'
-        fake_drain_method = mock.Mock()
+        fake_drain_method = make_fake_drain_method()
         fake_marathon_jobid = 'fake.marathon.jobid'
         fake_client = mock.create_autospec(
             marathon.MarathonClient
@@ -649,6 +714,158 @@ class TestSetupMarathonJob:
                 soa_dir='fake_soa_dir',
             )
 
+    def test_do_bounce_creates_new_app_with_new_app_instances(self):
+        fake_bounce_func = mock.create_autospec(
+            bounce_lib.brutal_bounce,
+            return_value={'create_app': True, 'tasks_to_drain': set(), 'new_app_instances': 2},
+        )
+        fake_client = mock.create_autospec(marathon.MarathonClient)
+
+        with contextlib.nested(
+            mock.patch('paasta_tools.setup_marathon_job._log', autospec=True),
+            mock.patch('paasta_tools.setup_marathon_job.bounce_lib.create_marathon_app', autospec=True),
+        ) as (_, mock_create_marathon_app):
+            setup_marathon_job.do_bounce(
+                bounce_func=fake_bounce_func,
+                drain_method=make_fake_drain_method(),
+                config={'id': 'fake.marathon.jobid', 'instances': 5},
+                new_app_running=False,
+                happy_new_tasks=[],
+                old_app_live_tasks={'fake_old_app': set([mock.Mock()])},
+                old_app_draining_tasks={'fake_old_app': set()},
+                service='fake_service',
+                bounce_method='rolling',
+                serviceinstance='fake_service.fake_instance',
+                cluster=self.fake_cluster,
+                instance='fake_instance',
+                marathon_jobid='fake.marathon.jobid',
+                client=fake_client,
+                soa_dir='fake_soa_dir',
+            )
+        mock_create_marathon_app.assert_called_once_with(
+            'fake.marathon.jobid',
+            {'id': 'fake.marathon.jobid', 'instances': 2},
+            fake_client,
+        )
+
+    def do_bounce_with_new_app(self, actions, new_app_instances, old_app_live_tasks, old_app_draining_tasks,
+                               drain_method=None):
+        """Runs do_bounce with a bounce method returning actions while the new app runs new_app_instances tasks,
+        and returns the fake MarathonClient it was given."""
+        fake_bounce_func = mock.create_autospec(bounce_lib.brutal_bounce, return_value=actions)
+        fake_client = mock.create_autospec(marathon.MarathonClient)
+
+        with contextlib.nested(
+            mock.patch('paasta_tools.setup_marathon_job._log', autospec=True),
+            mock.patch('paasta_tools.setup_marathon_job.bounce_lib.create_marathon_app', autospec=True),
+            mock.patch('paasta_tools.setup_marathon_job.bounce_lib.kill_tasks', autospec=True, return_value={}),
+            mock.patch('paasta_tools.setup_marathon_job.bounce_lib.kill_old_ids', autospec=True),
+            mock.patch('paasta_tools.setup_marathon_job.send_sensu_bounce_keepalive', autospec=True),
+        ) as (_, mock_create_marathon_app, _, _, _):
+            setup_marathon_job.do_bounce(
+                bounce_func=fake_bounce_func,
+                drain_method=drain_method or make_fake_drain_method(),
+                config={'id': 'fake.marathon.jobid', 'instances': 5},
+                new_app_running=True,
+                happy_new_tasks=[],
+                old_app_live_tasks=old_app_live_tasks,
+                old_app_draining_tasks=old_app_draining_tasks,
+                service='fake_service',
+                bounce_method='rolling',
+                serviceinstance='fake_service.fake_instance',
+                cluster=self.fake_cluster,
+                instance='fake_instance',
+                marathon_jobid='fake.marathon.jobid',
+                client=fake_client,
+                soa_dir='fake_soa_dir',
+                new_app_instances=new_app_instances,
+            )
+        assert mock_create_marathon_app.call_count == 0
+        return fake_client
+
+    @pytest.mark.parametrize(('current_instances', 'expected_scale_calls'), [(2, 1), (4, 0), (6, 0)])
+    def test_do_bounce_only_scales_new_app_up(self, current_instances, expected_scale_calls):
+        fake_client = self.do_bounce_with_new_app(
+            actions={'create_app': False, 'tasks_to_drain': set(), 'new_app_instances': 4},
+            new_app_instances=current_instances,
+            old_app_live_tasks={'fake_old_app': set([mock.Mock()])},
+            old_app_draining_tasks={'fake_old_app': set()},
+        )
+        assert fake_client.scale_app.call_count == expected_scale_calls
+        if expected_scale_calls:
+            fake_client.scale_app.assert_called_once_with('fake.marathon.jobid', instances=4, force=True)
+
+    def test_do_bounce_does_not_scale_new_app_without_old_apps(self):
+        """Once the bounce is over, a scale down of the new app, e.g. in an emergency, should be left alone."""
+        fake_client = self.do_bounce_with_new_app(
+            actions={'create_app': False, 'tasks_to_drain': set(), 'new_app_instances': 5},
+            new_app_instances=2,
+            old_app_live_tasks={},
+            old_app_draining_tasks={},
+        )
+        assert fake_client.scale_app.call_count == 0
+
+    def test_do_bounce_scales_new_app_to_full_size_for_other_bounce_methods(self):
+        """If the bounce method changes from rolling mid-bounce, the new app should not be left undersized."""
+        fake_client = self.do_bounce_with_new_app(
+            actions={'create_app': False, 'tasks_to_drain': set()},
+            new_app_instances=2,
+            old_app_live_tasks={'fake_old_app': set([mock.Mock()])},
+            old_app_draining_tasks={'fake_old_app': set()},
+        )
+        fake_client.scale_app.assert_called_once_with('fake.marathon.jobid', instances=5, force=True)
+
+    def test_do_bounce_scales_new_app_to_full_size_when_killing_last_old_app(self):
+        """This is the last run with old apps, so the new app must reach its full size now."""
+        fake_client = self.do_bounce_with_new_app(
+            actions={'create_app': False, 'tasks_to_drain': set(), 'new_app_instances': 3},
+            new_app_instances=3,
+            old_app_live_tasks={'fake_old_app': set()},
+            old_app_draining_tasks={'fake_old_app': set([mock.Mock()])},
+            drain_method=make_fake_drain_method(is_safe_to_kill=lambda t: True),
+        )
+        fake_client.scale_app.assert_called_once_with('fake.marathon.jobid', instances=5, force=True)
+
+    @pytest.mark.parametrize('error', [
+        marathon.MarathonError('fake error'),
+        bounce_lib.LockLostException('fake lock lost'),
+    ])
+    def test_do_bounce_keeps_last_old_app_if_scale_fails(self, error):
+        """If the new app can't be brought to full size, the old app must survive so the next run tries again."""
+        fake_bounce_func = mock.create_autospec(
+            bounce_lib.brutal_bounce,
+            return_value={'create_app': False, 'tasks_to_drain': set(), 'new_app_instances': 3},
+        )
+        fake_client = mock.create_autospec(marathon.MarathonClient)
+        fake_client.scale_app.side_effect = error
+        with contextlib.nested(
+            mock.patch('paasta_tools.setup_marathon_job._log', autospec=True),
+            mock.patch('paasta_tools.setup_marathon_job.bounce_lib.kill_tasks', autospec=True, return_value={}),
+            mock.patch('paasta_tools.setup_marathon_job.bounce_lib.kill_old_ids', autospec=True),
+            mock.patch('paasta_tools.setup_marathon_job.send_sensu_bounce_keepalive', autospec=True),
+        ) as (_, _, mock_kill_old_ids, _):
+            with raises(type(error)):
+                setup_marathon_job.do_bounce(
+                    bounce_func=fake_bounce_func,
+                    drain_method=make_fake_drain_method(is_safe_to_kill=lambda t: True),
+                    config={'id': 'fake.marathon.jobid', 'instances': 5},
+                    new_app_running=True,
+                    happy_new_tasks=[],
+                    old_app_live_tasks={'fake_old_app': set()},
+                    old_app_draining_tasks={'fake_old_app': set([mock.Mock()])},
+                    service='fake_service',
+                    bounce_method='rolling',
+                    serviceinstance='fake_service.fake_instance',
+                    cluster=self.fake_cluster,
+                    instance='fake_instance',
+                    marathon_jobid='fake.marathon.jobid',
+                    client=fake_client,
+                    soa_dir='fake_soa_dir',
+                    new_app_instances=3,
+                )
+        fake_client.scale_app.assert_called_once_with('fake.marathon.jobid', instances=5, force=True)
+        assert mock_kill_old_ids.call_count == 0
+
     def test_setup_service_srv_already_exists(self):
         fake_name = 'if_trees_could_talk'
         fake_instance = 'would_they_scream'
@@ -692,6 +909,7 @@ class TestSetupMarathonJob:
                 fake_name,
                 fake_instance,
                 self.fake_marathon_config,
+                system_paasta_config=None,
             )
             assert deploy_service_patch.call_count == 1
 
@@ -772,7 +990,8 @@ class TestSetupMarathonJob:
             create_config_patch.assert_called_once_with(
                 fake_name,
                 fake_instance,
-                self.fake_marathon_config
+                self.fake_marathon_config,
+                system_paasta_config=None,
             )
             get_bounce_patch.assert_called_once_with()
             get_drain_method_patch.assert_called_once_with(read_namespace_conf_patch.return_value)
@@ -789,6 +1008,10 @@ class TestSetupMarathonJob:
                 bounce_health_params=self.fake_marathon_service_config.get_bounce_health_params(
                     read_namespace_conf_patch.return_value),
                 soa_dir=None,
+                marathon_snapshot=None,
+                system_paasta_config=None,
+                zk=None,
+                bounce_method_params={},
             )
 
     def test_setup_service_srv_complete_config_raises(self):
@@ -915,7 +1138,10 @@ class TestSetupMarathonJob:
             }
         )
 
-        fake_drain_method = mock.Mock(is_draining=lambda t: t is old_task_is_draining, is_safe_to_kill=lambda t: True)
+        fake_drain_method = make_fake_drain_method(
+            is_draining=lambda t: t is old_task_is_draining,
+            is_safe_to_kill=lambda t: True,
+        )
 
         with contextlib.nested(
             mock.patch(
@@ -960,15 +1186,22 @@ class TestSetupMarathonJob:
                 new_app_running=False,
                 happy_new_tasks=[],
                 old_app_live_tasks={old_app.id: set([old_task_to_drain, old_task_dont_drain])},
+                old_app_draining_tasks={old_app.id: set([old_task_is_draining])},
             )
 
             assert fake_drain_method.drain.call_count == 2
             fake_drain_method.drain.assert_any_call(old_task_is_draining)
             fake_drain_method.drain.assert_any_call(old_task_to_drain)
 
-            assert fake_client.kill_task.call_count == 2
-            fake_client.kill_task.assert_any_call(old_app_id, old_task_is_draining.id, scale=True)
-            fake_client.kill_task.assert_any_call(old_app_id, old_task_to_drain.id, scale=True)
+            assert fake_client.kill_task.call_count == 0
+            assert fake_client._do_request.call_count == 1
+            method, path = fake_client._do_request.call_args[0]
+            assert (method, path) == ('POST', '/v2/tasks/delete')
+            assert fake_client._do_request.call_args[1]['params'] == {'scale': True}
+            assert sorted(json.loads(fake_client._do_request.call_args[1]['data'])['ids']) == [
+                old_task_is_draining.id,
+                old_task_to_drain.id,
+            ]
 
             create_marathon_app_patch.assert_called_once_with(fake_config['id'], fake_config, fake_client)
             assert kill_old_ids_patch.call_count == 0
@@ -982,6 +1215,104 @@ class TestSetupMarathonJob:
 
             assert mock_log.call_count == 5
 
+    def test_deploy_service_passes_bounce_method_params(self):
+        fake_name = 'fake_service'
+        fake_instance = 'fake_instance'
+        fake_id = marathon_tools.format_job_id(fake_name, fake_instance, 'git11111111', 'config11111111')
+        fake_config = {'id': fake_id, 'instances': 10}
+        new_app = mock.Mock(id='/%s' % fake_id, tasks=[], instances=3)
+        fake_client = mock.MagicMock(list_apps=mock.Mock(return_value=[new_app]))
+
+        with contextlib.nested(
+            mock.patch('paasta_tools.bounce_lib.bounce_lock_zookeeper', autospec=True),
+            mock.patch('paasta_tools.bounce_lib.get_happy_tasks', autospec=True, return_value=[]),
+            mock.patch('paasta_tools.setup_marathon_job.load_system_paasta_config', autospec=True),
+            mock.patch('paasta_tools.setup_marathon_job.do_bounce', autospec=True),
+        ) as (_, _, _, do_bounce_patch):
+            result = setup_marathon_job.deploy_service(
+                service=fake_name,
+                instance=fake_instance,
+                marathon_jobid=fake_id,
+                config=fake_config,
+                client=fake_client,
+                bounce_method='rolling',
+                drain_method_name='noop',
+                drain_method_params={},
+                nerve_ns=fake_instance,
+                bounce_health_params={},
+                soa_dir='fake_soa_dir',
+                bounce_method_params={'max_surge': 2, 'max_unavailable': 1},
+            )
+        assert result[0] == 0
+        assert do_bounce_patch.call_args[1]['new_app_instances'] == 3
+        bounce_func = do_bounce_patch.call_args[1]['bounce_func']
+        assert bounce_func.func is bounce_lib.rolling_bounce
+        assert bounce_func.keywords == {'max_surge': 2, 'max_unavailable': 1}
+
+    def test_deploy_service_ignores_legacy_bounce_method_params(self):
+        fake_name = 'fake_service'
+        fake_instance = 'fake_instance'
+        fake_id = marathon_tools.format_job_id(fake_name, fake_instance, 'git11111111', 'config11111111')
+        fake_config = {'id': fake_id, 'instances': 10}
+        fake_client = mock.MagicMock(list_apps=mock.Mock(return_value=[]))
+
+        with contextlib.nested(
+            mock.patch('paasta_tools.bounce_lib.bounce_lock_zookeeper', autospec=True),
+            mock.patch('paasta_tools.setup_marathon_job.load_system_paasta_config', autospec=True),
+            mock.patch('paasta_tools.setup_marathon_job.do_bounce', autospec=True),
+            mock.patch('paasta_tools.setup_marathon_job._log', autospec=True),
+        ) as (_, _, do_bounce_patch, mock_log):
+            result = setup_marathon_job.deploy_service(
+                service=fake_name,
+                instance=fake_instance,
+                marathon_jobid=fake_id,
+                config=fake_config,
+                client=fake_client,
+                bounce_method='crossover',
+                drain_method_name='noop',
+                drain_method_params={},
+                nerve_ns=fake_instance,
+                bounce_health_params={},
+                soa_dir='fake_soa_dir',
+                bounce_method_params={'check_haproxy': True, 'min_task_uptime': 30},
+            )
+        assert result[0] == 0
+        assert do_bounce_patch.call_args[1]['bounce_func'] is bounce_lib.crossover_bounce
+        logged_lines = [call[1]['line'] for call in mock_log.call_args_list]
+        assert any(
+            'check_haproxy, min_task_uptime' in line and 'bounce_health_params' in line
+            for line in logged_lines
+        )
+
+    def test_deploy_service_stops_when_lock_is_lost(self):
+        fake_name = 'fake_service'
+        fake_instance = 'fake_instance'
+        fake_id = marathon_tools.format_job_id(fake_name, fake_instance, 'git11111111', 'config11111111')
+        fake_client = mock.MagicMock(list_apps=mock.Mock(return_value=[]))
+
+        with contextlib.nested(
+            mock.patch('paasta_tools.bounce_lib.bounce_lock_zookeeper', autospec=True),
+            mock.patch('paasta_tools.setup_marathon_job.load_system_paasta_config', autospec=True),
+            mock.patch('paasta_tools.setup_marathon_job.do_bounce', autospec=True,
+                       side_effect=bounce_lib.LockLostException('lost it')),
+            mock.patch('paasta_tools.setup_marathon_job._log', autospec=True),
+        ):
+            result = setup_marathon_job.deploy_service(
+                service=fake_name,
+                instance=fake_instance,
+                marathon_jobid=fake_id,
+                config={'id': fake_id, 'instances': 1},
+                client=fake_client,
+                bounce_method='crossover',
+                drain_method_name='noop',
+                drain_method_params={},
+                nerve_ns=fake_instance,
+                bounce_health_params={},
+                soa_dir='fake_soa_dir',
+            )
+        assert result[0] == 1
+        assert 'lost it' in result[1]
+
     def test_deploy_service_already_bouncing(self):
         fake_bounce = 'areallygoodbouncestrategy'
         fake_drain_method = 'noop'
@@ -1078,6 +1409,66 @@ class TestSetupMarathonJob:
             assert fake_name in mock_log.mock_calls[0][2]["line"]
             assert 'Traceback' in mock_log.mock_calls[1][2]["line"]
 
+    def test_deploy_service_reads_apps_from_snapshot(self):
+        fake_bounce = 'WHEEEEEEEEEEEEEEEE'
+        fake_drain_method = 'noop'
+        fake_name = 'whoa'
+        fake_instance = 'the_earth_is_tiny'
+        fake_id = marathon_tools.format_job_id(fake_name, fake_instance)
+        fake_apps = [mock.Mock(id=fake_id, tasks=[]), mock.Mock(id=('%s2' % fake_id), tasks=[])]
+        fake_client = mock.MagicMock()
+        fake_snapshot = mock.Mock(list_apps=mock.Mock(return_value=fake_apps))
+        fake_config = {'id': fake_id, 'instances': 2}
+
+        with contextlib.nested(
+            mock.patch('paasta_tools.setup_marathon_job._log', autospec=True),
+            mock.patch('paasta_tools.setup_marathon_job.load_system_paasta_config', autospec=True),
+        ) as (mock_log, mock_load_system_paasta_config):
+            mock_load_system_paasta_config.return_value.get_cluster = mock.Mock(return_value='fake_cluster')
+            setup_marathon_job.deploy_service(
+                service=fake_name,
+                instance=fake_instance,
+                marathon_jobid=fake_id,
+                config=fake_config,
+                client=fake_client,
+                bounce_method=fake_bounce,
+                drain_method_name=fake_drain_method,
+                drain_method_params={},
+                nerve_ns=fake_instance,
+                bounce_health_params={},
+                soa_dir='fake_soa_dir',
+                marathon_snapshot=fake_snapshot,
+            )
+        fake_snapshot.list_apps.assert_called_once_with(embed_failures=True)
+        assert fake_client.list_apps.call_count == 0
+
+    def test_get_marathon_snapshot(self):
+        fake_snapshot = mock.Mock(is_stale=mock.Mock(return_value=False))
+        with mock.patch(
+            'paasta_tools.marathon_tools.load_marathon_snapshot',
+            return_value=fake_snapshot,
+            autospec=True,
+        ) as load_snapshot_patch:
+            assert setup_marathon_job.get_marathon_snapshot('/fake/snapshot') == fake_snapshot
+            load_snapshot_patch.assert_called_once_with('/fake/snapshot')
+
+    def test_get_marathon_snapshot_stale(self):
+        fake_snapshot = mock.Mock(is_stale=mock.Mock(return_value=True), get_age=mock.Mock(return_value=1000))
+        with mock.patch(
+            'paasta_tools.marathon_tools.load_marathon_snapshot',
+            return_value=fake_snapshot,
+            autospec=True,
+        ):
+            assert setup_marathon_job.get_marathon_snapshot('/fake/snapshot') is None
+
+    def test_get_marathon_snapshot_not_available(self):
+        with mock.patch(
+            'paasta_tools.marathon_tools.load_marathon_snapshot',
+            side_effect=marathon_tools.MarathonSnapshotNotAvailable('nope'),
+            autospec=True,
+        ):
+            assert setup_marathon_job.get_marathon_snapshot('/fake/snapshot') is None
+
     def test_get_marathon_config(self):
         fake_conf = {'oh_no': 'im_a_ghost'}
         with mock.patch(
@@ -1107,7 +1498,7 @@ class TestSetupMarathonJob:
             fake_apps[1].id: set(),
         }
 
-        fake_drain_method = mock.Mock(is_draining=lambda _: True)
+        fake_drain_method = make_fake_drain_method(is_draining=lambda _: True)
 
         actual = setup_marathon_job.get_old_live_draining_tasks(fake_apps, fake_drain_method)
         actual_live_tasks, actual_draining_tasks = actual
@@ -1135,7 +1526,7 @@ class TestSetupMarathonJob:
             fake_apps[1].id: set([fake_apps[1].tasks[1]]),
         }
 
-        fake_drain_method = mock.Mock(is_draining=lambda t: t._drain_state == 'down')
+        fake_drain_method = make_fake_drain_method(is_draining=lambda t: t._drain_state == 'down')
 
         actual = setup_marathon_job.get_old_live_draining_tasks(fake_apps, fake_drain_method)
         actual_live_tasks, actual_draining_tasks = actual
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# Copyright 2015 Yelp Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import contextlib
+
+import mock
+from pytest import raises
+
+from paasta_tools import setup_marathon_jobs
+
+
+def test_setup_service_instances():
+    fake_client = mock.Mock()
+    fake_marathon_config = mock.Mock()
+    fake_snapshot = mock.Mock(is_stale=mock.Mock(return_value=False))
+    fake_system_paasta_config = mock.Mock()
+    fake_zk = mock.Mock()
+    service_instances = [('fake_service', 'main'), ('fake_service', 'canary'), ('other_service', 'main')]
+    with mock.patch(
+        'paasta_tools.setup_marathon_jobs.setup_service_instance',
+        autospec=True,
+        side_effect=lambda service, instance, **kwargs: 1 if instance == 'canary' else 0,
+    ) as setup_service_instance_patch:
+        actual = setup_marathon_jobs.setup_service_instances(
+            service_instances=service_instances,
+            client=fake_client,
+            marathon_config=fake_marathon_config,
+            soa_dir='fake_soa_dir',
+            jobs=2,
+            marathon_snapshot=fake_snapshot,
+            system_paasta_config=fake_system_paasta_config,
+            zk=fake_zk,
+        )
+        assert actual == [('fake_service', 'main', 0), ('fake_service', 'canary', 1), ('other_service', 'main', 0)]
+        assert setup_service_instance_patch.call_count == 3
+        setup_service_instance_patch.assert_any_call(
+            'other_service',
+            'main',
+            client=fake_client,
+            marathon_config=fake_marathon_config,
+            soa_dir='fake_soa_dir',
+            marathon_snapshot=fake_snapshot,
+            system_paasta_config=fake_system_paasta_config,
+            zk=fake_zk,
+        )
+
+
+def test_setup_service_instances_refreshes_stale_snapshot():
+    fake_client = mock.Mock()
+    stale_snapshot = mock.Mock(is_stale=mock.Mock(return_value=True))
+    with contextlib.nested(
+        mock.patch('paasta_tools.setup_marathon_jobs.setup_service_instance', autospec=True, return_value=0),
+        mock.patch('paasta_tools.marathon_tools.fetch_marathon_snapshot', autospec=True),
+    ) as (setup_service_instance_patch, fetch_marathon_snapshot_patch):
+        fetch_marathon_snapshot_patch.return_value.is_stale.return_value = False
+        setup_marathon_jobs.setup_service_instances(
+            service_instances=[('fake_service', 'main'), ('fake_service', 'canary')],
+            client=fake_client,
+            marathon_config=mock.Mock(),
+            soa_dir='fake_soa_dir',
+            jobs=1,
+            marathon_snapshot=stale_snapshot,
+        )
+        fetch_marathon_snapshot_patch.assert_called_once_with(fake_client)
+        for call in setup_service_instance_patch.call_args_list:
+            assert call[1]['marathon_snapshot'] is fetch_marathon_snapshot_patch.return_value
+
+
+def test_setup_service_instances_survives_exceptions():
+    with mock.patch(
+        'paasta_tools.setup_marathon_jobs.setup_service_instance',
+        autospec=True,
+        side_effect=lambda service, instance, **kwargs: 0 if instance == 'main' else 1 / 0,
+    ):
+        actual = setup_marathon_jobs.setup_service_instances(
+            service_instances=[('fake_service', 'broken'), ('fake_service', 'main')],
+            client=mock.Mock(),
+            marathon_config=mock.Mock(),
+            soa_dir='fake_soa_dir',
+            jobs=1,
+        )
+        assert actual == [('fake_service', 'broken', 1), ('fake_service', 'main', 0)]
+
+
+def test_main():
+    fake_args = mock.Mock(soa_dir='fake_soa_dir', jobs=3, verbose=False)
+    fake_service_instances = [('fake_service', 'main'), ('fake_service', 'canary')]
+    fake_marathon_config = mock.Mock()
+    fake_zk = mock.Mock()
+    with contextlib.nested(
+        mock.patch('paasta_tools.setup_marathon_jobs.parse_args', autospec=True, return_value=fake_args),
+        mock.patch('paasta_tools.setup_marathon_jobs.configure_log', autospec=True),
+        mock.patch('paasta_tools.setup_marathon_jobs.load_system_paasta_config', autospec=True),
+        mock.patch('paasta_tools.setup_marathon_jobs.get_services_for_cluster', autospec=True,
+                   return_value=fake_service_instances),
+        mock.patch('paasta_tools.setup_marathon_jobs.get_main_marathon_config', autospec=True,
+                   return_value=fake_marathon_config),
+        mock.patch('paasta_tools.marathon_tools.get_marathon_client', autospec=True),
+        mock.patch('paasta_tools.marathon_tools.fetch_marathon_snapshot', autospec=True),
+        mock.patch('paasta_tools.setup_marathon_jobs.get_zookeeper_client', autospec=True, return_value=fake_zk),
+        mock.patch('paasta_tools.setup_marathon_jobs.setup_service_instances', autospec=True,
+                   return_value=[('fake_service', 'main', 0), ('fake_service', 'canary', 0)]),
+    ) as (
+        _,
+        _,
+        load_system_paasta_config_patch,
+        get_services_for_cluster_patch,
+        _,
+        get_marathon_client_patch,
+        fetch_marathon_snapshot_patch,
+        get_zookeeper_client_patch,
+        setup_service_instances_patch,
+    ):
+        fake_system_paasta_config = load_system_paasta_config_patch.return_value
+        fake_system_paasta_config.get_cluster.return_value = 'fake_cluster'
+        fake_system_paasta_config.get_zk_hosts.return_value = 'fake_zk_hosts'
+        with raises(SystemExit) as exc_info:
+            setup_marathon_jobs.main()
+        assert exc_info.value.code == 0
+        get_services_for_cluster_patch.assert_called_once_with(
+            cluster='fake_cluster',
+            instance_type='marathon',
+            soa_dir='fake_soa_dir',
+        )
+        fetch_marathon_snapshot_patch.assert_called_once_with(get_marathon_client_patch.return_value)
+        get_zookeeper_client_patch.assert_called_once_with('fake_zk_hosts', timeout=mock.ANY)
+        setup_service_instances_patch.assert_called_once_with(
+            service_instances=mock.ANY,
+            client=get_marathon_client_patch.return_value,
+            marathon_config=fake_marathon_config,
+            soa_dir='fake_soa_dir',
+            jobs=3,
+            marathon_snapshot=fetch_marathon_snapshot_patch.return_value,
+            system_paasta_config=fake_system_paasta_config,
+            zk=fake_zk,
+        )
+        assert sorted(setup_service_instances_patch.call_args[1]['service_instances']) == \
+            sorted(fake_service_instances)
+
+
+def test_main_exits_1_if_any_instance_failed():
+    fake_args = mock.Mock(soa_dir='fake_soa_dir', jobs=3, verbose=False)
+    with contextlib.nested(
+        mock.patch('paasta_tools.setup_marathon_jobs.parse_args', autospec=True, return_value=fake_args),
+        mock.patch('paasta_tools.setup_marathon_jobs.configure_log', autospec=True),
+        mock.patch('paasta_tools.setup_marathon_jobs.load_system_paasta_config', autospec=True),
+        mock.patch('paasta_tools.setup_marathon_jobs.get_services_for_cluster', autospec=True, return_value=[]),
+        mock.patch('paasta_tools.setup_marathon_jobs.get_main_marathon_config', autospec=True),
+        mock.patch('paasta_tools.marathon_tools.get_marathon_client', autospec=True),
+        mock.patch('paasta_tools.marathon_tools.fetch_marathon_snapshot', autospec=True),
+        mock.patch('paasta_tools.setup_marathon_jobs.get_zookeeper_client', autospec=True),
+        mock.patch('paasta_tools.setup_marathon_jobs.setup_service_instances', autospec=True,
+                   return_value=[('fake_service', 'main', 0), ('fake_service', 'canary', 1)]),
+    ):
+        with raises(SystemExit) as exc_info:
+            setup_marathon_jobs.main()
+        assert exc_info.value.code == 1
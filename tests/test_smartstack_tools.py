@@ -0,0 +1,325 @@
+# Copyright 2015 Yelp Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import contextlib
+import os
+import shutil
+import socket
+import tempfile
+import threading
+
+import mock
+from pytest import raises
+
+from paasta_tools import smartstack_tools
+
+
+FAKE_HAPROXY_CSV = (
+    "# pxname,svname,status,\n"
+    "service1,FRONTEND,OPEN,\n"
+    "service1,10.0.0.1:31000_host1,UP,\n"
+    "service1,BACKEND,UP,\n"
+    "service2,10.0.0.2:31001_host2,DOWN,\n"
+)
+
+
+def make_fake_haproxy_csv(*args, **kwargs):
+    return FAKE_HAPROXY_CSV
+
+
+def test_get_haproxy_session_is_shared():
+    with mock.patch.object(smartstack_tools, '_haproxy_session', None):
+        session = smartstack_tools.get_haproxy_session()
+        assert smartstack_tools.get_haproxy_session() is session
+
+
+def test_retrieve_haproxy_csv_uses_shared_session():
+    fake_session = mock.Mock()
+    fake_session.get.return_value.text = FAKE_HAPROXY_CSV
+    with mock.patch('paasta_tools.smartstack_tools.get_haproxy_session', autospec=True,
+                    return_value=fake_session):
+        lines = list(smartstack_tools.retrieve_haproxy_csv('fake_host', 1234))
+    fake_session.get.assert_called_once_with('http://fake_host:1234/;csv;norefresh', timeout=1)
+    assert len(lines) == 4
+
+
+def test_get_multiple_backends_reuses_csv():
+    with contextlib.nested(
+        mock.patch('paasta_tools.smartstack_tools.fetch_haproxy_csv', autospec=True,
+                   side_effect=make_fake_haproxy_csv),
+        mock.patch.object(smartstack_tools, '_haproxy_csv_cache', {}),
+    ) as (
+        mock_fetch_haproxy_csv,
+        _,
+    ):
+        all_backends = smartstack_tools.get_multiple_backends(synapse_host='fake_host', synapse_port=1234)
+        service2_backends = smartstack_tools.get_backends('service2', synapse_host='fake_host', synapse_port=1234)
+        mock_fetch_haproxy_csv.assert_called_once_with('fake_host', 1234)
+
+        smartstack_tools.get_backends('service2', synapse_host='other_host', synapse_port=1234)
+        assert mock_fetch_haproxy_csv.call_count == 2
+
+    assert [(b['pxname'], b['svname']) for b in all_backends] == [
+        ('service1', '10.0.0.1:31000_host1'),
+        ('service2', '10.0.0.2:31001_host2'),
+    ]
+    assert service2_backends == [smartstack_tools.HaproxyBackend('service2', '10.0.0.2:31001_host2', 'DOWN')]
+
+
+def test_get_haproxy_csv_expires():
+    with contextlib.nested(
+        mock.patch('paasta_tools.smartstack_tools.fetch_haproxy_csv', autospec=True,
+                   side_effect=make_fake_haproxy_csv),
+        mock.patch.object(smartstack_tools, '_haproxy_csv_cache', {}),
+        mock.patch('paasta_tools.smartstack_tools.time.time', autospec=True),
+    ) as (
+        mock_fetch_haproxy_csv,
+        _,
+        mock_time,
+    ):
+        mock_time.return_value = 1000
+        smartstack_tools.get_haproxy_csv('fake_host', 1234, ttl=5)
+        mock_time.return_value = 1004
+        smartstack_tools.get_haproxy_csv('fake_host', 1234, ttl=5)
+        assert mock_fetch_haproxy_csv.call_count == 1
+        mock_time.return_value = 1005
+        smartstack_tools.get_haproxy_csv('fake_host', 1234, ttl=5)
+        assert mock_fetch_haproxy_csv.call_count == 2
+
+
+def test_parse_haproxy_backends_keeps_only_needed_columns():
+    haproxy_data = (
+        "# pxname,svname,qcur,status,lastchg,check_status,check_code,check_duration,\n"
+        "service1,10.0.0.1:31000_host1,0,UP,10,L7OK,200,1,\n"
+        "service2,10.0.0.2:31001_host2,0,DOWN 1/2,20,L4CON,,0,\n"
+        "service3,BACKEND,0,UP,30,,,,\n"
+    )
+    actual = smartstack_tools.parse_haproxy_backends(haproxy_data)
+    assert actual == [
+        smartstack_tools.HaproxyBackend('service1', '10.0.0.1:31000_host1', 'UP', 'L7OK', '200', '1', '10'),
+        smartstack_tools.HaproxyBackend('service2', '10.0.0.2:31001_host2', 'DOWN 1/2', 'L4CON', '', '0', '20'),
+    ]
+    assert actual[1]['status'] == 'DOWN 1/2'
+    assert actual[1]['lastchg'] == '20'
+    with raises(KeyError):
+        actual[1]['qcur']
+
+
+def test_parse_haproxy_backends_filters_services():
+    actual = smartstack_tools.parse_haproxy_backends(FAKE_HAPROXY_CSV, services=['service1'])
+    assert [backend['svname'] for backend in actual] == ['10.0.0.1:31000_host1']
+    assert smartstack_tools.parse_haproxy_backends('', services=['service1']) == []
+
+
+def test_parse_haproxy_backends_handles_missing_columns():
+    actual = smartstack_tools.parse_haproxy_backends(FAKE_HAPROXY_CSV)
+    assert actual[0]['check_status'] is None
+
+
+class FakeHaproxyStatsSocket(object):
+    """A UNIX socket that answers each connection with a canned haproxy csv,
+    remembering the commands it was sent."""
+
+    def __init__(self, response):
+        self.response = response
+        self.commands = []
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'haproxy.sock')
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(self.path)
+        self.sock.listen(1)
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.daemon = True
+
+    def serve(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except socket.error:
+                return
+            self.commands.append(conn.recv(1024))
+            conn.sendall(self.response)
+            conn.close()
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.sock.close()
+        shutil.rmtree(self.tmpdir)
+
+
+def test_fetch_haproxy_csv_from_socket():
+    with FakeHaproxyStatsSocket(FAKE_HAPROXY_CSV) as fake_socket:
+        actual = smartstack_tools.fetch_haproxy_csv_from_socket(fake_socket.path)
+    assert actual == FAKE_HAPROXY_CSV
+    assert fake_socket.commands == ['show stat -1 4 -1\n']
+
+
+def test_fetch_haproxy_csv_prefers_local_socket():
+    with contextlib.nested(
+        FakeHaproxyStatsSocket(FAKE_HAPROXY_CSV),
+        mock.patch('paasta_tools.smartstack_tools.get_haproxy_session', autospec=True),
+    ) as (
+        fake_socket,
+        mock_get_haproxy_session,
+    ):
+        actual = smartstack_tools.fetch_haproxy_csv('localhost', 1234, stats_socket=fake_socket.path)
+        assert actual == FAKE_HAPROXY_CSV
+        assert len(fake_socket.commands) == 1
+        assert mock_get_haproxy_session.call_count == 0
+
+        smartstack_tools.fetch_haproxy_csv('remote_host', 1234, stats_socket=fake_socket.path)
+        smartstack_tools.fetch_haproxy_csv('localhost', 1234, stats_socket=None)
+        assert len(fake_socket.commands) == 1
+        assert mock_get_haproxy_session.call_count == 2
+
+
+def test_fetch_haproxy_csv_falls_back_to_http():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        # A socket file that nothing listens on
+        stats_socket = os.path.join(tmpdir, 'haproxy.sock')
+        socket.socket(socket.AF_UNIX, socket.SOCK_STREAM).bind(stats_socket)
+        with mock.patch('paasta_tools.smartstack_tools.get_haproxy_session', autospec=True) as mock_session:
+            mock_session.return_value.get.return_value.text = FAKE_HAPROXY_CSV
+            actual = smartstack_tools.fetch_haproxy_csv('localhost', 1234, stats_socket=stats_socket)
+    finally:
+        shutil.rmtree(tmpdir)
+    assert actual == FAKE_HAPROXY_CSV
+    mock_session.return_value.get.assert_called_once_with('http://localhost:1234/;csv;norefresh', timeout=1)
+
+
+def test_fetch_haproxy_csv_without_socket_skips_fqdn_lookup():
+    with contextlib.nested(
+        mock.patch('paasta_tools.smartstack_tools.get_haproxy_session', autospec=True),
+        mock.patch('socket.getfqdn', autospec=True),
+    ) as (
+        _,
+        getfqdn_patch,
+    ):
+        smartstack_tools.fetch_haproxy_csv('remote_host', 1234, stats_socket='/nonexistent/haproxy.sock')
+    assert getfqdn_patch.call_count == 0
+
+
+def test_retrieve_haproxy_csv_reads_socket():
+    with FakeHaproxyStatsSocket(FAKE_HAPROXY_CSV) as fake_socket:
+        lines = list(smartstack_tools.retrieve_haproxy_csv('localhost', 1234, stats_socket=fake_socket.path))
+    assert [line['svname'] for line in lines] == [
+        'FRONTEND', '10.0.0.1:31000_host1', 'BACKEND', '10.0.0.2:31001_host2',
+    ]
+
+
+def test_query_locations_queries_first_host_of_each_location_concurrently():
+    locations = {
+        'place1': ['host1', 'host2'],
+        'place2': ['host3'],
+        'place3': ['host4'],
+    }
+    all_started = threading.Event()
+    started = []
+
+    def fake_query(synapse_host):
+        started.append(synapse_host)
+        if len(started) == len(locations):
+            all_started.set()
+        # Only returns if every other query is running at the same time
+        assert all_started.wait(5)
+        return 'result from %s' % synapse_host
+
+    actual = smartstack_tools.query_locations(locations, fake_query)
+    assert actual == {
+        'place1': 'result from host1',
+        'place2': 'result from host3',
+        'place3': 'result from host4',
+    }
+
+
+def test_query_locations_raises_query_exceptions():
+    def fake_query(synapse_host):
+        if synapse_host == 'host3':
+            raise ValueError(synapse_host)
+        return synapse_host
+
+    with mock.patch.object(smartstack_tools, '_synapse_host_failures', {}):
+        with raises(ValueError):
+            smartstack_tools.query_locations({'place1': ['host1'], 'place2': ['host3']}, fake_query)
+    assert smartstack_tools.query_locations({}, fake_query) == {}
+
+
+def test_query_location_keeps_query_traceback():
+    def fake_query(synapse_host):
+        raise ValueError(synapse_host)
+
+    with mock.patch.object(smartstack_tools, '_synapse_host_failures', {}):
+        with raises(ValueError) as excinfo:
+            smartstack_tools.query_location(['host1'], fake_query)
+        with raises(ValueError) as locations_excinfo:
+            smartstack_tools.query_locations({'place1': ['host1']}, fake_query)
+    assert excinfo.traceback[-1].name == 'fake_query'
+    assert locations_excinfo.traceback[-1].name == 'fake_query'
+
+
+def test_query_location_fails_over_to_next_host():
+    def fake_query(synapse_host):
+        if synapse_host == 'bad_host':
+            raise ValueError(synapse_host)
+        return synapse_host
+
+    with mock.patch.object(smartstack_tools, '_synapse_host_failures', {}):
+        assert smartstack_tools.query_location(['bad_host', 'good_host'], fake_query) == 'good_host'
+        with raises(ValueError):
+            smartstack_tools.query_location(['bad_host', 'bad_host'], fake_query)
+
+
+def test_query_location_hedges_slow_hosts():
+    slow_host_release = threading.Event()
+
+    def fake_query(synapse_host):
+        if synapse_host == 'slow_host':
+            slow_host_release.wait(5)
+        return synapse_host
+
+    with mock.patch.object(smartstack_tools, '_synapse_host_failures', {}):
+        try:
+            actual = smartstack_tools.query_location(['slow_host', 'fast_host'], fake_query, hedge_delay_s=0.01)
+        finally:
+            slow_host_release.set()
+    assert actual == 'fast_host'
+
+
+def test_query_location_skips_failing_hosts():
+    queried = []
+
+    def fake_query(synapse_host):
+        queried.append(synapse_host)
+        if synapse_host == 'bad_host':
+            raise ValueError(synapse_host)
+        return synapse_host
+
+    with mock.patch.object(smartstack_tools, '_synapse_host_failures', {}):
+        for _ in range(smartstack_tools.MAX_SYNAPSE_HOST_FAILURES):
+            smartstack_tools.query_location(['bad_host', 'good_host'], fake_query)
+        assert smartstack_tools.is_synapse_host_failing('bad_host')
+        del queried[:]
+        assert smartstack_tools.query_location(['bad_host', 'good_host'], fake_query) == 'good_host'
+        assert queried == ['good_host']
+
+        # Failing hosts are still asked when no other host is left
+        smartstack_tools.record_synapse_host_result('good_host', False)
+        assert smartstack_tools.query_location(['bad_host', 'good_host'], fake_query, max_hosts=1) == 'good_host'
+
+        smartstack_tools.record_synapse_host_result('bad_host', True)
+        assert not smartstack_tools.is_synapse_host_failing('bad_host')
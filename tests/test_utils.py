@@ -169,6 +169,27 @@ def test_load_system_paasta_config():
         assert json_patch.call_count == 1
 
 
+def test_get_system_paasta_config_signature_itest():
+    tempdir = tempfile.mkdtemp()
+    try:
+        with open(os.path.join(tempdir, 'cluster.json'), 'w') as f:
+            json.dump({'cluster': 'fake_cluster'}, f)
+        with open(os.path.join(tempdir, 'README'), 'w') as f:
+            f.write('not a config file\n')
+        signature = utils.get_system_paasta_config_signature(tempdir)
+        assert [config_file for config_file, _ in signature] == [os.path.join(tempdir, 'cluster.json')]
+
+        with open(os.path.join(tempdir, 'README'), 'w') as f:
+            f.write('still not a config file\n')
+        assert utils.get_system_paasta_config_signature(tempdir) == signature
+
+        with open(os.path.join(tempdir, 'marathon.json'), 'w') as f:
+            json.dump({'url': 'http://marathon'}, f)
+        assert utils.get_system_paasta_config_signature(tempdir) != signature
+    finally:
+        shutil.rmtree(tempdir)
+
+
 def test_load_system_paasta_config_file_non_existent_dir():
     fake_path = '/var/dir_of_fake'
     with contextlib.nested(
@@ -667,6 +688,198 @@ def test_DeploymentsJson_read():
         assert actual == fake_json['v1']
 
 
+def test_read_soa_config_file_parses_once_until_changed_itest():
+    tempdir = tempfile.mkdtemp()
+    fake_path = os.path.join(tempdir, 'fake.json')
+    parse = mock.Mock(side_effect=utils._load_json_file)
+    try:
+        with open(fake_path, 'w') as f:
+            json.dump({'a': 1}, f)
+        assert utils.read_soa_config_file(fake_path, parse) == {'a': 1}
+        assert utils.read_soa_config_file(fake_path, parse) == {'a': 1}
+        assert parse.call_count == 1
+
+        with open(fake_path, 'w') as f:
+            json.dump({'a': 1, 'b': 2}, f)
+        assert utils.read_soa_config_file(fake_path, parse) == {'a': 1, 'b': 2}
+        assert parse.call_count == 2
+    finally:
+        shutil.rmtree(tempdir)
+
+
+def test_get_soa_service_signature_itest():
+    tempdir = tempfile.mkdtemp()
+    service_dir = os.path.join(tempdir, 'fake_service')
+    os.mkdir(service_dir)
+    try:
+        with open(os.path.join(service_dir, 'marathon-fake_cluster.yaml'), 'w') as f:
+            f.write('main: {}\n')
+        with open(os.path.join(service_dir, 'README'), 'w') as f:
+            f.write('not read by paasta\n')
+        signature = utils.get_soa_service_signature('fake_service', tempdir)
+        assert [filename for filename, _ in signature] == ['marathon-fake_cluster.yaml']
+
+        with open(os.path.join(service_dir, 'README'), 'w') as f:
+            f.write('still not read by paasta\n')
+        assert utils.get_soa_service_signature('fake_service', tempdir) == signature
+
+        with open(os.path.join(service_dir, 'deployments.json'), 'w') as f:
+            json.dump({'v1': {}}, f)
+        assert utils.get_soa_service_signature('fake_service', tempdir) != signature
+
+        assert utils.get_soa_service_signature('missing_service', tempdir) is None
+    finally:
+        shutil.rmtree(tempdir)
+
+
+def test_read_soa_config_file_returns_copies_itest():
+    tempdir = tempfile.mkdtemp()
+    fake_path = os.path.join(tempdir, 'fake.json')
+    try:
+        with open(fake_path, 'w') as f:
+            json.dump({'a': {'b': 1}}, f)
+        utils.read_soa_config_file(fake_path, utils._load_json_file)['a']['b'] = 2
+        assert utils.read_soa_config_file(fake_path, utils._load_json_file) == {'a': {'b': 1}}
+    finally:
+        shutil.rmtree(tempdir)
+
+
+def test_read_soa_config_file_missing_file():
+    fake_read_missing = mock.Mock(return_value={})
+    fake_parse = mock.Mock()
+    with mock.patch('paasta_tools.utils._get_file_signature', autospec=True, return_value=None):
+        assert utils.read_soa_config_file('/fake/path', fake_parse, read_missing=fake_read_missing) == {}
+    fake_read_missing.assert_called_once_with()
+    assert fake_parse.call_count == 0
+
+
+def test_read_extra_service_information_itest():
+    tempdir = tempfile.mkdtemp()
+    try:
+        os.mkdir(os.path.join(tempdir, 'fake_service'))
+        with open(os.path.join(tempdir, 'fake_service', 'marathon-fake_cluster.yaml'), 'w') as f:
+            f.write('main:\n  instances: 3\n')
+        actual = utils.read_extra_service_information('fake_service', 'marathon-fake_cluster', soa_dir=tempdir)
+        assert actual == {'main': {'instances': 3}}
+    finally:
+        shutil.rmtree(tempdir)
+
+
+def test_read_service_configuration_itest():
+    tempdir = tempfile.mkdtemp()
+    try:
+        os.mkdir(os.path.join(tempdir, 'fake_service'))
+        with open(os.path.join(tempdir, 'fake_service', 'service.yaml'), 'w') as f:
+            f.write('git_url: git@fake:fake_service\n')
+        with open(os.path.join(tempdir, 'fake_service', 'smartstack.yaml'), 'w') as f:
+            f.write('main:\n  proxy_port: 1234\n')
+        actual = utils.read_service_configuration('fake_service', soa_dir=tempdir)
+        assert actual['git_url'] == 'git@fake:fake_service'
+        assert actual['smartstack'] == {'main': {'proxy_port': 1234}}
+        assert actual['monitoring'] == {}
+        assert actual['port'] is None
+    finally:
+        shutil.rmtree(tempdir)
+
+
+def test_compile_soa_snapshot_itest():
+    tempdir = tempfile.mkdtemp()
+    try:
+        os.mkdir(os.path.join(tempdir, 'fake_service'))
+        with open(os.path.join(tempdir, 'fake_service', 'marathon-fake_cluster.yaml'), 'w') as f:
+            f.write('main:\n  instances: 3\n')
+        with open(os.path.join(tempdir, 'fake_service', 'deployments.json'), 'w') as f:
+            json.dump({'v1': {}}, f)
+        with open(os.path.join(tempdir, 'fake_service', 'broken.yaml'), 'w') as f:
+            f.write('main: [\n')
+        with open(os.path.join(tempdir, 'fake_service', 'port'), 'w') as f:
+            f.write('1234\n')
+        with open(os.path.join(tempdir, 'not_a_service'), 'w') as f:
+            f.write('hi\n')
+
+        actual = utils.compile_soa_snapshot(tempdir)
+        assert actual['version'] == utils.SOA_SNAPSHOT_VERSION
+        assert actual['soa_dir'] == os.path.abspath(tempdir)
+        assert actual['files'] == {
+            os.path.join('fake_service', 'marathon-fake_cluster.yaml'): (
+                utils._get_file_signature(os.path.join(tempdir, 'fake_service', 'marathon-fake_cluster.yaml')),
+                {'main': {'instances': 3}},
+            ),
+            os.path.join('fake_service', 'deployments.json'): (
+                utils._get_file_signature(os.path.join(tempdir, 'fake_service', 'deployments.json')),
+                {'v1': {}},
+            ),
+        }
+    finally:
+        shutil.rmtree(tempdir)
+
+
+def test_write_and_load_soa_snapshot_itest():
+    tempdir = tempfile.mkdtemp()
+    fake_path = os.path.join(tempdir, 'soa_snapshot.pickle')
+    fake_snapshot = {
+        'version': utils.SOA_SNAPSHOT_VERSION,
+        'soa_dir': '/fake/soa_dir',
+        'timestamp': 1234,
+        'files': {'fake_service/service.yaml': {'a': 'b'}},
+    }
+    try:
+        utils.write_soa_snapshot(fake_snapshot, fake_path)
+        assert utils.load_soa_snapshot(fake_path) == fake_snapshot
+    finally:
+        shutil.rmtree(tempdir)
+
+
+def test_load_soa_snapshot_missing():
+    with raises(utils.SoaSnapshotNotAvailable):
+        utils.load_soa_snapshot('/this/snapshot/does/not/exist')
+
+
+def test_load_soa_snapshot_other_version_itest():
+    tempdir = tempfile.mkdtemp()
+    fake_path = os.path.join(tempdir, 'soa_snapshot.pickle')
+    try:
+        utils.write_soa_snapshot({'version': utils.SOA_SNAPSHOT_VERSION + 1}, fake_path)
+        with raises(utils.SoaSnapshotNotAvailable):
+            utils.load_soa_snapshot(fake_path)
+    finally:
+        shutil.rmtree(tempdir)
+
+
+def test_read_soa_config_file_uses_snapshot_when_unchanged_itest():
+    tempdir = tempfile.mkdtemp()
+    fake_path = os.path.join(tempdir, 'fake_service', 'service.yaml')
+    parse = mock.Mock(side_effect=utils._load_yaml_file)
+    try:
+        os.mkdir(os.path.join(tempdir, 'fake_service'))
+        with open(fake_path, 'w') as f:
+            f.write('a: b\n')
+        fake_snapshot = {
+            'soa_dir': os.path.abspath(tempdir),
+            'timestamp': os.stat(fake_path).st_mtime + 1,
+            'files': {
+                os.path.join('fake_service', 'service.yaml'): (
+                    utils._get_file_signature(fake_path),
+                    {'from': 'snapshot'},
+                ),
+            },
+        }
+        with mock.patch('paasta_tools.utils.get_soa_snapshot', autospec=True, return_value=fake_snapshot):
+            assert utils.read_soa_config_file(fake_path, parse) == {'from': 'snapshot'}
+            assert parse.call_count == 0
+
+            # A file copied in with its old mtime preserved, like rsync -t does, is parsed again
+            old_mtime = os.stat(fake_path).st_mtime
+            os.rename(fake_path, fake_path + '.old')
+            with open(fake_path, 'w') as f:
+                f.write('a: c\n')
+            os.utime(fake_path, (old_mtime, old_mtime))
+            assert utils.read_soa_config_file(fake_path, parse) == {'a': 'c'}
+            assert parse.call_count == 1
+    finally:
+        shutil.rmtree(tempdir)
+
+
 def test_get_docker_url_no_error():
     fake_registry = "im.a-real.vm"
     fake_image = "and-i-can-run:1.0"
@@ -1084,3 +1297,13 @@ def test_format_table_all_strings():
     actual = utils.format_table(['foo', 'bar', 'baz'])
     expected = ['foo', 'bar', 'baz']
     assert actual == expected
+
+
+def test_SystemPaastaConfig_get_marathon_app_creation_leases():
+    fake_config = utils.SystemPaastaConfig({'marathon_app_creation_leases': 4}, '/some/fake/dir')
+    assert fake_config.get_marathon_app_creation_leases() == 4
+
+
+def test_SystemPaastaConfig_get_marathon_app_creation_leases_default():
+    fake_config = utils.SystemPaastaConfig({}, '/some/fake/dir')
+    assert fake_config.get_marathon_app_creation_leases() == utils.DEFAULT_MARATHON_APP_CREATION_LEASES
@@ -0,0 +1,108 @@
+# Copyright 2015 Yelp Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import contextlib
+
+import mock
+from kazoo.client import KazooState
+from pytest import raises
+
+from paasta_tools import zookeeper_tools
+
+
+def test_get_client_starts_one_client_per_ensemble():
+    manager = zookeeper_tools.ZookeeperClientManager()
+    with contextlib.nested(
+        mock.patch('paasta_tools.zookeeper_tools.KazooClient', autospec=True),
+        mock.patch('paasta_tools.zookeeper_tools.atexit', autospec=True),
+    ) as (
+        kazoo_client_patch,
+        atexit_patch,
+    ):
+        kazoo_client_patch.side_effect = lambda **kwargs: mock.Mock()
+        client = manager.get_client('fake_hosts', timeout=5)
+        assert manager.get_client('fake_hosts') is client
+        assert manager.get_client('other_hosts') is not client
+        assert manager.get_client('fake_hosts', read_only=True) is not client
+        assert kazoo_client_patch.call_count == 3
+        kazoo_client_patch.assert_any_call(hosts='fake_hosts', timeout=5, read_only=False)
+        client.start.assert_called_once_with(timeout=5)
+        atexit_patch.register.assert_called_once_with(manager.close_all)
+
+
+def test_get_client_retries_after_failed_start():
+    manager = zookeeper_tools.ZookeeperClientManager()
+    failing_client = mock.Mock()
+    failing_client.start.side_effect = Exception('timed out')
+    working_client = mock.Mock()
+    with contextlib.nested(
+        mock.patch('paasta_tools.zookeeper_tools.KazooClient', autospec=True,
+                   side_effect=[failing_client, working_client]),
+        mock.patch('paasta_tools.zookeeper_tools.atexit', autospec=True),
+    ):
+        with raises(Exception):
+            manager.get_client('fake_hosts')
+        failing_client.stop.assert_called_once_with()
+        failing_client.close.assert_called_once_with()
+        assert manager.get_client('fake_hosts') is working_client
+
+
+def test_lost_sessions_are_counted():
+    manager = zookeeper_tools.ZookeeperClientManager()
+    fake_client = mock.Mock()
+    with contextlib.nested(
+        mock.patch('paasta_tools.zookeeper_tools.KazooClient', autospec=True, return_value=fake_client),
+        mock.patch('paasta_tools.zookeeper_tools.atexit', autospec=True),
+    ):
+        client = manager.get_client('fake_hosts')
+    listener = fake_client.add_listener.call_args[0][0]
+    assert manager.get_lost_sessions(client) == 0
+    listener(KazooState.SUSPENDED)
+    listener(KazooState.CONNECTED)
+    assert manager.get_lost_sessions(client) == 0
+    listener(KazooState.LOST)
+    assert manager.get_lost_sessions(client) == 1
+    assert manager.get_lost_sessions(mock.Mock()) == 0
+
+
+def test_close_all():
+    manager = zookeeper_tools.ZookeeperClientManager()
+    with contextlib.nested(
+        mock.patch('paasta_tools.zookeeper_tools.KazooClient', autospec=True),
+        mock.patch('paasta_tools.zookeeper_tools.atexit', autospec=True),
+    ) as (
+        kazoo_client_patch,
+        _,
+    ):
+        kazoo_client_patch.side_effect = lambda **kwargs: mock.Mock()
+        client = manager.get_client('fake_hosts')
+        manager.close_all()
+        client.stop.assert_called_once_with()
+        client.close.assert_called_once_with()
+        assert manager.get_client('fake_hosts') is not client
+
+
+def test_get_zookeeper_client_defaults_to_system_zk_hosts():
+    with contextlib.nested(
+        mock.patch('paasta_tools.zookeeper_tools.load_system_paasta_config', autospec=True),
+        mock.patch.object(zookeeper_tools._client_manager, 'get_client', autospec=True),
+    ) as (
+        load_system_paasta_config_patch,
+        get_client_patch,
+    ):
+        load_system_paasta_config_patch.return_value.get_zk_hosts.return_value = 'fake_zk_hosts'
+        actual = zookeeper_tools.get_zookeeper_client()
+        get_client_patch.assert_called_once_with(
+            'fake_zk_hosts', read_only=False, timeout=zookeeper_tools.DEFAULT_ZK_CONNECT_TIMEOUT_S)
+        assert actual == get_client_patch.return_value
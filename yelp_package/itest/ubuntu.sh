@@ -27,6 +27,8 @@ generate_services_file
 generate_services_yaml
 list_chronos_jobs
 list_marathon_service_instances
+paasta_bounced
+paasta_compile_soa
 paasta_execute_docker_command
 paasta_metastatus
 paasta_serviceinit